@@ -96,7 +96,7 @@ class RecipeInfo(namedtuple('RecipeInfo', recipe_fields)):
 
     @classmethod
     def depvar(cls, var, metadata):
-        return bb.utils.explode_deps(cls.getvar(var, metadata))
+        return bb.utils.parse_deps(cls.getvar(var, metadata))
 
     @classmethod
     def pkgvar(cls, var, packages, metadata):
@@ -629,10 +629,10 @@ class CacheData(object):
             if dep not in self.all_depends:
                 self.all_depends.append(dep)
 
-        rprovides = info.rprovides
+        rprovides = list(info.rprovides)
         for package in info.packages:
             self.packages[package].append(fn)
-            rprovides += info.rprovides_pkg[package]
+            rprovides.extend(info.rprovides_pkg[package])
 
         for rprovide in rprovides:
             self.rproviders[rprovide].append(fn)
@@ -642,8 +642,8 @@ class CacheData(object):
 
         # Build hash of runtime depends and rececommends
         for package in info.packages + [info.pn]:
-            self.rundeps[fn][package] = list(info.rdepends) + info.rdepends_pkg[package]
-            self.runrecs[fn][package] = list(info.rrecommends) + info.rrecommends_pkg[package]
+            self.rundeps[fn][package] = list(info.rdepends) + list(info.rdepends_pkg[package])
+            self.runrecs[fn][package] = list(info.rrecommends) + list(info.rrecommends_pkg[package])
 
         # Collect files we may need for possible world-dep
         # calculations
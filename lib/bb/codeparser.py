@@ -2,13 +2,13 @@ import ast
 import codegen
 import logging
 import os.path
-import bb.utils, bb.data
+import time
+import bb.utils, bb.data, bb.shellscan
 from itertools import chain
-from pysh import pyshyacc, pyshlex, sherrors
 
 
 logger = logging.getLogger('BitBake.CodeParser')
-PARSERCACHE_VERSION = 2
+PARSERCACHE_VERSION = 3
 
 try:
     import cPickle as pickle
@@ -32,8 +32,38 @@ def check_indent(codestr):
 
     return codestr
 
+def walk_calls(node):
+    """Yield the Call nodes of a python abstract syntax tree, in no
+    particular order. Cheaper than filtering ast.walk().
+    """
+
+    todo = [node]
+    while todo:
+        node = todo.pop()
+        if isinstance(node, ast.Call):
+            yield node
+        for field in node._fields:
+            value = getattr(node, field, None)
+            if isinstance(value, list):
+                for item in value:
+                    if isinstance(item, ast.AST):
+                        todo.append(item)
+            elif isinstance(value, ast.AST):
+                todo.append(value)
+
+# Results of parsing python and shell code, keyed by the hash of the code.
+# bb_codeparser.dat holds the compacted cache. Parsing processes don't
+# rewrite it but add the entries they parsed to it as a shard of their own
+# (bb_codeparser.dat.<unique>.shard), which needs no locking.
+# parser_cache_init() loads the shards as well and parser_cache_compact()
+# merges them back into bb_codeparser.dat once there are
+# PARSERCACHE_MAX_SHARDS of them.
+PARSERCACHE_MAX_SHARDS = 32
 pythonparsecache = {}
 shellparsecache = {}
+# Keys of the entries parsed rather than loaded by this process
+pythonparsecache_new = set()
+shellparsecache_new = set()
 
 def parser_cachefile(d):
     cachedir = (bb.data.getVar("PERSISTENT_DIR", d, True) or
@@ -45,50 +75,103 @@ def parser_cachefile(d):
     logger.debug(1, "Using cache in '%s' for codeparser cache", cachefile)
     return cachefile
 
-def parser_cache_init(d):
-    global pythonparsecache
-    global shellparsecache
+def _load_parser_cache(filename):
+    try:
+        p = pickle.Unpickler(file(filename, "rb"))
+        data, version = p.load()
+    except Exception:
+        return None
+    if version != PARSERCACHE_VERSION:
+        return None
+    return data
 
+def _write_parser_cache(cachefile, python, shell, shard = False):
+    with bb.utils.replacing(cachefile, shard) as f:
+        pickle.dump([[python, shell], PARSERCACHE_VERSION], f, -1)
+
+def _merge_parser_cache(data):
+    for h in data[0]:
+        if h not in pythonparsecache:
+            pythonparsecache[h] = data[0][h]
+    for h in data[1]:
+        if h not in shellparsecache:
+            shellparsecache[h] = data[1][h]
+
+def parser_cache_init(d):
+    """
+    Load the persistent cache and the shards not compacted into it yet
+    """
     cachefile = parser_cachefile(d)
     if not cachefile:
         return
 
-    try:
-        p = pickle.Unpickler(file(cachefile, "rb"))
-        data, version = p.load()
-    except:
-        return
+    start = time.time()
+    files = [cachefile] + bb.utils.shards(cachefile)
+    for filename in files:
+        data = _load_parser_cache(filename)
+        if data:
+            _merge_parser_cache(data)
+    logger.debug(1, "Loaded %d python and %d shell codeparser cache entries from %d files in %.3fs",
+                 len(pythonparsecache), len(shellparsecache), len(files), time.time() - start)
 
-    if version != PARSERCACHE_VERSION:
+def parser_cache_save(d):
+    """
+    Write the entries parsed by this process to a new shard of the
+    persistent cache
+    """
+    if not pythonparsecache_new and not shellparsecache_new:
+        return
+    cachefile = parser_cachefile(d)
+    if not cachefile:
         return
 
-    pythonparsecache = data[0]
-    shellparsecache = data[1]
-
-def parser_cache_save(d):
+    python = dict((h, pythonparsecache[h]) for h in pythonparsecache_new)
+    shell = dict((h, shellparsecache[h]) for h in shellparsecache_new)
+    _write_parser_cache(cachefile, python, shell, shard = True)
+    pythonparsecache_new.clear()
+    shellparsecache_new.clear()
+
+def parser_cache_compact(d):
+    """
+    Save the entries parsed by this process, merging them and the shards
+    of the persistent cache into bb_codeparser.dat if there are too many
+    shards. The shards' entries are added to this process' cache too.
+    """
     cachefile = parser_cachefile(d)
     if not cachefile:
         return
+    if len(bb.utils.shards(cachefile)) < PARSERCACHE_MAX_SHARDS:
+        parser_cache_save(d)
+        return
 
+    start = time.time()
     lf = bb.utils.lockfile(cachefile + ".lock")
-
     try:
-        p = pickle.Unpickler(file(cachefile, "rb"))
-        data, version = p.load()
-    except IOError:
-        data, version = None, None
-
-    if version == PARSERCACHE_VERSION:
-        for h in data[0]:
-            if h not in pythonparsecache:
-                pythonparsecache[h] = data[0][h]
-        for h in data[1]:
-            if h not in pythonparsecache:
-                shellparsecache[h] = data[1][h]
-
-    p = pickle.Pickler(file(cachefile, "wb"), -1)
-    p.dump([[pythonparsecache, shellparsecache], PARSERCACHE_VERSION])
-    bb.utils.unlockfile(lf)
+        shards = bb.utils.shards(cachefile)
+        python, shell = {}, {}
+        for filename in [cachefile] + shards:
+            data = _load_parser_cache(filename)
+            if data:
+                python.update(data[0])
+                shell.update(data[1])
+                _merge_parser_cache(data)
+        for h in pythonparsecache_new:
+            python[h] = pythonparsecache[h]
+        for h in shellparsecache_new:
+            shell[h] = shellparsecache[h]
+        _write_parser_cache(cachefile, python, shell)
+        for shard in shards:
+            try:
+                os.unlink(shard)
+            except OSError:
+                pass
+        bb.utils.remove_stale_temporaries(cachefile)
+    finally:
+        bb.utils.unlockfile(lf)
+    pythonparsecache_new.clear()
+    shellparsecache_new.clear()
+    logger.debug(1, "Compacted %d codeparser cache shards in %.3fs",
+                 len(shards), time.time() - start)
 
 class PythonParser():
     class ValueVisitor():
@@ -102,38 +185,53 @@ class PythonParser():
         execs = ("bb.build.exec_func", "bb.build.exec_task")
 
         @classmethod
-        def _compare_name(cls, strparts, node):
-            """Given a sequence of strings representing a python name,
-            where the last component is the actual Name and the prior
-            elements are Attribute nodes, determine if the supplied node
-            matches.
+        def _name_patterns(cls):
+            """Map the reversed components of the names above, and of the
+            trailing parts of them, to the group of the name. A call matches
+            a name if it ends with all its components ("x.d.getVar" matches
+            "d.getVar"), or if its whole name is a trailing part of it
+            ("getVar", "build.exec_func").
             """
 
-            if not strparts:
-                return True
+            names, trailing = {}, {}
+            for group in ("getvars", "expands", "execs"):
+                for value in getattr(cls, group):
+                    parts = tuple(reversed(value.split(".")))
+                    names[parts] = group
+                    for i in xrange(1, len(parts)):
+                        trailing.setdefault(parts[:i], group)
+            return names, trailing
+
+        @staticmethod
+        def dotted_name(node):
+            """Return the reversed components of the dotted name of a Name
+            node or chain of Attribute nodes, and whether the chain ends with
+            a Name rather than some other expression.
+            """
 
-            current, rest = strparts[0], strparts[1:]
-            if isinstance(node, ast.Attribute):
-                if current == node.attr:
-                    return cls._compare_name(rest, node.value)
-            elif isinstance(node, ast.Name):
-                if current == node.id:
-                    return True
-            return False
+            parts = []
+            while isinstance(node, ast.Attribute):
+                parts.append(node.attr)
+                node = node.value
+            if isinstance(node, ast.Name):
+                parts.append(node.id)
+                return tuple(parts), True
+            return tuple(parts), False
 
         @classmethod
-        def compare_name(cls, value, node):
-            """Convenience function for the _compare_node method, which
-            can accept a string (which is split by '.' for you), or an
-            iterable of strings, in which case it checks to see if any of
-            them match, similar to isinstance.
+        def name_group(cls, parts, complete):
+            """Return "getvars", "expands" or "execs" if the dotted name
+            given as returned by dotted_name() matches one of those names,
+            None otherwise.
             """
 
-            if isinstance(value, basestring):
-                return cls._compare_name(tuple(reversed(value.split("."))),
-                                         node)
-            else:
-                return any(cls.compare_name(item, node) for item in value)
+            for i in xrange(1, min(len(parts), cls.longest_name) + 1):
+                group = cls.patterns.get(parts[:i])
+                if group:
+                    return group
+            if complete:
+                return cls.trailing.get(parts)
+            return None
 
         def __init__(self, value):
             self.var_references = set()
@@ -159,39 +257,34 @@ class PythonParser():
                                 "not a literal", funcstr, argstr)
 
         def visit_Call(self, node):
-            if self.compare_name(self.getvars, node.func):
+            parts, complete = self.dotted_name(node.func)
+            group = self.name_group(parts, complete)
+            if group == "getvars":
                 if isinstance(node.args[0], ast.Str):
                     self.var_references.add(node.args[0].s)
                 else:
                     self.warn(node.func, node.args[0])
-            elif self.compare_name(self.expands, node.func):
+            elif group == "expands":
                 if isinstance(node.args[0], ast.Str):
                     self.warn(node.func, node.args[0])
                     self.var_expands.update(node.args[0].s)
                 elif isinstance(node.args[0], ast.Call) and \
-                     self.compare_name(self.getvars, node.args[0].func):
+                     self.name_group(*self.dotted_name(node.args[0].func)) == "getvars":
                     pass
                 else:
                     self.warn(node.func, node.args[0])
-            elif self.compare_name(self.execs, node.func):
+            elif group == "execs":
                 if isinstance(node.args[0], ast.Str):
                     self.var_execs.add(node.args[0].s)
                 else:
                     self.warn(node.func, node.args[0])
-            elif isinstance(node.func, ast.Name):
-                self.direct_func_calls.add(node.func.id)
-            elif isinstance(node.func, ast.Attribute):
-                # We must have a qualified name.  Therefore we need
-                # to walk the chain of 'Attribute' nodes to determine
-                # the qualification.
-                attr_node = node.func.value
-                identifier = node.func.attr
-                while isinstance(attr_node, ast.Attribute):
-                    identifier = attr_node.attr + "." + identifier
-                    attr_node = attr_node.value
-                if isinstance(attr_node, ast.Name):
-                    identifier = attr_node.id + "." + identifier
-                self.direct_func_calls.add(identifier)
+            elif parts:
+                # A call of a function by its qualified name, minus any
+                # expression the name is an attribute of
+                self.direct_func_calls.add(".".join(reversed(parts)))
+
+    ValueVisitor.patterns, ValueVisitor.trailing = ValueVisitor._name_patterns()
+    ValueVisitor.longest_name = max(len(parts) for parts in ValueVisitor.patterns)
 
     def __init__(self):
         #self.funcdefs = set()
@@ -201,20 +294,20 @@ class PythonParser():
 
     def parse_python(self, node):
 
-        h = hash(str(node))
+        node = str(node)
+        h = hash(node)
 
         if h in pythonparsecache:
             self.references = pythonparsecache[h]["refs"]
             self.execs = pythonparsecache[h]["execs"]
             return
 
-        code = compile(check_indent(str(node)), "<string>", "exec",
+        code = compile(check_indent(node), "<string>", "exec",
                        ast.PyCF_ONLY_AST)
 
         visitor = self.ValueVisitor(code)
-        for n in ast.walk(code):
-            if n.__class__.__name__ == "Call":
-                visitor.visit_Call(n)
+        for n in walk_calls(code):
+            visitor.visit_Call(n)
 
         self.references.update(visitor.var_references)
         self.references.update(visitor.var_execs)
@@ -223,6 +316,7 @@ class PythonParser():
         pythonparsecache[h] = {}
         pythonparsecache[h]["refs"] = self.references
         pythonparsecache[h]["execs"] = self.execs
+        pythonparsecache_new.add(h)
 
 class ShellParser():
     def __init__(self):
@@ -241,6 +335,33 @@ class ShellParser():
             self.execs = shellparsecache[h]["execs"]
             return self.execs
 
+        self._parse_shell(value)
+        self.execs = set(cmd for cmd in self.allexecs if cmd not in self.funcdefs)
+
+        shellparsecache[h] = {}
+        shellparsecache[h]["execs"] = self.execs
+        shellparsecache_new.add(h)
+
+        return self.execs
+
+    def _parse_shell(self, value):
+        """Add the commands executed and the functions defined by the shell
+        code to allexecs and funcdefs. The scanner handles the code found in
+        metadata, anything it doesn't understand goes through pysh.
+        """
+
+        try:
+            execs, funcdefs = bb.shellscan.scan(value)
+        except bb.shellscan.Unsupported:
+            pass
+        else:
+            self.allexecs |= execs
+            self.funcdefs |= funcdefs
+            return
+
+        # Importing pysh builds its parser, which only the code the scanner
+        # can't handle needs
+        from pysh import pyshyacc, pyshlex, sherrors
         try:
             tokens, _ = pyshyacc.parse(value, eof=True, debug=False)
         except pyshlex.NeedMore:
@@ -248,12 +369,6 @@ class ShellParser():
 
         for token in tokens:
             self.process_tokens(token)
-        self.execs = set(cmd for cmd in self.allexecs if cmd not in self.funcdefs)
-
-        shellparsecache[h] = {}
-        shellparsecache[h]["execs"] = self.execs
-
-        return self.execs
 
     def process_tokens(self, tokens):
         """Process a supplied portion of the syntax tree as returned by
@@ -318,6 +433,8 @@ class ShellParser():
         the command name argument.
         """
 
+        from pysh import pyshlex
+
         words = list(words)
         for word in list(words):
             wtree = pyshlex.make_wordtree(word[1])
@@ -327,7 +444,7 @@ class ShellParser():
 
                 if part[0] in ('`', '$('):
                     command = pyshlex.wordtree_as_string(part[1:-1])
-                    self.parse_shell(command)
+                    self._parse_shell(command)
 
                     if word[0] in ("cmd_name", "cmd_word"):
                         if word in words:
@@ -347,7 +464,7 @@ class ShellParser():
                                     "command '%s'", cmd)
                 elif cmd == "eval":
                     command = " ".join(word for _, word in words[1:])
-                    self.parse_shell(command)
+                    self._parse_shell(command)
                 else:
                     self.allexecs.add(cmd)
                 break
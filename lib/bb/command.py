@@ -171,6 +171,7 @@ class CommandsSync:
         varname = params[0]
         value = params[1]
         bb.data.setVar(varname, value, command.cooker.configuration.data)
+        command.cooker.resetBuildCache()
 
 
 class CommandsAsync:
@@ -66,6 +66,7 @@ class BBCooker:
     def __init__(self, configuration, server_registration_cb):
         self.status = None
         self.appendlist = {}
+        self.buildcache = None
 
         self.server_registration_cb = server_registration_cb
 
@@ -233,8 +234,9 @@ class BBCooker:
 
         # emit the metadata which isnt valid shell
         data.expandKeys(envdata)
+        python = envdata.keys_with_flag('python')
         for e in envdata.keys():
-            if data.getVarFlag( e, 'python', envdata ):
+            if e in python:
                 logger.plain("\npython %s () {\n%s}\n", e, data.getVar(e, envdata, 1))
 
     def prepareTreeData(self, pkgs_to_build, task):
@@ -613,6 +615,7 @@ class BBCooker:
 
         bb.fetch.fetcher_init(data)
         bb.codeparser.parser_cache_init(data)
+        bb.parse.statement_cache_init(data)
         bb.parse.init_parser(data)
         bb.event.fire(bb.event.ConfigParsed(), data)
         self.configuration.data = data
@@ -812,21 +815,50 @@ class BBCooker:
         buildname = bb.data.getVar("BUILDNAME", self.configuration.data)
         bb.event.fire(bb.event.BuildStarted(buildname, targets), self.configuration.event_data)
 
+        taskdata, rqdata = self.resolveTargets(targets, task)
+        runlist = [[k, "do_%s" % task] for k in targets]
+
+        rq = bb.runqueue.RunQueue(self, self.configuration.data, self.status, taskdata, runlist, rqdata)
+        self.buildcache.rqdata = rq.rqdata
+
+        self.server_registration_cb(buildTargetsIdle, rq)
+
+    def resolveTargets(self, targets, task):
+        """
+        Return the taskdata for building task of targets and, if an earlier
+        build of the same targets can be reused, its prepared runqueue data.
+        The cache is only valid for the parsed recipes (self.status) and
+        configuration it was created with.
+        """
+        key = (tuple(targets), task, self.configuration.abort,
+               self.configuration.tryaltconfigs)
+        cached = self.buildcache
+        if (cached and cached.key == key and cached.status is self.status and
+                cached.rqdata and cached.rqdata.prepared is not None and
+                len(cached.taskdata.failed_fnids) == cached.failed):
+            buildlog.debug(1, "Reusing the runqueue from the previous build of %s", " ".join(targets))
+            return cached.taskdata, cached.rqdata
+
         localdata = data.createCopy(self.configuration.data)
         bb.data.update_data(localdata)
         bb.data.expandKeys(localdata)
 
         taskdata = bb.taskdata.TaskData(self.configuration.abort)
 
-        runlist = []
         for k in targets:
             taskdata.add_provider(localdata, self.status, k)
-            runlist.append([k, "do_%s" % task])
         taskdata.add_unresolved(localdata, self.status)
 
-        rq = bb.runqueue.RunQueue(self, self.configuration.data, self.status, taskdata, runlist)
+        self.buildcache = BuildCache(key, self.status, taskdata)
+        return taskdata, None
 
-        self.server_registration_cb(buildTargetsIdle, rq)
+    def resetBuildCache(self):
+        """
+        Forget the cached runqueue and preferred versions, the
+        configuration has changed
+        """
+        self.buildcache = None
+        bb.providers.resetPreferredVersions()
 
     def updateCache(self):
         if self.state == state.running:
@@ -987,6 +1019,19 @@ class BBCooker:
     def stop(self):
         self.state = state.stop
 
+class BuildCache(object):
+    """
+    Resolved taskdata and prepared runqueue data of a buildTargets() call
+    """
+    def __init__(self, key, status, taskdata):
+        self.key = key
+        self.status = status
+        self.taskdata = taskdata
+        # A build trying alternative providers marks failed recipes in the
+        # taskdata, after which it no longer matches the key
+        self.failed = len(taskdata.failed_fnids)
+        self.rqdata = None
+
 class CookerExit(bb.event.Event):
     """
     Notify clients of the Cooker shutdown
@@ -1072,7 +1117,10 @@ class CookerParser(object):
     def start(self):
         def init(cfg):
             parse_file.cfg = cfg
+            # The statements parsed by the main process are saved by it
+            bb.parse.statementcache_parsed.clear()
             multiprocessing.util.Finalize(None, bb.codeparser.parser_cache_save, args=(self.cooker.configuration.data, ), exitpriority=1)
+            multiprocessing.util.Finalize(None, bb.parse.statement_cache_save, args=(self.cooker.configuration.data, ), exitpriority=1)
 
         self.results = self.load_cached()
 
@@ -1087,6 +1135,7 @@ class CookerParser(object):
 
     def shutdown(self, clean=True):
         if not self.toparse:
+            bb.parse.statement_cache_compact(self.cfgdata)
             return
 
         if clean:
@@ -1099,7 +1148,8 @@ class CookerParser(object):
             self.pool.terminate()
         self.pool.join()
 
-        bb.codeparser.parser_cache_save(self.cfgdata)
+        bb.codeparser.parser_cache_compact(self.cfgdata)
+        bb.parse.statement_cache_compact(self.cfgdata)
 
         sync = threading.Thread(target=self.bb_cache.sync)
         sync.start()
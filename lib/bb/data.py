@@ -227,17 +227,23 @@ def emit_var(var, o=sys.__stdout__, d = init(), all=False):
 def emit_env(o=sys.__stdout__, d = init(), all=False):
     """Emits all items in the data store in a format such that it can be sourced by a shell."""
 
-    isfunc = lambda key: bool(d.getVarFlag(key, "func"))
-    keys = sorted((key for key in d.keys() if not key.startswith("__")), key=isfunc)
+    funcs = d.keys_with_flag("func")
+    isfunc = lambda key: key in funcs
+    keys = (key for key in d.keys() if not key.startswith("__"))
+    if not all:
+        # Other variables aren't emitted, don't look at them
+        emitted = funcs | d.keys_with_flag("export") | d.keys_with_flag("unexport")
+        keys = (key for key in keys if key in emitted)
+    keys = sorted(keys, key=isfunc)
     grouped = groupby(keys, isfunc)
     for isfunc, keys in grouped:
         for key in keys:
             emit_var(key, o, d, all and not isfunc) and o.write('\n')
 
 def exported_keys(d):
-    return (key for key in d.keys() if not key.startswith('__') and
-                                      d.getVarFlag(key, 'export') and
-                                      not d.getVarFlag(key, 'unexport'))
+    unexported = d.keys_with_flag('unexport')
+    return (key for key in d.keys_with_flag('export') if not key.startswith('__') and
+                                                         key not in unexported)
 
 def exported_vars(d):
     for key in exported_keys(d):
@@ -252,7 +258,10 @@ def exported_vars(d):
 def emit_func(func, o=sys.__stdout__, d = init()):
     """Emits all items in the data store in a format such that it can be sourced by a shell."""
 
-    keys = (key for key in d.keys() if not key.startswith("__") and not d.getVarFlag(key, "func"))
+    # Only exported and unexported variables are emitted
+    emitted = d.keys_with_flag("export") | d.keys_with_flag("unexport")
+    emitted -= d.keys_with_flag("func")
+    keys = (key for key in d.keys() if not key.startswith("__") and key in emitted)
     for key in keys:
         emit_var(key, o, d, False) and o.write('\n')
 
@@ -302,10 +311,30 @@ def build_dependencies(key, keys, shelldeps, d):
     #bb.note("Variable %s references %s and calls %s" % (key, str(deps), str(execs)))
     #d.setVarFlag(key, "vardeps", deps)
 
-def generate_dependencies(d):
+def dependency_keys(d, base = None):
+    """
+    Return the variables generate_dependencies considers in d and the
+    subset of them exported to shell functions as a (d, keys, shelldeps)
+    tuple. base is such a tuple for a datastore d was copied from, and
+    which hasn't changed since, in which case only the variables set in d
+    since the copy are looked at.
+    """
+    shelldeps = set(exported_keys(d))
+    if base is None:
+        keys = set(key for key in d.keys() if not key.startswith("__"))
+        return d, keys, shelldeps
+
+    parent, keys, _ = base
+    changed = set(key for key in d.keys_since(parent) if not key.startswith("__"))
+    keys = keys | changed
+    return d, keys, shelldeps
 
-    keys = set(key for key in d.keys() if not key.startswith("__"))
-    shelldeps = set(key for key in keys if d.getVarFlag(key, "export") and not d.getVarFlag(key, "unexport"))
+def generate_dependencies(d, base = None):
+    """
+    Return the tasks of d and the variables each variable they use
+    depends on. base is passed on to dependency_keys.
+    """
+    _, keys, shelldeps = dependency_keys(d, base)
 
     deps = {}
 
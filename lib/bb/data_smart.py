@@ -37,10 +37,15 @@ from bb.COW  import COWDictBase
 
 logger = logging.getLogger("BitBake.Data")
 
+# Distinguishes flags which aren't set from flags set to None
+_missing = object()
+
 __setvar_keyword__ = ["_append", "_prepend"]
 __setvar_regexp__ = re.compile('(?P<base>.*?)(?P<keyword>_append|_prepend)(_(?P<add>.*))?')
 __expand_var_regexp__ = re.compile(r"\${[^{}]+}")
 __expand_python_regexp__ = re.compile(r"\${@.+?}")
+# Flags DataSmart keeps track of the variables of, see keys_with_flag()
+__indexed_flags__ = ("export", "unexport", "func", "python")
 
 
 class VariableParse:
@@ -109,6 +114,10 @@ class DataSmart(MutableMapping):
         self._special_values = special
         self._seen_overrides = seen
 
+        # The variables each of __indexed_flags__ was set on in self.dict,
+        # and under "_data" the same for the datastore self was copied from
+        self._flag_index = {}
+
         self.expand_cache = {}
 
     def expandWithRefs(self, s, varname):
@@ -299,10 +308,17 @@ class DataSmart(MutableMapping):
         self.expand_cache = {}
         self.dict[var] = {}
 
+    def _index_flag(self, var, flag):
+        if flag in __indexed_flags__:
+            if flag not in self._flag_index:
+                self._flag_index[flag] = set()
+            self._flag_index[flag].add(var)
+
     def setVarFlag(self, var, flag, flagvalue):
         if not var in self.dict:
             self._makeShadowCopy(var)
         self.dict[var][flag] = flagvalue
+        self._index_flag(var, flag)
 
     def getVarFlag(self, var, flag, expand=False):
         local_var = self._findVar(var)
@@ -334,6 +350,7 @@ class DataSmart(MutableMapping):
             if i == "content":
                 continue
             self.dict[var][i] = flags[i]
+            self._index_flag(var, i)
 
     def getVarFlags(self, var):
         local_var = self._findVar(var)
@@ -373,9 +390,106 @@ class DataSmart(MutableMapping):
         # we really want this to be a DataSmart...
         data = DataSmart(seen=self._seen_overrides.copy(), special=self._special_values.copy())
         data.dict["_data"] = self.dict
+        data._flag_index["_data"] = self._flag_index
 
         return data
 
+    def copiedFrom(self):
+        """
+        Return the layer of the datastore self was copied from, or None
+        """
+        return self.dict.get("_data")
+
+    def createRecording(self):
+        """
+        Create a RecordingDataSmart on top of the datastore self was
+        copied from
+        """
+        return RecordingDataSmart(self.dict["_data"], self._flag_index["_data"])
+
+    def applyRecording(self, recording, accumulators = ()):
+        """
+        Make the changes recorded by recording, which must have been created
+        on top of the same datastore as self, to self without evaluating
+        them again. Variables the recording didn't touch keep being looked
+        up in self's own layer first, then in the recording's changes,
+        which are shared rather than copied.
+
+        accumulators names variables holding lists or sets which are only
+        ever extended, such as __inherit_cache. The elements recording
+        added to them are added to self's values.
+
+        Returns False, leaving self unchanged, if self differs from the
+        datastore the recording was made on in a way which would change
+        the outcome.
+        """
+        top = self.dict
+        if not recording.reusable or top.get("_data") is not recording.parent:
+            return False
+
+        for (var, flag), value in recording.reads.iteritems():
+            if var in accumulators:
+                continue
+            local_var = self._findVar(var) or {}
+            if local_var.get(flag, _missing) != value:
+                return False
+
+        merged = {}
+        changes = recording.dict
+        for var in changes:
+            if var == "_data":
+                continue
+            if var not in top:
+                # A variable of the parent which changed since
+                if self._findVar(var) != recording.originals[var]:
+                    return False
+                continue
+            if var in recording.deleted:
+                return False
+            if var in accumulators:
+                final = changes[var].get("content")
+                kind = type(final)
+                original = (recording.originals[var] or {}).get("content") or kind()
+                current = top[var].get("content") or kind()
+                if kind not in (list, set) or type(original) is not kind or type(current) is not kind:
+                    return False
+                if kind is set:
+                    added = final - original
+                    merged[var] = current | added
+                elif final[:len(original)] == original:
+                    added = final[len(original):]
+                    merged[var] = current + added
+                else:
+                    return False
+                if not set(original) <= set(current) or set(added) & set(current):
+                    return False
+
+        for var, flags in recording.written.iteritems():
+            if var not in top or var in merged:
+                continue
+            for flag in flags:
+                if flag in changes[var]:
+                    top[var][flag] = copy.copy(changes[var][flag])
+                    self._index_flag(var, flag)
+                else:
+                    top[var].pop(flag, None)
+        for var, value in merged.iteritems():
+            top[var]["content"] = value
+        top["_data"] = changes
+        self._flag_index["_data"] = recording._flag_index
+
+        for override, vars in recording._seen_overrides.iteritems():
+            if override not in self._seen_overrides:
+                self._seen_overrides[override] = set()
+            self._seen_overrides[override].update(vars)
+        for keyword, vars in recording._special_values.iteritems():
+            if keyword not in self._special_values:
+                self._special_values[keyword] = set()
+            self._special_values[keyword].update(vars)
+
+        self.expand_cache = {}
+        return True
+
     def expandVarref(self, variable, parents=False):
         """Find all references to variable in the data and expand it
            in place, optionally descending to parent datastores."""
@@ -397,22 +511,66 @@ class DataSmart(MutableMapping):
             if key != '_data':
                 yield key
 
+    def _layers(self, stop = None):
+        """Return the dicts of self, top first, down to (excluding) stop"""
+        layers = []
+        dest = self.dict
+        while dest is not stop:
+            layers.append(dest)
+            if "_data" not in dest:
+                if stop is not None:
+                    raise ValueError("Datastore is not a copy of the given one")
+                break
+            dest = dest["_data"]
+        return layers
+
+    def keys_since(self, parent):
+        """
+        Return the set of keys set in self since it was copied (directly
+        or not) from the datastore parent
+        """
+        keys = set()
+        for layer in self._layers(parent.dict):
+            keys.update(layer)
+        keys.discard("_data")
+        return keys
+
+    def keys_with_flag(self, flag):
+        """
+        Return the set of variables with flag set to a true value. For the
+        flags in __indexed_flags__ only the variables the flag was ever set
+        on are looked at rather than all of them.
+        """
+        if flag not in __indexed_flags__:
+            return set(key for key in self if self.getVarFlag(key, flag))
+
+        keys = set()
+        index = self._flag_index
+        while index:
+            keys.update(index.get(flag, ()))
+            index = index.get("_data")
+        return set(key for key in keys if self.getVarFlag(key, flag))
+
     def __iter__(self):
-        seen = set()
-        def _keys(d):
-            if "_data" in d:
-                for key in _keys(d["_data"]):
+        # Walk the layers bottom up so keys come out in the same order as
+        # they would from a recursive walk
+        seen = set(["_data"])
+        for layer in reversed(self._layers()):
+            for key in layer:
+                if key not in seen:
+                    seen.add(key)
                     yield key
 
-            for key in d:
-                if key != "_data":
-                    if not key in seen:
-                        seen.add(key)
-                        yield key
-        return _keys(self.dict)
-
     def __len__(self):
-        return len(frozenset(self))
+        keys = set()
+        for layer in self._layers():
+            keys.update(layer)
+        keys.discard("_data")
+        return len(keys)
+
+    def keys(self):
+        # list(self) would ask __len__ for a size hint, walking the layers twice
+        return list(iter(self))
 
     def __getitem__(self, item):
         value = self.getVar(item, False)
@@ -426,3 +584,118 @@ class DataSmart(MutableMapping):
 
     def __delitem__(self, var):
         self.delVar(var)
+
+class RecordingDataSmart(DataSmart):
+    """
+    A datastore on top of the layer parent of another one, which records
+    the variables and flags looked up before being set, the variables
+    changed and their previous contents, so the changes can be made to
+    other copies of the same datastore by DataSmart.applyRecording().
+
+    Operations whose outcome can't be recorded that way, such as iterating
+    over the variables or copying the datastore, clear reusable.
+    """
+    def __init__(self, parent, parentindex):
+        # Only the overrides and _append/_prepend seen here are recorded
+        DataSmart.__init__(self, special = {}, seen = {})
+        self.dict["_data"] = parent
+        self._flag_index["_data"] = parentindex
+        self.parent = parent
+        self.reusable = True
+        # (var, flag) -> value found before the flag was set here
+        self.reads = {}
+        # var -> flags set or removed here
+        self.written = {}
+        # var -> contents of var before it was first changed here
+        self.originals = {}
+        self.deleted = set()
+
+    def _record(self, var, flag):
+        if (var, flag) in self.reads or var in self.deleted:
+            return
+        if flag in self.written.get(var, ()):
+            return
+        local_var = self._findVar(var) or {}
+        value = local_var.get(flag, _missing)
+        if value is not _missing:
+            value = copy.copy(value)
+        self.reads[(var, flag)] = value
+
+    def _write(self, var, flag):
+        if var not in self.written:
+            self.written[var] = set()
+        self.written[var].add(flag)
+
+    def _makeShadowCopy(self, var):
+        if var not in self.dict:
+            self.originals[var] = copy.copy(self._findVar(var))
+        DataSmart._makeShadowCopy(self, var)
+
+    def getVarFlag(self, var, flag, expand=False):
+        self._record(var, flag)
+        if flag == "content":
+            self._record(var, "defaultval")
+        return DataSmart.getVarFlag(self, var, flag, expand)
+
+    def setVar(self, var, value):
+        DataSmart.setVar(self, var, value)
+        match = __setvar_regexp__.match(var)
+        if not match or match.group("keyword") not in __setvar_keyword__:
+            self._write(var, "content")
+
+    def setVarFlag(self, var, flag, flagvalue):
+        DataSmart.setVarFlag(self, var, flag, flagvalue)
+        self._write(var, flag)
+
+    def delVarFlag(self, var, flag):
+        DataSmart.delVarFlag(self, var, flag)
+        if var in self.dict:
+            self._write(var, flag)
+
+    def setVarFlags(self, var, flags):
+        DataSmart.setVarFlags(self, var, flags)
+        for flag in flags:
+            if flag != "content":
+                self._write(var, flag)
+
+    def delVar(self, var):
+        if var not in self.dict:
+            self.originals[var] = copy.copy(self._findVar(var))
+        DataSmart.delVar(self, var)
+        self.deleted.add(var)
+
+    def getVarFlags(self, var):
+        self.reusable = False
+        return DataSmart.getVarFlags(self, var)
+
+    def delVarFlags(self, var):
+        self.reusable = False
+        return DataSmart.delVarFlags(self, var)
+
+    def renameVar(self, key, newkey):
+        self.reusable = False
+        return DataSmart.renameVar(self, key, newkey)
+
+    def finalize(self):
+        self.reusable = False
+        return DataSmart.finalize(self)
+
+    def createCopy(self):
+        self.reusable = False
+        return DataSmart.createCopy(self)
+
+    def localkeys(self):
+        self.reusable = False
+        return DataSmart.localkeys(self)
+
+    def keys_with_flag(self, flag):
+        self.reusable = False
+        return DataSmart.keys_with_flag(self, flag)
+
+    def __iter__(self):
+        self.reusable = False
+        return DataSmart.__iter__(self)
+
+    def __len__(self):
+        self.reusable = False
+        return DataSmart.__len__(self)
@@ -30,6 +30,8 @@ except ImportError:
     import pickle
 import logging
 import atexit
+import struct
+import threading
 import traceback
 import bb.utils
 
@@ -38,6 +40,19 @@ import bb.utils
 worker_pid = 0
 worker_pipe = None
 
+# Events are sent from the workers to the server as pickles prefixed with
+# their length. LogRecords are held back for up to worker_flush_delay
+# seconds so bursts of them go out in a single write.
+worker_frame = struct.Struct("!I")
+worker_flush_delay = 0.1
+worker_flush_size = 65536
+_worker_buffer = []
+_worker_buffered = 0
+_worker_timer = None
+_worker_lock = threading.Lock()
+# The process the buffer, timer and lock above belong to
+_worker_owner = None
+
 logger = logging.getLogger('BitBake.Event')
 
 class Event(object):
@@ -140,15 +155,58 @@ def fire(event, d):
     else:
         fire_ui_handlers(event, d)
 
+def _worker_check_fork():
+    """
+    A process forked by task code inherits the buffer of its parent and
+    its lock, which the parent's timer thread may be holding, but not the
+    thread. Start afresh in such a process.
+    """
+    global _worker_buffered, _worker_timer, _worker_lock, _worker_owner
+
+    pid = os.getpid()
+    if _worker_owner != pid:
+        _worker_owner = pid
+        _worker_lock = threading.Lock()
+        _worker_timer = None
+        del _worker_buffer[:]
+        _worker_buffered = 0
+
 def worker_fire(event, d):
-    data = "<event>" + pickle.dumps(event) + "</event>"
-    worker_pipe.write(data)
+    global _worker_buffered, _worker_timer
+
+    _worker_check_fork()
+    data = pickle.dumps(event, pickle.HIGHEST_PROTOCOL)
+    with _worker_lock:
+        _worker_buffer.append(worker_frame.pack(len(data)))
+        _worker_buffer.append(data)
+        _worker_buffered += worker_frame.size + len(data)
+        if isinstance(event, logging.LogRecord) and _worker_buffered < worker_flush_size:
+            if _worker_timer is None:
+                _worker_timer = threading.Timer(worker_flush_delay, worker_flush)
+                _worker_timer.daemon = True
+                _worker_timer.start()
+            return
+        _worker_flush()
+
+def worker_flush():
+    """Send any buffered events to the server"""
+    _worker_check_fork()
+    with _worker_lock:
+        _worker_flush()
+
+def _worker_flush():
+    global _worker_buffered, _worker_timer
+
+    if _worker_timer is not None:
+        _worker_timer.cancel()
+        _worker_timer = None
+    if _worker_buffer:
+        worker_pipe.write("".join(_worker_buffer))
+        del _worker_buffer[:]
+        _worker_buffered = 0
 
 def fire_from_worker(event, d):
-    if not event.startswith("<event>") or not event.endswith("</event>"):
-        print("Error, not an event %s" % event)
-        return
-    event = pickle.loads(event[7:-8])
+    event = pickle.loads(event)
     fire_ui_handlers(event, d)
 
 noop = lambda _: None
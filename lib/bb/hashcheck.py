@@ -0,0 +1,218 @@
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+"""
+BitBake 'HashCheck' implementation
+
+Checks which setscene objects are available for a batch of tasks. This
+can be used directly as BB_HASHCHECK_FUNCTION (bb.hashcheck.check_hashes)
+and is used by the runqueue when BB_HASHCHECK_MIRRORS is set but no
+BB_HASHCHECK_FUNCTION is.
+
+The following variables control the checker:
+
+BB_HASHCHECK_MIRRORS     Locations searched in order, either local paths,
+                         file:// or http(s):// urls
+BB_HASHCHECK_OBJECT      Name of the object for a task relative to a
+                         mirror, expanded with BB_HASHCHECK_FN,
+                         BB_HASHCHECK_TASK, BB_HASHCHECK_HASH and
+                         BB_HASHCHECK_HASHFN set for that task
+BB_HASHCHECK_THREADS     Number of concurrent checks (default 8)
+BB_HASHCHECK_CACHE_TTL   Seconds remote results are remembered for
+                         (default 3600 for found objects)
+BB_HASHCHECK_NEGATIVE_TTL  As above for missing objects (default 300)
+"""
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import time
+import socket
+import urllib
+import httplib
+import urlparse
+import logging
+from multiprocessing.pool import ThreadPool
+import bb.data
+import bb.persist_data
+
+logger = logging.getLogger("BitBake.HashCheck")
+
+DEFAULT_OBJECT = "${BB_HASHCHECK_HASHFN}_${BB_HASHCHECK_TASK}_${BB_HASHCHECK_HASH}"
+
+def check_hashes(sq_fn, sq_task, sq_hash, sq_hashfn, d):
+    """
+    BB_HASHCHECK_FUNCTION compatible entry point, returns the indexes of
+    the tasks whose setscene objects are available
+    """
+    return HashChecker(d).check(sq_fn, sq_task, sq_hash, sq_hashfn)
+
+class HashChecker(object):
+    def __init__(self, d):
+        self.d = d
+        self.mirrors = (bb.data.getVar("BB_HASHCHECK_MIRRORS", d, True) or "").split()
+        self.threads = int(bb.data.getVar("BB_HASHCHECK_THREADS", d, True) or 8)
+        self.ttl = int(bb.data.getVar("BB_HASHCHECK_CACHE_TTL", d, True) or 3600)
+        self.negative_ttl = int(bb.data.getVar("BB_HASHCHECK_NEGATIVE_TTL", d, True) or 300)
+        self.cache = None
+
+    def object_names(self, sq_fn, sq_task, sq_hash, sq_hashfn):
+        localdata = bb.data.createCopy(self.d)
+        template = bb.data.getVar("BB_HASHCHECK_OBJECT", localdata, False) or DEFAULT_OBJECT
+        names = []
+        for i in xrange(len(sq_fn)):
+            localdata.setVar("BB_HASHCHECK_FN", sq_fn[i])
+            localdata.setVar("BB_HASHCHECK_TASK", sq_task[i])
+            localdata.setVar("BB_HASHCHECK_HASH", sq_hash[i])
+            localdata.setVar("BB_HASHCHECK_HASHFN", sq_hashfn[i])
+            names.append(bb.data.expand(template, localdata))
+        return names
+
+    def check(self, sq_fn, sq_task, sq_hash, sq_hashfn):
+        names = self.object_names(sq_fn, sq_task, sq_hash, sq_hashfn)
+
+        found = set()
+        pending = range(len(names))
+        pool = ThreadPool(self.threads)
+        try:
+            for mirror in self.mirrors:
+                if not pending:
+                    break
+                scheme = urlparse.urlparse(mirror)[0]
+                if scheme in ("", "file"):
+                    available = self.check_local(pool, mirror, names, pending)
+                elif scheme in ("http", "https"):
+                    available = self.check_http(pool, mirror, names, pending)
+                else:
+                    logger.warn("Unsupported BB_HASHCHECK_MIRRORS entry %s, ignoring", mirror)
+                    continue
+                found |= available
+                pending = [i for i in pending if i not in available]
+        finally:
+            pool.close()
+            pool.join()
+
+        logger.debug(1, "Found %d of %d setscene objects", len(found), len(names))
+        return sorted(found)
+
+    def check_local(self, pool, mirror, names, pending):
+        """
+        Each directory involved is listed once rather than checking every
+        object individually. Local results aren't cached since the
+        directory changes as the build runs.
+        """
+        base = urlparse.urlparse(mirror)[2] if mirror.startswith("file:") else mirror
+
+        bydir = {}
+        for i in pending:
+            path = os.path.join(base, names[i])
+            dirname, name = os.path.split(path)
+            bydir.setdefault(dirname, []).append((i, name))
+
+        def scan(dirname):
+            try:
+                return set(os.listdir(dirname))
+            except OSError:
+                return set()
+
+        dirnames = bydir.keys()
+        available = set()
+        for dirname, entries in zip(dirnames, pool.map(scan, dirnames)):
+            for i, name in bydir[dirname]:
+                if name in entries:
+                    available.add(i)
+        return available
+
+    def check_http(self, pool, mirror, names, pending):
+        """
+        Send HEAD requests, with each thread keeping one connection to the
+        server open for its share of the objects. Definitive answers are
+        cached in the persistent data store.
+        """
+        scheme, netloc, path = urlparse.urlparse(mirror)[:3]
+        path = path.rstrip("/")
+
+        cache = self.get_cache()
+        now = int(time.time())
+        available = set()
+        tocheck = []
+        for i in pending:
+            location = "%s://%s%s/%s" % (scheme, netloc, path, names[i])
+            try:
+                state, stamp = cache[location].split()
+                ttl = self.ttl if state == "1" else self.negative_ttl
+                if now - int(stamp) < ttl:
+                    if state == "1":
+                        available.add(i)
+                    continue
+            except (KeyError, ValueError):
+                pass
+            tocheck.append((i, location, path + "/" + urllib.quote(names[i])))
+
+        if not tocheck:
+            return available
+
+        numchunks = min(self.threads, len(tocheck))
+        chunks = [tocheck[n::numchunks] for n in xrange(numchunks)]
+
+        def head(chunk):
+            return self.http_head(scheme, netloc, chunk)
+
+        with cache:
+            for results in pool.map(head, chunks):
+                for i, location, state in results:
+                    if state is None:
+                        continue
+                    cache[location] = "%d %d" % (state, now)
+                    if state:
+                        available.add(i)
+        return available
+
+    def http_head(self, scheme, netloc, chunk):
+        """
+        Return (index, location, state) for each object where state is
+        True/False if the object does/doesn't exist or None on error
+        """
+        if scheme == "https":
+            conn = httplib.HTTPSConnection(netloc, timeout=30)
+        else:
+            conn = httplib.HTTPConnection(netloc, timeout=30)
+
+        results = []
+        try:
+            for i, location, urlpath in chunk:
+                try:
+                    conn.request("HEAD", urlpath)
+                    response = conn.getresponse()
+                    response.read()
+                except (httplib.HTTPException, socket.error) as exc:
+                    logger.debug(2, "Checking %s failed: %s", location, exc)
+                    conn.close()
+                    results.append((i, location, None))
+                    continue
+                if 200 <= response.status < 300:
+                    results.append((i, location, True))
+                elif response.status in (404, 410):
+                    results.append((i, location, False))
+                else:
+                    results.append((i, location, None))
+                if response.will_close:
+                    conn.close()
+        finally:
+            conn.close()
+        return results
+
+    def get_cache(self):
+        if self.cache is None:
+            self.cache = bb.persist_data.persist("BB_HASHCHECK_CACHE", self.d)
+        return self.cache
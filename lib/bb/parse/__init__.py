@@ -28,11 +28,18 @@ handlers = []
 
 import os
 import stat
+import hashlib
 import logging
+import cStringIO
 import bb
 import bb.utils
 import bb.siggen
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
 logger = logging.getLogger("BitBake.Parsing")
 
 class ParseError(Exception):
@@ -99,6 +106,134 @@ def resolve_file(fn, d):
     logger.debug(2, "LOAD %s", fn)
     return fn
 
+# Parsed statements of configuration files, classes and includes, keyed
+# by (name the file was included as, absolute filename) and serialised
+# with bb.parse.ast.dump_statements() along with the md5sum of the file's
+# contents, so unchanged files aren't parsed again by later runs or by
+# other parsing processes. As with the codeparser cache, bb_statements.dat
+# holds the compacted cache and each process adds the statements it parsed
+# as a shard of its own, which statement_cache_compact() merges back once
+# there are STATEMENTCACHE_MAX_SHARDS of them.
+STATEMENTCACHE_VERSION = 1
+STATEMENTCACHE_MAX_SHARDS = 32
+statementcache = {}
+# Keys of the entries parsed rather than loaded by this process
+statementcache_parsed = set()
+
+def statement_cachefile(d):
+    cachedir = (bb.data.getVar("PERSISTENT_DIR", d, True) or
+                bb.data.getVar("CACHE", d, True))
+    if cachedir in [None, '']:
+        return None
+    bb.utils.mkdirhier(cachedir)
+    return os.path.join(cachedir, "bb_statements.dat")
+
+def _load_statement_cache(filename):
+    try:
+        p = pickle.Unpickler(file(filename, "rb"))
+        data, version = p.load()
+    except Exception:
+        return {}
+    if version != (STATEMENTCACHE_VERSION, bb.__version__):
+        return {}
+    return data
+
+def _write_statement_cache(cachefile, data, shard = False):
+    with bb.utils.replacing(cachefile, shard) as f:
+        pickle.dump([data, (STATEMENTCACHE_VERSION, bb.__version__)], f, -1)
+
+def statement_cache_init(d):
+    """
+    Load the persistent statement cache and the shards not compacted into
+    it yet. Statements already parsed by this process, such as those of
+    the configuration files, are kept.
+    """
+    cachefile = statement_cachefile(d)
+    if not cachefile:
+        return
+
+    logger.debug(1, "Using cache in '%s' for parsed statements", cachefile)
+    data = {}
+    for filename in [cachefile] + bb.utils.shards(cachefile):
+        data.update(_load_statement_cache(filename))
+    for key, entry in data.iteritems():
+        if key not in statementcache:
+            statementcache[key] = entry
+        elif statementcache[key][0] == entry[0]:
+            # Only parsed because the cache wasn't loaded yet
+            statementcache_parsed.discard(key)
+
+def statement_cache_save(d):
+    """
+    Write the statements parsed by this process to a new shard of the
+    persistent cache
+    """
+    if not statementcache_parsed:
+        return
+    cachefile = statement_cachefile(d)
+    if not cachefile:
+        return
+
+    data = dict((key, statementcache[key]) for key in statementcache_parsed)
+    _write_statement_cache(cachefile, data, shard = True)
+    statementcache_parsed.clear()
+
+def statement_cache_compact(d):
+    """
+    Save the statements parsed by this process, merging them and the
+    shards of the persistent cache into bb_statements.dat if there are too
+    many shards. Only meant to be called by the main process.
+    """
+    cachefile = statement_cachefile(d)
+    if not cachefile:
+        return
+    if len(bb.utils.shards(cachefile)) < STATEMENTCACHE_MAX_SHARDS:
+        statement_cache_save(d)
+        return
+
+    lf = bb.utils.lockfile(cachefile + ".lock")
+    try:
+        shards = bb.utils.shards(cachefile)
+        # Only the latest contents of each file are kept
+        data = {}
+        for filename in [cachefile] + shards:
+            data.update(_load_statement_cache(filename))
+        for key in statementcache_parsed:
+            data[key] = statementcache[key]
+        _write_statement_cache(cachefile, data)
+        for shard in shards:
+            try:
+                os.unlink(shard)
+            except OSError:
+                pass
+        bb.utils.remove_stale_temporaries(cachefile)
+    finally:
+        bb.utils.unlockfile(lf)
+    statementcache_parsed.clear()
+
+def cached_statements(fn, abs_fn, parse):
+    """
+    Return the statements of abs_fn, included as fn, from the statement
+    cache if its contents haven't changed. Otherwise parse(fn, f) is
+    called with a file-like object to parse them.
+    """
+    with open(abs_fn, 'r') as f:
+        contents = f.read()
+    digest = hashlib.md5(contents).hexdigest()
+
+    key = (fn, abs_fn)
+    entry = statementcache.get(key)
+    if entry and entry[0] == digest:
+        try:
+            return bb.parse.ast.load_statements(entry[1])
+        except Exception as exc:
+            logger.debug(1, "Ignoring unusable cached statements of %s: %s", abs_fn, exc)
+
+    statements = parse(fn, cStringIO.StringIO(contents))
+    statementcache[key] = (digest, bb.parse.ast.dump_statements(statements))
+    statementcache_parsed.add(key)
+    return statements
+
 # Used by OpenEmbedded metadata
 __pkgsplit_cache__={}
 def vars_from_file(mypkg, d):
@@ -25,6 +25,7 @@ from __future__ import absolute_import
 from future_builtins import filter
 import re
 import string
+import marshal
 import logging
 import bb
 import itertools
@@ -44,6 +45,12 @@ class AstNode(object):
         self.filename = filename
         self.lineno = lineno
 
+    def __getstate__(self):
+        return self.__dict__
+
+    def __setstate__(self, state):
+        self.__dict__ = state
+
 class IncludeNode(AstNode):
     def __init__(self, filename, lineno, what_file, force):
         AstNode.__init__(self, filename, lineno)
@@ -160,7 +167,8 @@ class MethodFlagsNode(AstNode):
     def __init__(self, filename, lineno, key, m):
         AstNode.__init__(self, filename, lineno)
         self.key = key
-        self.m = m
+        self.python = m.group("py") is not None
+        self.fakeroot = m.group("fr") is not None
 
     def eval(self, data):
         if bb.data.getVar(self.key, data):
@@ -168,11 +176,11 @@ class MethodFlagsNode(AstNode):
             # flags could cause problems
             bb.data.setVarFlag(self.key, 'python', None, data)
             bb.data.setVarFlag(self.key, 'fakeroot', None, data)
-        if self.m.group("py") is not None:
+        if self.python:
             bb.data.setVarFlag(self.key, "python", "1", data)
         else:
             bb.data.delVarFlag(self.key, "python", data)
-        if self.m.group("fr") is not None:
+        if self.fakeroot:
             bb.data.setVarFlag(self.key, "fakeroot", "1", data)
         else:
             bb.data.delVarFlag(self.key, "fakeroot", data)
@@ -183,6 +191,17 @@ class ExportFuncsNode(AstNode):
         self.n = fns.split()
         self.classes = classes
 
+    def __getstate__(self):
+        # classes is the parser's stack of the classes being inherited,
+        # which must stay shared with it rather than be copied
+        state = self.__dict__.copy()
+        del state["classes"]
+        return state
+
+    def __setstate__(self, state):
+        AstNode.__setstate__(self, state)
+        self.classes = bb.parse.BBHandler.classes
+
     def eval(self, data):
         for f in self.n:
             allvars = []
@@ -269,6 +288,27 @@ class InheritNode(AstNode):
     def eval(self, data):
         bb.parse.BBHandler.inherit(self.classes, data)
 
+def dump_statements(statements):
+    """
+    Serialise a StatementGroup. The nodes only hold strings, lists and
+    dicts so marshal can be used, which loads several times faster than
+    pickle.
+    """
+    return marshal.dumps([(node.__class__.__name__, node.__getstate__())
+                          for node in statements])
+
+def load_statements(data):
+    """
+    Recreate a StatementGroup serialised by dump_statements
+    """
+    statements = StatementGroup()
+    nodetypes = globals()
+    for name, state in marshal.loads(data):
+        node = object.__new__(nodetypes[name])
+        node.__setstate__(state)
+        statements.append(node)
+    return statements
+
 def handleInclude(statements, filename, lineno, m, force):
     statements.append(IncludeNode(filename, lineno, m.group(1), force))
 
@@ -306,13 +346,12 @@ def handleInherit(statements, filename, lineno, m):
     classes = m.group(1)
     statements.append(InheritNode(filename, lineno, classes.split()))
 
-def finalize(fn, d, variant = None):
+def finalize(fn, d, variant = None, base = None):
     bb.data.expandKeys(d)
     bb.data.update_data(d)
-    code = []
+    # The anonymous functions were defined by bb.methodpool
     for funcname in bb.data.getVar("__BBANONFUNCS", d) or []:
-        code.append("%s(d)" % funcname)
-    bb.utils.simple_exec("\n".join(code), {"d": d})
+        bb.utils._context[funcname](d)
     bb.data.update_data(d)
 
     all_handlers = {}
@@ -324,7 +363,7 @@ def finalize(fn, d, variant = None):
     tasklist = bb.data.getVar('__BBTASKS', d) or []
     bb.build.add_tasks(tasklist, d)
 
-    bb.parse.siggen.finalise(fn, d, variant)
+    bb.parse.siggen.finalise(fn, d, variant, base)
 
     bb.event.fire(bb.event.RecipeParsed(fn), d)
 
@@ -434,11 +473,17 @@ def multi_finalize(fn, d):
         safe_d.setVar("BBCLASSEXTEND", extended)
         _create_variants(datastores, extended.split(), extendfunc)
 
+    # Every variant is a copy of safe_d, which doesn't change any more, so
+    # the variables it contributes to the task signatures are only looked
+    # up once and each variant only adds what it set itself
+    base = None
     for variant, variant_d in datastores.iteritems():
         if variant:
             try:
                 if not onlyfinalise or variant in onlyfinalise:
-                    finalize(fn, variant_d, variant)
+                    if base is None:
+                        base = bb.data.dependency_keys(safe_d)
+                    finalize(fn, variant_d, variant, base)
             except bb.parse.SkipPackage:
                 bb.data.setVar("__SKIPPED", True, variant_d)
 
@@ -47,28 +47,60 @@ __def_regexp__           = re.compile( r"def\s+(\w+).*:" )
 __python_func_regexp__   = re.compile( r"(\s+.*)|(^$)" )
 
 
-__infunc__ = ""
-__inpython__ = False
-__body__   = []
-__classname__ = ""
 classes = [ None, ]
 
 cached_statements = {}
 
-# We need to indicate EOF to the feeder. This code is so messy that
-# factoring it out to a close_parse_file method is out of question.
-# We will use the IN_PYTHON_EOF as an indicator to just close the method
-#
-# The two parts using it are tightly integrated anyway
-IN_PYTHON_EOF = -9999999999999
-
-
+# The changes inheriting a list of classes makes to a recipe, keyed by the
+# list of classes and recorded on top of snapshot_base, the datastore
+# (configuration) the recipes are copied from. Most recipes inherit the
+# same classes without having set anything the classes use, in which case
+# applying the recording replaces evaluating the classes again.
+inherit_snapshots = {}
+snapshot_base = None
+# Variables the classes only ever add elements to
+snapshot_accumulators = ("__inherit_cache", "__depends", "__BBTASKS",
+                         "__BBHANDLERS", "__BBANONFUNCS")
 
 def supports(fn, d):
     """Return True if fn has a supported extension"""
     return os.path.splitext(fn)[-1] in [".bb", ".bbclass", ".inc"]
 
+def set_snapshot_base(d):
+    """
+    Record the class inheritance of recipes on top of the datastore the
+    recipe datastore d was copied from
+    """
+    global snapshot_base
+    base = d.copiedFrom()
+    if base is not snapshot_base:
+        inherit_snapshots.clear()
+        snapshot_base = base
+
 def inherit(files, d):
+    if snapshot_base is not None and len(classes) == 1 and d.copiedFrom() is snapshot_base:
+        files = [data.expand(file, d) for file in files]
+        key = tuple(files)
+        # Only record lists of classes inherited by more than one recipe
+        if key not in inherit_snapshots:
+            inherit_snapshots[key] = None
+        elif inherit_snapshots[key] is None:
+            snapshot = d.createRecording()
+            try:
+                inherit_classes(files, snapshot)
+            except Exception:
+                # The classes may need something the recipe sets, leave
+                # any error to evaluating them in the recipe
+                del classes[1:]
+                snapshot.reusable = False
+            inherit_snapshots[key] = snapshot
+        snapshot = inherit_snapshots[key]
+        if snapshot is not None and d.applyRecording(snapshot, snapshot_accumulators):
+            return
+
+    inherit_classes(files, d)
+
+def inherit_classes(files, d):
     __inherit_cache = data.getVar('__inherit_cache', d) or []
     fn = ""
     lineno = 0
@@ -84,37 +116,36 @@ def inherit(files, d):
             include(fn, file, d, "inherit")
             __inherit_cache = data.getVar('__inherit_cache', d) or []
 
+def parse_statements(filename, file, base_name):
+    statements = ast.StatementGroup()
+    parser = StatementParser(filename, base_name, statements)
+
+    lineno = 0
+    while True:
+        lineno = lineno + 1
+        s = file.readline()
+        if not s: break
+        parser.feed(lineno, s.rstrip())
+    parser.close(lineno)
+
+    return statements
+
 def get_statements(filename, absolute_filename, base_name):
     global cached_statements
 
     try:
         return cached_statements[absolute_filename]
     except KeyError:
-        file = open(absolute_filename, 'r')
-        statements = ast.StatementGroup()
-
-        lineno = 0
-        while True:
-            lineno = lineno + 1
-            s = file.readline()
-            if not s: break
-            s = s.rstrip()
-            feeder(lineno, s, filename, base_name, statements)
-        if __inpython__:
-            # add a blank line to close out any python definition
-            feeder(IN_PYTHON_EOF, "", filename, base_name, statements)
-
         if filename.endswith(".bbclass") or filename.endswith(".inc"):
+            parse = lambda fn, f: parse_statements(fn, f, base_name)
+            statements = bb.parse.cached_statements(filename, absolute_filename, parse)
             cached_statements[absolute_filename] = statements
+        else:
+            statements = parse_statements(filename, open(absolute_filename, 'r'), base_name)
         return statements
 
 def handle(fn, d, include):
-    global __func_start_regexp__, __inherit_regexp__, __export_func_regexp__, __addtask_regexp__, __addhandler_regexp__, __infunc__, __body__, __residue__
-    __body__ = []
-    __infunc__ = ""
     __classname__ = ""
-    __residue__ = []
-
 
     if include == 0:
         logger.debug(2, "BB %s: handle(data)", fn)
@@ -125,6 +156,9 @@ def handle(fn, d, include):
     (root, ext) = os.path.splitext(base_name)
     init(d)
 
+    if include == 0:
+        set_snapshot_base(d)
+
     if ext == ".bbclass":
         __classname__ = root
         classes.append(__classname__)
@@ -133,7 +167,8 @@ def handle(fn, d, include):
             __inherit_cache.append(fn)
             data.setVar('__inherit_cache', __inherit_cache, d)
 
-    if include != 0:
+    # Classes don't set FILE
+    if include != 0 and ext != ".bbclass":
         oldfile = data.getVar('FILE', d)
     else:
         oldfile = None
@@ -167,77 +202,101 @@ def handle(fn, d, include):
 
     return d
 
-def feeder(lineno, s, fn, root, statements):
-    global __func_start_regexp__, __inherit_regexp__, __export_func_regexp__, __addtask_regexp__, __addhandler_regexp__, __def_regexp__, __python_func_regexp__, __inpython__, __infunc__, __body__, classes, bb, __residue__
-    if __infunc__:
-        if s == '}':
-            __body__.append('')
-            ast.handleMethod(statements, fn, lineno, __infunc__, __body__)
-            __infunc__ = ""
-            __body__ = []
-        else:
-            __body__.append(s)
-        return
-
-    if __inpython__:
-        m = __python_func_regexp__.match(s)
-        if m and lineno != IN_PYTHON_EOF:
-            __body__.append(s)
+class StatementParser(ConfHandler.StatementParser):
+    """
+    Turns the lines of a .bb, .bbclass or .inc file into the statements of
+    statements. Lines are fed one by one, with the trailing whitespace
+    removed, and close() must be called at the end of the file.
+    """
+    def __init__(self, fn, root, statements):
+        ConfHandler.StatementParser.__init__(self, fn, statements)
+        self.root = root
+        # Name of the shell or python function whose body is being read
+        self.infunc = ""
+        # Name of the python def whose body is being read
+        self.inpython = False
+        self.body = []
+        # Lines ending with a backslash, joined to the next one
+        self.residue = []
+
+    def feed(self, lineno, s):
+        if self.infunc:
+            if s == '}':
+                self.body.append('')
+                ast.handleMethod(self.statements, self.fn, lineno, self.infunc, self.body)
+                self.infunc = ""
+                self.body = []
+            else:
+                self.body.append(s)
             return
-        else:
-            ast.handlePythonMethod(statements, fn, lineno, __inpython__,
-                                   root, __body__)
-            __body__ = []
-            __inpython__ = False
 
-            if lineno == IN_PYTHON_EOF:
+        if self.inpython:
+            if __python_func_regexp__.match(s):
+                self.body.append(s)
                 return
+            self.close_python(lineno)
+            # fall through
 
-#           fall through
-
-    if s == '' or s[0] == '#': return          # skip comments and empty lines
-
-    if s[-1] == '\\':
-        __residue__.append(s[:-1])
-        return
-
-    s = "".join(__residue__) + s
-    __residue__ = []
-
-    m = __func_start_regexp__.match(s)
-    if m:
-        __infunc__ = m.group("func") or "__anonymous"
-        ast.handleMethodFlags(statements, fn, lineno, __infunc__, m)
-        return
+        if s == '' or s[0] == '#': return          # skip comments and empty lines
 
-    m = __def_regexp__.match(s)
-    if m:
-        __body__.append(s)
-        __inpython__ = m.group(1)
+        if s[-1] == '\\':
+            self.residue.append(s[:-1])
+            return
 
-        return
+        if self.residue:
+            s = "".join(self.residue) + s
+            self.residue = []
 
-    m = __export_func_regexp__.match(s)
-    if m:
-        ast.handleExportFuncs(statements, fn, lineno, m, classes)
-        return
+        if s[-1] == '{':
+            m = __func_start_regexp__.match(s)
+            if m:
+                self.infunc = m.group("func") or "__anonymous"
+                ast.handleMethodFlags(self.statements, self.fn, lineno, self.infunc, m)
+                return
 
-    m = __addtask_regexp__.match(s)
-    if m:
-        ast.handleAddTask(statements, fn, lineno, m)
-        return
+        # The keywords' regexps all need whitespace after the keyword
+        keyword = s.split(None, 1)[0]
+        if keyword == "def":
+            m = __def_regexp__.match(s)
+            if m:
+                self.body.append(s)
+                self.inpython = m.group(1)
+                return
+        elif keyword == "EXPORT_FUNCTIONS":
+            m = __export_func_regexp__.match(s)
+            if m:
+                ast.handleExportFuncs(self.statements, self.fn, lineno, m, classes)
+                return
+        elif keyword == "addtask":
+            m = __addtask_regexp__.match(s)
+            if m:
+                ast.handleAddTask(self.statements, self.fn, lineno, m)
+                return
+        elif keyword == "addhandler":
+            m = __addhandler_regexp__.match(s)
+            if m:
+                ast.handleBBHandlers(self.statements, self.fn, lineno, m)
+                return
+        elif keyword == "inherit":
+            m = __inherit_regexp__.match(s)
+            if m:
+                ast.handleInherit(self.statements, self.fn, lineno, m)
+                return
 
-    m = __addhandler_regexp__.match(s)
-    if m:
-        ast.handleBBHandlers(statements, fn, lineno, m)
-        return
+        ConfHandler.StatementParser.feed(self, lineno, s)
 
-    m = __inherit_regexp__.match(s)
-    if m:
-        ast.handleInherit(statements, fn, lineno, m)
-        return
+    def close_python(self, lineno):
+        ast.handlePythonMethod(self.statements, self.fn, lineno, self.inpython,
+                               self.root, self.body)
+        self.body = []
+        self.inpython = False
 
-    return ConfHandler.feeder(lineno, s, fn, statements)
+    def close(self, lineno):
+        """
+        Finish the python definition the file ends with, if any
+        """
+        if self.inpython:
+            self.close_python(lineno)
 
 # Add us to the handlers list
 from .. import handlers
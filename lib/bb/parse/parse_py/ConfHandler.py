@@ -80,12 +80,22 @@ def handle(fn, data, include):
         oldfile = bb.data.getVar('FILE', data)
 
     abs_fn = resolve_file(fn, data)
-    f = open(abs_fn, 'r')
+    statements = bb.parse.cached_statements(fn, abs_fn, parse_statements)
 
     if include:
         bb.parse.mark_dependency(data, abs_fn)
 
+    # DONE WITH PARSING... time to evaluate
+    bb.data.setVar('FILE', fn, data)
+    statements.eval(data)
+    if oldfile:
+        bb.data.setVar('FILE', oldfile, data)
+
+    return data
+
+def parse_statements(fn, f):
     statements = ast.StatementGroup()
+    parser = StatementParser(fn, statements)
     lineno = 0
     while True:
         lineno = lineno + 1
@@ -99,39 +109,50 @@ def handle(fn, data, include):
             s2 = f.readline()[:-1].strip()
             lineno = lineno + 1
             s = s[:-1] + s2
-        feeder(lineno, s, fn, statements)
+        parser.feed(lineno, s)
+    return statements
 
-    # DONE WITH PARSING... time to evaluate
-    bb.data.setVar('FILE', fn, data)
-    statements.eval(data)
-    if oldfile:
-        bb.data.setVar('FILE', oldfile, data)
+class StatementParser(object):
+    """
+    Turns the lines of a configuration file into the statements of
+    statements. Lines must be non-empty, without comments or
+    continuations.
 
-    return data
+    Apart from assignments, which are tried first, each kind of line
+    starts with a keyword, so only the regexp for the line's first word
+    needs to be tried.
+    """
+    def __init__(self, fn, statements):
+        self.fn = fn
+        self.statements = statements
+
+    def feed(self, lineno, s):
+        m = __config_regexp__.match(s)
+        if m:
+            ast.handleData(self.statements, self.fn, lineno, m.groupdict())
+            return
+
+        keyword = s.split(None, 1)[0]
+        if keyword == "include":
+            m = __include_regexp__.match(s)
+            if m:
+                ast.handleInclude(self.statements, self.fn, lineno, m, False)
+                return
+        elif keyword == "require":
+            m = __require_regexp__.match(s)
+            if m:
+                ast.handleInclude(self.statements, self.fn, lineno, m, True)
+                return
+        elif keyword == "export":
+            m = __export_regexp__.match(s)
+            if m:
+                ast.handleExport(self.statements, self.fn, lineno, m)
+                return
+
+        raise ParseError("%s:%d: unparsed line: '%s'" % (self.fn, lineno, s));
 
 def feeder(lineno, s, fn, statements):
-    m = __config_regexp__.match(s)
-    if m:
-        groupd = m.groupdict()
-        ast.handleData(statements, fn, lineno, groupd)
-        return
-
-    m = __include_regexp__.match(s)
-    if m:
-        ast.handleInclude(statements, fn, lineno, m, False)
-        return
-
-    m = __require_regexp__.match(s)
-    if m:
-        ast.handleInclude(statements, fn, lineno, m, True)
-        return
-
-    m = __export_regexp__.match(s)
-    if m:
-        ast.handleExport(statements, fn, lineno, m)
-        return
-
-    raise ParseError("%s:%d: unparsed line: '%s'" % (fn, lineno, s));
+    StatementParser(fn, statements).feed(lineno, s)
 
 # Add us to the handlers list
 from bb.parse import handlers
@@ -23,6 +23,7 @@
 
 import re
 import logging
+import weakref
 from bb import data, utils
 import bb
 
@@ -47,18 +48,16 @@ def sortPriorities(pn, dataCache, pkg_pn = None):
     priorities = {}
     for f in files:
         priority = dataCache.bbfile_priority[f]
-        preference = dataCache.pkg_dp[f]
         if priority not in priorities:
-            priorities[priority] = {}
-        if preference not in priorities[priority]:
-            priorities[priority][preference] = []
-        priorities[priority][preference].append(f)
+            priorities[priority] = []
+        priorities[priority].append(f)
+
+    # Highest priority first, each group ordered by descending default
+    # preference (the sort is stable so ties keep the order of pkg_pn)
+    preference = dataCache.pkg_dp
     tmp_pn = []
-    for pri in sorted(priorities, lambda a, b: a - b):
-        tmp_pref = []
-        for pref in sorted(priorities[pri], lambda a, b: b - a):
-            tmp_pref.extend(priorities[pri][pref])
-        tmp_pn = [tmp_pref] + tmp_pn
+    for pri in sorted(priorities, reverse=True):
+        tmp_pn.append(sorted(priorities[pri], key=lambda f: -preference[f]))
 
     return tmp_pn
 
@@ -75,6 +74,108 @@ def preferredVersionMatch(pe, pv, pr, preferred_e, preferred_v, preferred_r):
                 return True
     return False
 
+class PreferredVersions(object):
+    """
+    The PREFERRED_VERSION of each PN in a configuration, as (epoch,
+    version, revision) or None, and its PREFERRED_PROVIDER of each item.
+
+    The variable has to be read with pn-<pn> and <pn> added to OVERRIDES,
+    which means finalizing a copy of the datastore. Unless the variable
+    references other variables or has values for those overrides, the
+    extra overrides make no difference, so it is read from a single
+    finalized copy instead.
+    """
+    def __init__(self, cfgData):
+        self.cfgData = cfgData
+        self.versions = {}
+        self.providers = {}
+        self.base = None
+
+    def needs_overrides(self, var, pn):
+        overrides = ("pn-" + pn, pn)
+        if '${' in (self.base.getVar(var, False) or ""):
+            return True
+        for override in overrides:
+            if self.base.getVar("%s_%s" % (var, override), False) is not None:
+                return True
+        for op in ('_append', '_prepend'):
+            for (value, override) in self.base.getVarFlag(var, op) or []:
+                if override in overrides:
+                    return True
+        return False
+
+    def get(self, pn):
+        if pn in self.versions:
+            return self.versions[pn]
+
+        if self.base is None:
+            self.base = data.createCopy(self.cfgData)
+            bb.data.update_data(self.base)
+
+        var = 'PREFERRED_VERSION_%s' % pn
+        if self.needs_overrides(var, pn):
+            localdata = data.createCopy(self.cfgData)
+            bb.data.setVar('OVERRIDES', "pn-%s:%s:%s" % (pn, pn, data.getVar('OVERRIDES', localdata)), localdata)
+            bb.data.update_data(localdata)
+            preferred_v = bb.data.getVar(var, localdata, True)
+        else:
+            preferred_v = bb.data.getVar(var, self.base, False)
+
+        version = None
+        if preferred_v:
+            m = re.match('(\d+:)*(.*)(_.*)*', preferred_v)
+            if m:
+                if m.group(1):
+                    preferred_e = int(m.group(1)[:-1])
+                else:
+                    preferred_e = None
+                preferred_v = m.group(2)
+                if m.group(3):
+                    preferred_r = m.group(3)[1:]
+                else:
+                    preferred_r = None
+            else:
+                preferred_e = None
+                preferred_r = None
+            version = (preferred_e, preferred_v, preferred_r)
+
+        self.versions[pn] = version
+        return version
+
+    def provider(self, item):
+        if item not in self.providers:
+            self.providers[item] = bb.data.getVar('PREFERRED_PROVIDER_%s' % item, self.cfgData, True)
+        return self.providers[item]
+
+# The PreferredVersions of the datastores seen most recently, as (datastore
+# it was copied from or None, weak reference to the datastore,
+# PreferredVersions) tuples. Datastores aren't hashable so they are
+# matched by identity.
+_preferred_versions = []
+
+def preferredVersions(cfgData):
+    """
+    Return the PreferredVersions for cfgData. The cooker finalizes a new
+    copy of its configuration for each build, all of which share the
+    PreferredVersions of the first one until the configuration changes
+    and resetPreferredVersions() is called.
+    """
+    base = cfgData.copiedFrom()
+    for entrybase, ref, versions in _preferred_versions:
+        if ref() is cfgData or (base is not None and entrybase is base):
+            return versions
+
+    versions = PreferredVersions(cfgData)
+    _preferred_versions[:] = [entry for entry in _preferred_versions[-3:] if entry[1]() is not None]
+    _preferred_versions.append((base, weakref.ref(cfgData), versions))
+    return versions
+
+def resetPreferredVersions():
+    """
+    Forget all PreferredVersions, to be called when a configuration changes
+    """
+    del _preferred_versions[:]
+
 def findPreferredProvider(pn, cfgData, dataCache, pkg_pn = None, item = None):
     """
     Find the first provider in pkg_pn with a PREFERRED_VERSION set.
@@ -83,26 +184,9 @@ def findPreferredProvider(pn, cfgData, dataCache, pkg_pn = None, item = None):
     preferred_file = None
     preferred_ver = None
 
-    localdata = data.createCopy(cfgData)
-    bb.data.setVar('OVERRIDES', "pn-%s:%s:%s" % (pn, pn, data.getVar('OVERRIDES', localdata)), localdata)
-    bb.data.update_data(localdata)
-
-    preferred_v = bb.data.getVar('PREFERRED_VERSION_%s' % pn, localdata, True)
-    if preferred_v:
-        m = re.match('(\d+:)*(.*)(_.*)*', preferred_v)
-        if m:
-            if m.group(1):
-                preferred_e = int(m.group(1)[:-1])
-            else:
-                preferred_e = None
-            preferred_v = m.group(2)
-            if m.group(3):
-                preferred_r = m.group(3)[1:]
-            else:
-                preferred_r = None
-        else:
-            preferred_e = None
-            preferred_r = None
+    version = preferredVersions(cfgData).get(pn)
+    if version:
+        preferred_e, preferred_v, preferred_r = version
 
         for file_set in pkg_pn:
             for f in file_set:
@@ -138,14 +222,17 @@ def findLatestProvider(pn, cfgData, dataCache, file_set):
     latest = None
     latest_p = 0
     latest_f = None
+    latest_key = None
     for file_name in file_set:
         pe, pv, pr = dataCache.pkg_pepvpr[file_name]
         dp = dataCache.pkg_dp[file_name]
+        key = utils.version_key((pe, pv, pr))
 
-        if (latest is None) or ((latest_p == dp) and (utils.vercmp(latest, (pe, pv, pr)) < 0)) or (dp > latest_p):
+        if (latest is None) or ((latest_p == dp) and (latest_key < key)) or (dp > latest_p):
             latest = (pe, pv, pr)
             latest_f = file_name
             latest_p = dp
+            latest_key = key
 
     return (latest, latest_f)
 
@@ -236,7 +323,7 @@ def filterProviders(providers, item, cfgData, dataCache):
 
     eligible = _filterProviders(providers, item, cfgData, dataCache)
 
-    prefervar = bb.data.getVar('PREFERRED_PROVIDER_%s' % item, cfgData, 1)
+    prefervar = preferredVersions(cfgData).provider(item)
     if prefervar:
         dataCache.preferred[item] = prefervar
 
@@ -270,11 +357,12 @@ def filterProvidersRunTime(providers, item, cfgData, dataCache):
     pns = {}
     for p in eligible:
         pns[dataCache.pkg_fn[p]] = p
+    versions = preferredVersions(cfgData)
     for p in eligible:
         pn = dataCache.pkg_fn[p]
         provides = dataCache.pn_provides[pn]
         for provide in provides:
-            prefervar = bb.data.getVar('PREFERRED_PROVIDER_%s' % provide, cfgData, 1)
+            prefervar = versions.provider(provide)
             logger.verbose("checking PREFERRED_PROVIDER_%s (value %s) against %s", provide, prefervar, pns.keys())
             if prefervar in pns and pns[prefervar] not in preferred:
                 var = "PREFERRED_PROVIDER_%s = %s" % (provide, prefervar)
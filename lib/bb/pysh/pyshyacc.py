@@ -645,7 +645,9 @@ def p_error(p):
         w('  %r\n' % n)
     raise sherrors.ShellSyntaxError(''.join(msg))
 
-# Build the parser
+# Build the parser from the tables in pyshtables.py. They are passed as a
+# module since ply can't import them by name. Delete the file to regenerate
+# it after changing the grammar, stale tables are rebuilt at every import.
 try:
     import pyshtables
 except ImportError:
@@ -654,7 +656,7 @@ except ImportError:
         outputdir = ''
     yacc.yacc(tabmodule = 'pyshtables', outputdir = outputdir, debug = 0)
 else:
-    yacc.yacc(tabmodule = 'pysh.pyshtables', write_tables = 0, debug = 0)
+    yacc.yacc(tabmodule = pyshtables, write_tables = 0, debug = 0)
 
 
 def parse(input, eof=False, debug=False):
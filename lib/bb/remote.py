@@ -0,0 +1,429 @@
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+"""
+BitBake 'Remote' implementation
+
+Runs runqueue tasks on other build hosts. Each host runs
+bitbake-worker-agent with the same metadata and the same shared TMPDIR
+and DL_DIR as the server. Setting
+
+    BB_REMOTE_WORKERS = "host[:port[:slots]] ..."
+
+in the server's configuration makes the runqueue dispatch tasks to the
+agents as well as running BB_NUMBER_THREADS tasks locally.
+
+Each task uses its own TCP connection. The agent greets the server with
+a random nonce, the server sends one length prefixed pickle describing
+the task, the agent streams back the task's events using the same
+framing as local workers (bb.event.worker_frame) followed by a TaskExit.
+Closing the connection kills the task.
+
+Unpickling data runs arbitrary code, so both ends must trust each other.
+If BB_REMOTE_SECRET_FILE names a file on the server (and, by default, on
+the agents), its contents are a secret shared by the server and the
+agents: each frame then starts with an HMAC-SHA256 of the rest of it,
+bound to the connection's nonce, direction and the frame's position, and
+frames failing the check are rejected before being unpickled. Without a
+secret, agents only listen on and the server only connects to the
+loopback interface, as through SSH tunnels, and any local user of either
+host can run tasks as the agent's user.
+"""
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import sys
+import time
+import errno
+import signal
+import select
+import socket
+import logging
+import hmac
+import hashlib
+import SocketServer
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import bb
+import bb.event
+import bb.taskstats
+
+logger = logging.getLogger("BitBake.Remote")
+
+DEFAULT_PORT = 8300
+GREETING = "BBAGENT1"
+NONCE_SIZE = 16
+MAC_SIZE = hashlib.sha256().digest_size
+
+try:
+    from hmac import compare_digest
+except ImportError:
+    # hmac.compare_digest() needs python 2.7.7
+    def compare_digest(a, b):
+        """
+        Compare two strings in a time not depending on where they differ
+        """
+        if len(a) != len(b):
+            return False
+        result = 0
+        for x, y in zip(a, b):
+            result |= ord(x) ^ ord(y)
+        return result == 0
+
+class AuthenticationError(Exception):
+    """
+    The other end of a connection couldn't be authenticated
+    """
+
+class TaskExit(object):
+    """
+    Final message sent by an agent once a task has exited
+    """
+    def __init__(self, status, resources):
+        self.status = status
+        self.resources = resources
+
+def read_secret(filename):
+    """
+    Return the shared secret stored in filename, or None if filename is
+    empty
+    """
+    if not filename:
+        return None
+    with open(filename) as f:
+        secret = f.read().strip()
+    if not secret:
+        raise AuthenticationError("Secret file %s is empty" % filename)
+    return secret
+
+def is_loopback(address):
+    return address.startswith("127.") or address in ("::1", "::ffff:127.0.0.1")
+
+class Session(object):
+    """
+    Signs the frames sent over a connection and checks the frames received
+    from it, see the module documentation. sender is "server" or "agent".
+    """
+    def __init__(self, secret, nonce, sender):
+        self.secret = secret
+        self.nonce = nonce
+        self.sender = sender
+        self.receiver = {"server" : "agent", "agent" : "server"}[sender]
+        self.sent = 0
+        self.received = 0
+
+    def mac(self, direction, position, data):
+        header = "%s%s:%d:" % (self.nonce, direction, position)
+        return hmac.new(self.secret, header + data, hashlib.sha256).digest()
+
+    def seal(self, data):
+        """
+        Frame the pickle data for sending
+        """
+        if self.secret:
+            data = self.mac(self.sender, self.sent, data) + data
+        self.sent = self.sent + 1
+        return bb.event.worker_frame.pack(len(data)) + data
+
+    def encode(self, obj):
+        return self.seal(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+
+    def decode(self, frame):
+        """
+        Check and unpickle the contents of a received frame
+        """
+        if self.secret:
+            mac, frame = frame[:MAC_SIZE], frame[MAC_SIZE:]
+            if not compare_digest(mac, self.mac(self.receiver, self.received, frame)):
+                raise AuthenticationError("Invalid message signature")
+        self.received = self.received + 1
+        return pickle.loads(frame)
+
+def recv_exactly(sock, size):
+    data = ""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError("Connection closed")
+        data = data + chunk
+    return data
+
+def recv_frame(sock, session):
+    length = bb.event.worker_frame.unpack(recv_exactly(sock, bb.event.worker_frame.size))[0]
+    return session.decode(recv_exactly(sock, length))
+
+def agent_session(sock, secret):
+    """
+    Greet a server which connected to sock and return the Session
+    """
+    nonce = os.urandom(NONCE_SIZE)
+    sock.sendall(GREETING + ("H" if secret else "P") + nonce)
+    return Session(secret, nonce, "agent")
+
+def server_session(sock, secret):
+    """
+    Check the greeting of the agent sock is connected to and return the
+    Session
+    """
+    greeting = recv_exactly(sock, len(GREETING) + 1 + NONCE_SIZE)
+    if not greeting.startswith(GREETING):
+        raise AuthenticationError("Not a bitbake-worker-agent")
+    mode = greeting[len(GREETING)]
+    if mode == "H" and not secret:
+        raise AuthenticationError("The agent requires BB_REMOTE_SECRET_FILE")
+    if mode != "H" and secret:
+        raise AuthenticationError("The agent doesn't use a secret")
+    if not secret and not is_loopback(sock.getpeername()[0]):
+        raise AuthenticationError("Agents not on the loopback interface require BB_REMOTE_SECRET_FILE")
+    return Session(secret, greeting[len(GREETING) + 1:], "server")
+
+class RemoteWorker(object):
+    """
+    A build host running bitbake-worker-agent, as seen by the server
+    """
+    def __init__(self, host, port = DEFAULT_PORT, slots = 1, secret = None):
+        self.host = host
+        self.port = port
+        self.slots = slots
+        self.secret = secret
+        self.active = 0
+
+    def __str__(self):
+        return "%s:%s" % (self.host, self.port)
+
+    def connect(self, request):
+        """
+        Send request to the agent, returning the connection and its
+        Session
+        """
+        sock = socket.create_connection((self.host, self.port), 30)
+        try:
+            session = server_session(sock, self.secret)
+            sock.sendall(session.encode(request))
+        except:
+            sock.close()
+            raise
+        sock.setblocking(0)
+        return sock, session
+
+class RemoteDispatcher(object):
+    """
+    Decides where tasks run. The local machine is represented by None.
+    """
+    def __init__(self, workers, localslots):
+        self.workers = workers
+        self.localslots = localslots
+        self.localactive = 0
+        self.running = {}
+        self.location = {}
+
+    @classmethod
+    def from_metadata(cls, d, localslots):
+        secret = read_secret(bb.data.getVar("BB_REMOTE_SECRET_FILE", d, True))
+        workers = []
+        for entry in (bb.data.getVar("BB_REMOTE_WORKERS", d, True) or "").split():
+            fields = entry.split(":")
+            host = fields[0]
+            port = DEFAULT_PORT
+            slots = 1
+            if len(fields) > 1 and fields[1]:
+                port = int(fields[1])
+            if len(fields) > 2 and fields[2]:
+                slots = int(fields[2])
+            workers.append(RemoteWorker(host, port, slots, secret))
+        if not workers:
+            return None
+        return cls(workers, localslots)
+
+    def slots(self):
+        return sum(worker.slots for worker in self.workers)
+
+    def choose(self, deps):
+        """
+        Pick the host with a free slot which ran the most of the task's
+        dependencies, so their output is most likely already local to it,
+        then the least loaded one. Returns None for the local machine and
+        False if every host is busy.
+        """
+        candidates = []
+        if self.localactive < self.localslots:
+            candidates.append((None, self.localactive, self.localslots))
+        for worker in self.workers:
+            if worker.active < worker.slots:
+                candidates.append((worker, worker.active, worker.slots))
+        if not candidates:
+            return False
+
+        def score(candidate):
+            host, active, slots = candidate
+            local = len([dep for dep in deps if self.location.get(dep, None) is host])
+            return (local, -float(active) / slots)
+
+        return max(candidates, key=score)[0]
+
+    def started(self, key, task, worker):
+        """
+        Record that runqueue task task is running as key on worker
+        """
+        self.running[key] = worker
+        self.location[task] = worker
+        if worker is None:
+            self.localactive = self.localactive + 1
+        else:
+            worker.active = worker.active + 1
+
+    def finished(self, key):
+        worker = self.running.pop(key)
+        if worker is None:
+            self.localactive = self.localactive - 1
+        else:
+            worker.active = worker.active - 1
+
+    def remove(self, worker):
+        """
+        Stop using a worker which couldn't be reached
+        """
+        if worker in self.workers:
+            self.workers.remove(worker)
+
+class WorkerAgent(SocketServer.ForkingMixIn, SocketServer.TCPServer):
+    """
+    Agent accepting tasks from a bitbake server. cooker must have parsed
+    the same configuration as the server's. Without a secret, only the
+    loopback interface can be listened on.
+    """
+    allow_reuse_address = True
+
+    def __init__(self, address, cooker, secret):
+        if not secret and not is_loopback(address[0]):
+            raise AuthenticationError("Listening on %s requires a secret" % (address[0] or "all interfaces"))
+        SocketServer.TCPServer.__init__(self, address, AgentRequestHandler)
+        self.cooker = cooker
+        self.secret = secret
+
+class AgentRequestHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        try:
+            session = agent_session(self.request, self.server.secret)
+            request = recv_frame(self.request, session)
+        except (EOFError, socket.error, AuthenticationError) as exc:
+            logger.error("Invalid request from %s: %s", self.client_address[0], exc)
+            return
+        logger.info("Running %s:%s for %s", request["fn"], request["taskname"], self.client_address[0])
+        run_task(self.server.cooker, request, self.request, session)
+
+def run_task(cooker, request, sock, session):
+    """
+    Execute a task described by a server request, sending its events
+    and finally a TaskExit over sock. The task writes its events to a
+    pipe and this process signs and forwards them.
+    """
+    fn = request["fn"]
+    taskname = request["taskname"]
+
+    # We need to setup the environment BEFORE the fork, since
+    # a fork() or exec*() activates PSEUDO...
+    for key, value in request["env"].iteritems():
+        os.environ[key] = value
+    for p in request["fakedirs"]:
+        bb.utils.mkdirhier(p)
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pipein, pipeout = os.pipe()
+    starttime = time.time()
+    pid = os.fork()
+    if pid == 0:
+        os.close(pipein)
+        sock.close()
+        bb.event.worker_pid = os.getpid()
+        bb.event.worker_pipe = os.fdopen(pipeout, "wb", 0)
+
+        os.setpgid(0, 0)
+        newsi = os.open(os.devnull, os.O_RDWR)
+        os.dup2(newsi, sys.stdin.fileno())
+
+        data = cooker.configuration.data
+        bb.parse.siggen.set_taskdata(request["hashes"], request["hash_deps"])
+        try:
+            the_data = bb.cache.Cache.loadDataFull(fn, request["appends"], data)
+            the_data.setVar('BB_TASKHASH', request["taskhash"])
+            os.environ.update(bb.data.exported_vars(the_data))
+        except Exception as exc:
+            if not request["quieterrors"]:
+                logger.critical(str(exc))
+            bb.event.worker_flush()
+            os._exit(1)
+        try:
+            ret = bb.build.exec_task(fn, taskname, the_data)
+            bb.event.worker_flush()
+            os._exit(ret)
+        except:
+            try:
+                bb.event.worker_flush()
+            finally:
+                os._exit(1)
+
+    os.close(pipeout)
+    queue = ""
+
+    def forward():
+        # Send the complete frames read from the task, False once the
+        # task and anything it started closed the pipe
+        data = os.read(pipein, 102400)
+        frames = queue + data
+        frame = bb.event.worker_frame
+        while len(frames) >= frame.size:
+            length = frame.unpack_from(frames)[0]
+            if len(frames) - frame.size < length:
+                break
+            sock.sendall(session.seal(frames[frame.size:frame.size + length]))
+            frames = frames[frame.size + length:]
+        return frames, bool(data)
+
+    # Wait for the task, killing it if the server goes away
+    try:
+        while True:
+            try:
+                result = os.wait4(pid, os.WNOHANG)
+            except OSError as exc:
+                if exc.errno == errno.EINTR:
+                    continue
+                raise
+            if result[0] != 0:
+                break
+            ready = select.select([sock, pipein], [], [], 0.5)[0]
+            if pipein in ready:
+                queue, _ = forward()
+            if sock in ready and not sock.recv(1):
+                logger.warn("Server disconnected, killing %s:%s", fn, taskname)
+                try:
+                    os.kill(-pid, signal.SIGTERM)
+                except OSError:
+                    pass
+                os.waitpid(pid, 0)
+                return
+
+        # Send what the task wrote before exiting, without waiting for any
+        # process it left behind
+        while select.select([pipein], [], [], 0)[0]:
+            queue, more = forward()
+            if not more:
+                break
+    finally:
+        os.close(pipein)
+
+    sock.sendall(session.encode(TaskExit(result[1], bb.taskstats.resources(starttime, result[2]))))
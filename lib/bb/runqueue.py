@@ -22,14 +22,22 @@ Handles preparation and execution of a queue of tasks
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-import copy
 import os
+import array
+import heapq
 import sys
+import time
 import signal
+import socket
+import errno
 import stat
 import fcntl
 import logging
 import bb
+import bb.hashcheck
+import bb.remote
+import bb.simulate
+import bb.taskstats
 from bb import msg, data, event
 
 bblogger = logging.getLogger("BitBake")
@@ -129,15 +137,9 @@ class RunQueueSchedulerSpeed(RunQueueScheduler):
         self.rq = runqueue
         self.rqdata = rqdata
 
-        sortweight = sorted(copy.deepcopy(self.rqdata.runq_weight))
-        copyweight = copy.deepcopy(self.rqdata.runq_weight)
-        self.prio_map = []
-
-        for weight in sortweight:
-            idx = copyweight.index(weight)
-            self.prio_map.append(idx)
-            copyweight[idx] = -1
-
+        weight = self.rqdata.runq_weight
+        # Ties are ordered by task number before being reversed
+        self.prio_map = sorted(xrange(len(weight)), key=weight.__getitem__)
         self.prio_map.reverse()
 
 class RunQueueSchedulerCompletion(RunQueueSchedulerSpeed):
@@ -156,21 +158,302 @@ class RunQueueSchedulerCompletion(RunQueueSchedulerSpeed):
         #FIXME - whilst this groups all fnids together it does not reorder the
         #fnid groups optimally.
 
-        basemap = copy.deepcopy(self.prio_map)
-        self.prio_map = []
-        while (len(basemap) > 0):
-            entry = basemap.pop(0)
-            self.prio_map.append(entry)
+        fnid_order = []
+        fnid_tasks = {}
+        for entry in self.prio_map:
             fnid = self.rqdata.runq_fnid[entry]
-            todel = []
-            for entry in basemap:
-                entry_fnid = self.rqdata.runq_fnid[entry]
-                if entry_fnid == fnid:
-                    todel.append(basemap.index(entry))
-                    self.prio_map.append(entry)
-            todel.reverse()
-            for idx in todel:
-                del basemap[idx]
+            if fnid not in fnid_tasks:
+                fnid_order.append(fnid)
+                fnid_tasks[fnid] = []
+            fnid_tasks[fnid].append(entry)
+
+        self.prio_map = []
+        for fnid in fnid_order:
+            self.prio_map.extend(fnid_tasks[fnid])
+
+def get_schedulers(d):
+    """
+    Return the available scheduler classes, the builtin ones and those
+    listed in BB_SCHEDULERS
+    """
+    schedulers = set(obj for obj in globals().values()
+                         if type(obj) is type and
+                            issubclass(obj, RunQueueScheduler))
+
+    user_schedulers = bb.data.getVar("BB_SCHEDULERS", d, True)
+    if user_schedulers:
+        for sched in user_schedulers.split():
+            if not "." in sched:
+                bb.note("Ignoring scheduler '%s' from BB_SCHEDULERS: not an import" % sched)
+                continue
+
+            modname, name = sched.rsplit(".", 1)
+            try:
+                module = __import__(modname, fromlist=(name,))
+            except ImportError, exc:
+                logger.critical("Unable to import scheduler '%s' from '%s': %s" % (name, modname, exc))
+                raise SystemExit(1)
+            else:
+                schedulers.add(getattr(module, name))
+    return schedulers
+
+class RunQueueStampIndex:
+    """
+    In-memory index of stamp file modification times
+
+    Each stamp directory is listed once, the first time a stamp in it is
+    queried, and the modification time of each stamp is recorded the first
+    time it is needed. Stamps written by the runqueue are recorded with
+    update() so the index stays current without rescanning.
+    """
+    def __init__(self, rqdata):
+        self.rqdata = rqdata
+        self.clear()
+
+    def clear(self):
+        self.stampfiles = {}
+        self.dirs = {}
+
+    def stampfile(self, task, taskname = None):
+        """
+        Return the (cached) stamp filename for a task
+        """
+        if taskname is None:
+            taskname = self.rqdata.runq_task[task]
+        key = (task, taskname)
+        if key not in self.stampfiles:
+            fn = self.rqdata.taskData.fn_index[self.rqdata.runq_fnid[task]]
+            self.stampfiles[key] = bb.build.stampfile(taskname, self.rqdata.dataCache, fn)
+        return self.stampfiles[key]
+
+    def scandir(self, dirname):
+        """
+        Return the name -> mtime table for a stamp directory, listing it
+        if it hasn't been seen before. Modification times are filled in
+        lazily by mtime().
+        """
+        entries = self.dirs.get(dirname)
+        if entries is None:
+            entries = {}
+            try:
+                for name in os.listdir(dirname):
+                    entries[name] = None
+            except OSError:
+                pass
+            self.dirs[dirname] = entries
+        return entries
+
+    def mtime(self, stampfile):
+        """
+        Return the modification time of a stamp or None if it doesn't exist
+        """
+        if not stampfile:
+            return None
+        dirname, name = os.path.split(stampfile)
+        entries = self.scandir(dirname)
+        if name not in entries:
+            return None
+        t = entries[name]
+        if t is None:
+            try:
+                t = os.stat(stampfile)[stat.ST_MTIME]
+            except OSError:
+                del entries[name]
+                return None
+            entries[name] = t
+        return t
+
+    def update(self, stampfile):
+        """
+        Record the current state of a stamp which has just been written
+        (or removed)
+        """
+        if not stampfile:
+            return
+        dirname, name = os.path.split(stampfile)
+        entries = self.scandir(dirname)
+        try:
+            entries[name] = os.stat(stampfile)[stat.ST_MTIME]
+        except OSError:
+            entries.pop(name, None)
+
+    def update_task(self, task, taskname = None):
+        self.update(self.stampfile(task, taskname))
+
+    def make_stamp(self, task, taskname = None):
+        """
+        Write the stamp for a task and record it in the index
+        """
+        if taskname is None:
+            taskname = self.rqdata.runq_task[task]
+        fn = self.rqdata.taskData.fn_index[self.rqdata.runq_fnid[task]]
+        bb.build.make_stamp(taskname, self.rqdata.dataCache, fn)
+        self.update_task(task, taskname)
+
+class RunQueueGraph:
+    """
+    Compact, read-only copy of the runqueue task graph
+
+    The dependencies and reverse dependencies of each task are stored in
+    compressed sparse row form: the entries for task n are
+    deps[dep_index[n]:dep_index[n+1]] (and likewise for revdeps). The
+    topological order of the tasks (dependencies first) is computed once
+    here; tasks which are part of, or depend upon, a dependency loop are
+    left out of it.
+    """
+    def __init__(self, depends):
+        self.numtasks = len(depends)
+        self.dep_index, self.deps = self.compress(depends)
+
+        revdeps = [[] for task in xrange(self.numtasks)]
+        for task in xrange(self.numtasks):
+            for dep in self.depends(task):
+                revdeps[dep].append(task)
+        self.revdep_index, self.revdeps = self.compress(revdeps)
+
+        self.order = self.topological_order()
+        self._loops = None
+
+    @staticmethod
+    def compress(adjacency):
+        index = array.array('l', [0] * (len(adjacency) + 1))
+        entries = array.array('l')
+        for task in xrange(len(adjacency)):
+            entries.extend(sorted(adjacency[task]))
+            index[task + 1] = len(entries)
+        return index, entries
+
+    def depends(self, task):
+        return self.deps[self.dep_index[task]:self.dep_index[task + 1]]
+
+    def revdepends(self, task):
+        return self.revdeps[self.revdep_index[task]:self.revdep_index[task + 1]]
+
+    def numdepends(self, task):
+        return self.dep_index[task + 1] - self.dep_index[task]
+
+    def numrevdepends(self, task):
+        return self.revdep_index[task + 1] - self.revdep_index[task]
+
+    def topological_order(self):
+        """
+        Return an array of task ids ordered so each task comes after all
+        of its dependencies (Kahn's algorithm)
+        """
+        dep_index = self.dep_index
+        revdep_index = self.revdep_index
+        revdeps = self.revdeps
+
+        deps_left = array.array('l', [0] * self.numtasks)
+        order = array.array('l')
+        for task in xrange(self.numtasks):
+            deps_left[task] = dep_index[task + 1] - dep_index[task]
+            if deps_left[task] == 0:
+                order.append(task)
+
+        # order grows as we walk it
+        pos = 0
+        while pos < len(order):
+            task = order[pos]
+            pos = pos + 1
+            for i in xrange(revdep_index[task], revdep_index[task + 1]):
+                revdep = revdeps[i]
+                deps_left[revdep] = deps_left[revdep] - 1
+                if deps_left[revdep] == 0:
+                    order.append(revdep)
+        return order
+
+    def loops(self):
+        """
+        Return the strongly connected components of the graph which have
+        more than one member or whose member depends on itself, i.e. the
+        sets of tasks involved in dependency loops, each as a sorted list. This is an iterative version of
+        Tarjan's algorithm so it runs in linear time and deep graphs don't
+        hit the recursion limit.
+        """
+        if self._loops is not None:
+            return self._loops
+
+        dep_index = self.dep_index
+        deps = self.deps
+
+        indices = array.array('l', [-1] * self.numtasks)
+        lowlink = array.array('l', [0] * self.numtasks)
+        onstack = bytearray(self.numtasks)
+        stack = []
+        components = []
+        counter = 0
+
+        for root in xrange(self.numtasks):
+            if indices[root] != -1:
+                continue
+            indices[root] = lowlink[root] = counter
+            counter = counter + 1
+            stack.append(root)
+            onstack[root] = 1
+            work = [[root, dep_index[root]]]
+            while work:
+                entry = work[-1]
+                task, pos = entry
+                if pos < dep_index[task + 1]:
+                    entry[1] = pos + 1
+                    dep = deps[pos]
+                    if indices[dep] == -1:
+                        indices[dep] = lowlink[dep] = counter
+                        counter = counter + 1
+                        stack.append(dep)
+                        onstack[dep] = 1
+                        work.append([dep, dep_index[dep]])
+                    elif onstack[dep] and indices[dep] < lowlink[task]:
+                        lowlink[task] = indices[dep]
+                    continue
+
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    if lowlink[task] < lowlink[parent]:
+                        lowlink[parent] = lowlink[task]
+                if lowlink[task] == indices[task]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        onstack[member] = 0
+                        component.append(member)
+                        if member == task:
+                            break
+                    # A task depending on itself is a loop of its own
+                    if len(component) > 1 or \
+                       task in deps[dep_index[task]:dep_index[task + 1]]:
+                        components.append(sorted(component))
+
+        components.sort()
+        self._loops = components
+        return components
+
+    def shortest_loop(self, component):
+        """
+        Return the shortest dependency chain through the lowest numbered
+        task of a loop component, following reverse dependencies.
+        """
+        members = set(component)
+        start = component[0]
+        parent = { start : None }
+        queue = [start]
+        for task in queue:
+            for revdep in self.revdepends(task):
+                if revdep not in members:
+                    continue
+                if revdep == start:
+                    chain = []
+                    while task is not None:
+                        chain.append(task)
+                        task = parent[task]
+                    chain.reverse()
+                    return chain
+                if revdep not in parent:
+                    parent[revdep] = task
+                    queue.append(revdep)
+        return component
 
 class RunQueueData:
     """
@@ -194,6 +477,9 @@ class RunQueueData:
         self.runq_depends = []
         self.runq_revdeps = []
         self.runq_hash = []
+        self.graph = None
+        # Number of tasks once prepare() has completed
+        self.prepared = None
 
     def runq_depends_names(self, ids):
         import re
@@ -220,85 +506,24 @@ class RunQueueData:
         Some tasks aren't buildable, likely due to circular dependency issues.
         Identify the circular dependencies and print them in a user readable format.
         """
-        from copy import deepcopy
-
-        valid_chains = []
-        explored_deps = {}
         msgs = []
+        tasks = set(tasks)
 
-        def chain_reorder(chain):
-            """
-            Reorder a dependency chain so the lowest task id is first
-            """
-            lowest = 0
-            new_chain = []
-            for entry in xrange(len(chain)):
-                if chain[entry] < chain[lowest]:
-                    lowest = entry
-            new_chain.extend(chain[lowest:])
-            new_chain.extend(chain[:lowest])
-            return new_chain
-
-        def chain_compare_equal(chain1, chain2):
-            """
-            Compare two dependency chains and see if they're the same
-            """
-            if len(chain1) != len(chain2):
-                return False
-            for index in xrange(len(chain1)):
-                if chain1[index] != chain2[index]:
-                    return False
-            return True
-
-        def chain_array_contains(chain, chain_array):
-            """
-            Return True if chain_array contains chain
-            """
-            for ch in chain_array:
-                if chain_compare_equal(ch, chain):
-                    return True
-            return False
-
-        def find_chains(taskid, prev_chain):
-            prev_chain.append(taskid)
-            total_deps = []
-            total_deps.extend(self.runq_revdeps[taskid])
-            for revdep in self.runq_revdeps[taskid]:
-                if revdep in prev_chain:
-                    idx = prev_chain.index(revdep)
-                    # To prevent duplicates, reorder the chain to start with the lowest taskid
-                    # and search through an array of those we've already printed
-                    chain = prev_chain[idx:]
-                    new_chain = chain_reorder(chain)
-                    if not chain_array_contains(new_chain, valid_chains):
-                        valid_chains.append(new_chain)
-                        msgs.append("Dependency loop #%d found:\n" % len(valid_chains))
-                        for dep in new_chain:
-                            msgs.append("  Task %s (%s) (dependent Tasks %s)\n" % (dep, self.get_user_idstring(dep), self.runq_depends_names(dep)))
-                        msgs.append("\n")
-                    if len(valid_chains) > 10:
-                        msgs.append("Aborted dependency loops search after 10 matches.\n")
-                        return msgs
-                    continue
-                scan = False
-                if revdep not in explored_deps:
-                    scan = True
-                elif revdep in explored_deps[revdep]:
-                    scan = True
-                else:
-                    for dep in prev_chain:
-                        if dep in explored_deps[revdep]:
-                            scan = True
-                if scan:
-                    find_chains(revdep, copy.deepcopy(prev_chain))
-                for dep in explored_deps[revdep]:
-                    if dep not in total_deps:
-                        total_deps.append(dep)
-
-            explored_deps[taskid] = total_deps
-
-        for task in tasks:
-            find_chains(task, [])
+        count = 0
+        for component in self.graph.loops():
+            if tasks.isdisjoint(component):
+                continue
+            count = count + 1
+            if count > 10:
+                msgs.append("Aborted dependency loops search after 10 matches.\n")
+                break
+            chain = self.graph.shortest_loop(component)
+            msgs.append("Dependency loop #%d found:\n" % count)
+            for dep in chain:
+                msgs.append("  Task %s (%s) (dependent Tasks %s)\n" % (dep, self.get_user_idstring(dep), self.runq_depends_names(dep)))
+            if len(component) > len(chain):
+                msgs.append("  (%d tasks in total are part of this loop)\n" % len(component))
+            msgs.append("\n")
 
         return msgs
 
@@ -312,44 +537,36 @@ class RunQueueData:
         """
 
         numTasks = len(self.runq_fnid)
-        weight = []
-        deps_left = []
-        task_done = []
-
-        for listid in xrange(numTasks):
-            task_done.append(False)
-            weight.append(0)
-            deps_left.append(len(self.runq_revdeps[listid]))
+        graph = self.graph
+        dep_index = graph.dep_index
+        deps = graph.deps
 
+        weight = [0] * numTasks
         for listid in endpoints:
             weight[listid] = 1
-            task_done[listid] = True
 
-        while True:
-            next_points = []
-            for listid in endpoints:
-                for revdep in self.runq_depends[listid]:
-                    weight[revdep] = weight[revdep] + weight[listid]
-                    deps_left[revdep] = deps_left[revdep] - 1
-                    if deps_left[revdep] == 0:
-                        next_points.append(revdep)
-                        task_done[revdep] = True
-            endpoints = next_points
-            if len(next_points) == 0:
-                break
+        # Walk the graph from the end of the dependency chains back towards
+        # the tasks without dependencies; a task's weight is final once all
+        # its reverse dependencies have been visited.
+        task_done = [False] * numTasks
+        for listid in reversed(graph.order):
+            task_done[listid] = True
+            taskweight = weight[listid]
+            for i in xrange(dep_index[listid], dep_index[listid + 1]):
+                dep = deps[i]
+                weight[dep] = weight[dep] + taskweight
 
         # Circular dependency sanity check
         problem_tasks = []
         for task in xrange(numTasks):
-            if task_done[task] is False or deps_left[task] != 0:
+            if task_done[task] is False:
                 problem_tasks.append(task)
                 logger.debug(2, "Task %s (%s) is not buildable", task, self.get_user_idstring(task))
-                logger.debug(2, "(Complete marker was %s and the remaining dependency count was %s)\n", task_done[task], deps_left[task])
 
         if problem_tasks:
             message = "Unbuildable tasks were found.\n"
             message = message + "These are usually caused by circular dependencies and any circular dependency chains found will be printed below. Increase the debug level to see a list of unbuildable tasks.\n\n"
-            message = message + "Identifying dependency loops (this may take a short while)...\n"
+            message = message + "Identifying dependency loops...\n"
             logger.error(message)
 
             msgs = self.circular_depchains_handler(problem_tasks)
@@ -367,6 +584,11 @@ class RunQueueData:
         to optimise the execution order.
         """
 
+        if self.prepared is not None:
+            # Reused from an earlier build of the same targets
+            self.remove_forced_stamps()
+            return self.prepared
+
         runq_build = []
         recursive_tdepends = {}
         runq_recrdepends = []
@@ -593,19 +815,20 @@ class RunQueueData:
         # Once all active tasks are marked, prune the ones we don't need.
 
         maps = []
-        delcount = 0
+        keep = []
         for listid in xrange(len(self.runq_fnid)):
-            if runq_build[listid-delcount] == 1:
-                maps.append(listid-delcount)
+            if runq_build[listid] == 1:
+                maps.append(len(keep))
+                keep.append(listid)
             else:
-                del self.runq_fnid[listid-delcount]
-                del self.runq_task[listid-delcount]
-                del self.runq_depends[listid-delcount]
-                del runq_build[listid-delcount]
-                del self.runq_revdeps[listid-delcount]
-                del self.runq_hash[listid-delcount]
-                delcount = delcount + 1
                 maps.append(-1)
+        delcount = len(self.runq_fnid) - len(keep)
+
+        self.runq_fnid = [self.runq_fnid[listid] for listid in keep]
+        self.runq_task = [self.runq_task[listid] for listid in keep]
+        self.runq_depends = [self.runq_depends[listid] for listid in keep]
+        self.runq_revdeps = [self.runq_revdeps[listid] for listid in keep]
+        self.runq_hash = [self.runq_hash[listid] for listid in keep]
 
         #
         # Step D - Sanity checks and computation
@@ -623,13 +846,12 @@ class RunQueueData:
         # Remap the dependencies to account for the deleted tasks
         # Check we didn't delete a task we depend on
         for listid in xrange(len(self.runq_fnid)):
-            newdeps = []
-            origdeps = self.runq_depends[listid]
-            for origdep in origdeps:
+            newdeps = set()
+            for origdep in self.runq_depends[listid]:
                 if maps[origdep] == -1:
                     bb.msg.fatal(bb.msg.domain.RunQueue, "Invalid mapping - Should never happen!")
-                newdeps.append(maps[origdep])
-            self.runq_depends[listid] = set(newdeps)
+                newdeps.add(maps[origdep])
+            self.runq_depends[listid] = newdeps
 
         logger.verbose("Assign Weightings")
 
@@ -638,17 +860,22 @@ class RunQueueData:
             for dep in self.runq_depends[listid]:
                 self.runq_revdeps[dep].add(listid)
 
+        self.graph = RunQueueGraph(self.runq_depends)
+
         # Identify tasks at the end of dependency chains
         # Error on circular dependency loops (length two)
         endpoints = []
         for listid in xrange(len(self.runq_fnid)):
-            revdeps = self.runq_revdeps[listid]
-            if len(revdeps) == 0:
+            if len(self.runq_revdeps[listid]) == 0:
                 endpoints.append(listid)
-            for dep in revdeps:
-                if dep in self.runq_depends[listid]:
-                    #self.dump_data(taskData)
-                    bb.msg.fatal(bb.msg.domain.RunQueue, "Task %s (%s) has circular dependency on %s (%s)" % (taskData.fn_index[self.runq_fnid[dep]], self.runq_task[dep], taskData.fn_index[self.runq_fnid[listid]], self.runq_task[listid]))
+        if len(self.graph.order) != len(self.runq_fnid):
+            # Only tasks which are part of a loop need checking
+            for component in self.graph.loops():
+                for listid in component:
+                    for dep in self.runq_revdeps[listid]:
+                        if dep in self.runq_depends[listid]:
+                            #self.dump_data(taskData)
+                            bb.msg.fatal(bb.msg.domain.RunQueue, "Task %s (%s) has circular dependency on %s (%s)" % (taskData.fn_index[self.runq_fnid[dep]], self.runq_task[dep], taskData.fn_index[self.runq_fnid[listid]], self.runq_task[listid]))
 
         logger.verbose("Compute totals (have %s endpoint(s))", len(endpoints))
 
@@ -658,12 +885,12 @@ class RunQueueData:
 
         # Sanity Check - Check for multiple tasks building the same provider
         prov_list = {}
-        seen_fn = []
+        seen_fn = set()
         for task in xrange(len(self.runq_fnid)):
             fn = taskData.fn_index[self.runq_fnid[task]]
             if fn in seen_fn:
                 continue
-            seen_fn.append(fn)
+            seen_fn.add(fn)
             for prov in self.dataCache.fn_provides[fn]:
                 if prov not in prov_list:
                     prov_list[prov] = [fn]
@@ -696,39 +923,36 @@ class RunQueueData:
             self.runq_setscene.append(task)
 
         # Interate over the task list and call into the siggen code
-        dealtwith = set()
-        todeal = set(range(len(self.runq_fnid)))
-        while len(todeal) > 0:
-            for task in todeal.copy():
-                if len(self.runq_depends[task] - dealtwith) == 0:
-                    dealtwith.add(task)
-                    todeal.remove(task)
-                    procdep = []
-                    for dep in self.runq_depends[task]:
-                        procdep.append(self.taskData.fn_index[self.runq_fnid[dep]] + "." + self.runq_task[dep])
-                    self.runq_hash[task] = bb.parse.siggen.get_taskhash(self.taskData.fn_index[self.runq_fnid[task]], self.runq_task[task], procdep, self.dataCache)
+        #
+        # Loops have been ruled out above so the topological order covers
+        # every task and each task's dependencies are hashed before it.
+        identifiers = []
+        for task in xrange(len(self.runq_fnid)):
+            identifiers.append(self.taskData.fn_index[self.runq_fnid[task]] + "." + self.runq_task[task])
 
         self.hashes = {}
         self.hash_deps = {}
-        for task in xrange(len(self.runq_fnid)):
-            identifier = '%s.%s' % (self.taskData.fn_index[self.runq_fnid[task]],
-                                    self.runq_task[task])
-            self.hashes[identifier] = self.runq_hash[task]
-            deps = []
-            for dep in self.runq_depends[task]:
-                depidentifier = '%s.%s' % (self.taskData.fn_index[self.runq_fnid[dep]],
-                                           self.runq_task[dep])
-                deps.append(depidentifier)
-            self.hash_deps[identifier] = deps
-
-        # Remove stamps for targets if force mode active
+        for task in self.graph.order:
+            fn = self.taskData.fn_index[self.runq_fnid[task]]
+            procdep = [identifiers[dep] for dep in self.runq_depends[task]]
+            self.runq_hash[task] = bb.parse.siggen.get_taskhash(fn, self.runq_task[task], procdep, self.dataCache)
+            self.hashes[identifiers[task]] = self.runq_hash[task]
+            self.hash_deps[identifiers[task]] = procdep
+
+        self.remove_forced_stamps()
+
+        self.prepared = len(self.runq_fnid)
+        return self.prepared
+
+    def remove_forced_stamps(self):
+        """
+        Remove stamps for targets if force mode active
+        """
         if self.cooker.configuration.force:
             for (fn, target) in self.target_pairs:
                 logger.verbose("Remove stamp %s, %s", target, fn)
                 bb.build.del_stamp(target, self.dataCache, fn)
 
-        return len(self.runq_fnid)
-
     def dump_data(self, taskQueue):
         """
         Dump some debug information on the internal data structures
@@ -754,14 +978,23 @@ class RunQueueData:
                            self.rqdata.runq_revdeps[task])
 
 class RunQueue:
-    def __init__(self, cooker, cfgData, dataCache, taskData, targets):
+    def __init__(self, cooker, cfgData, dataCache, taskData, targets, rqdata = None):
 
         self.cooker = cooker
         self.cfgData = cfgData
-        self.rqdata = RunQueueData(self, cooker, cfgData, dataCache, taskData, targets)
+        if rqdata is None:
+            rqdata = RunQueueData(self, cooker, cfgData, dataCache, taskData, targets)
+        else:
+            rqdata.rq = self
+        self.rqdata = rqdata
 
         self.stamppolicy = bb.data.getVar("BB_STAMP_POLICY", cfgData, True) or "perfile"
         self.hashvalidate = bb.data.getVar("BB_HASHCHECK_FUNCTION", cfgData, True) or None
+        if not self.hashvalidate and bb.data.getVar("BB_HASHCHECK_MIRRORS", cfgData, True):
+            self.hashvalidate = "bb.hashcheck.check_hashes"
+        self.stamps = RunQueueStampIndex(self.rqdata)
+        self.taskstats = None
+        self.remote = None
 
         self.state = runQueuePrepare
 
@@ -799,9 +1032,8 @@ class RunQueue:
                 continue
             fn = self.rqdata.taskData.fn_index[self.rqdata.runq_fnid[task]]
             taskname = self.rqdata.runq_task[task]
-            stampfile = bb.build.stampfile(taskname, self.rqdata.dataCache, fn)
             # If the stamp is missing its not current
-            if not os.access(stampfile, os.F_OK):
+            if self.stamps.mtime(self.stamps.stampfile(task)) is None:
                 del unchecked[task]
                 notcurrent.append(task)
                 check_buildable(self, task, buildable)
@@ -818,22 +1050,18 @@ class RunQueue:
             nextbuildable = []
             for task in buildable:
                 if task in unchecked:
-                    fn = self.taskData.fn_index[self.rqdata.runq_fnid[task]]
-                    taskname = self.rqdata.runq_task[task]
-                    stampfile = bb.build.stampfile(taskname, self.rqdata.dataCache, fn)
+                    fn = self.rqdata.taskData.fn_index[self.rqdata.runq_fnid[task]]
                     iscurrent = True
 
-                    t1 = os.stat(stampfile)[stat.ST_MTIME]
+                    t1 = self.stamps.mtime(self.stamps.stampfile(task))
                     for dep in self.rqdata.runq_depends[task]:
                         if iscurrent:
-                            fn2 = self.taskData.fn_index[self.rqdata.runq_fnid[dep]]
-                            taskname2 = self.rqdata.runq_task[dep]
-                            stampfile2 = bb.build.stampfile(taskname2, self.rqdata.dataCache, fn2)
+                            fn2 = self.rqdata.taskData.fn_index[self.rqdata.runq_fnid[dep]]
                             if fn == fn2 or (fulldeptree and fn2 not in stampwhitelist):
                                 if dep in notcurrent:
                                     iscurrent = False
                                 else:
-                                    t2 = os.stat(stampfile2)[stat.ST_MTIME]
+                                    t2 = self.stamps.mtime(self.stamps.stampfile(dep))
                                     if t1 < t2:
                                         iscurrent = False
                     del unchecked[task]
@@ -860,14 +1088,6 @@ class RunQueue:
         return current
 
     def check_stamp_task(self, task, taskname = None):
-        def get_timestamp(f):
-            try:
-                if not os.access(f, os.F_OK):
-                    return None
-                return os.stat(f)[stat.ST_MTIME]
-            except:
-                return None
-
         if self.stamppolicy == "perfile":
             fulldeptree = False
         else:
@@ -880,10 +1100,12 @@ class RunQueue:
         if taskname is None:
             taskname = self.rqdata.runq_task[task]
 
-        stampfile = bb.build.stampfile(taskname, self.rqdata.dataCache, fn)
+        stamps = self.stamps
+        stampfile = stamps.stampfile(task, taskname)
+        t1 = stamps.mtime(stampfile)
 
         # If the stamp is missing its not current
-        if not os.access(stampfile, os.F_OK):
+        if t1 is None:
             logger.debug(2, "Stampfile %s not available", stampfile)
             return False
         # If its a 'nostamp' task, it's not current
@@ -896,15 +1118,13 @@ class RunQueue:
             return True
 
         iscurrent = True
-        t1 = get_timestamp(stampfile)
         for dep in self.rqdata.runq_depends[task]:
             if iscurrent:
                 fn2 = self.rqdata.taskData.fn_index[self.rqdata.runq_fnid[dep]]
                 taskname2 = self.rqdata.runq_task[dep]
-                stampfile2 = bb.build.stampfile(taskname2, self.rqdata.dataCache, fn2)
-                stampfile3 = bb.build.stampfile(taskname2 + "_setscene", self.rqdata.dataCache, fn2)
-                t2 = get_timestamp(stampfile2)
-                t3 = get_timestamp(stampfile3)
+                stampfile2 = stamps.stampfile(dep, taskname2)
+                t2 = stamps.mtime(stampfile2)
+                t3 = stamps.mtime(stamps.stampfile(dep, taskname2 + "_setscene"))
                 if t3 and t3 > t2:
                    continue
                 if fn == fn2 or (fulldeptree and fn2 not in stampwhitelist):
@@ -928,6 +1148,7 @@ class RunQueue:
 
         if self.state is runQueuePrepare:
             self.rqexe = RunQueueExecuteDummy(self)
+            self.stamps.clear()
             if self.rqdata.prepare() == 0:
                 self.state = runQueueComplete
             else:
@@ -936,7 +1157,15 @@ class RunQueue:
         if self.state is runQueueSceneInit:
             if self.cooker.configuration.dump_signatures:
                 self.dump_signatures()
+            elif self.cooker.configuration.simulate:
+                self.state = runQueueComplete
+                bb.simulate.simulate(self.rqdata, self.cfgData)
             else:
+                self.taskstats = bb.taskstats.TaskStats.from_metadata(self.cfgData)
+                if self.taskstats:
+                    self.taskstats.start_build(["%s:%s" % (target[0], target[1]) for target in self.rqdata.targets])
+                self.remote = bb.remote.RemoteDispatcher.from_metadata(self.cfgData,
+                        int(bb.data.getVar("BB_NUMBER_THREADS", self.cfgData, 1) or 1))
                 self.rqexe = RunQueueExecuteScenequeue(self)
 
         if self.state is runQueueSceneRun:
@@ -954,6 +1183,8 @@ class RunQueue:
            self.rqexe.finish()
 
         if self.state is runQueueFailed:
+            if self.taskstats:
+                self.taskstats.end_build("failed")
             if not self.rqdata.taskData.tryaltconfigs:
                 raise bb.runqueue.TaskFailure(self.rqexe.failed_fnids)
             for fnid in self.rqexe.failed_fnids:
@@ -962,6 +1193,8 @@ class RunQueue:
 
         if self.state is runQueueComplete:
             # All done
+            if self.taskstats:
+                self.taskstats.end_build("succeeded")
             logger.info("Tasks Summary: Attempted %d tasks of which %d didn't need to be rerun and %d failed.", self.rqexe.stats.completed, self.rqexe.stats.skipped, self.rqexe.stats.failed)
             return False
 
@@ -995,6 +1228,9 @@ class RunQueue:
 
 class RunQueueExecute:
 
+    # Don't report failures to load the recipe data in the worker
+    quieterrors = False
+
     def __init__(self, rq):
         self.rq = rq
         self.cooker = rq.cooker
@@ -1004,11 +1240,19 @@ class RunQueueExecute:
         self.number_tasks = int(bb.data.getVar("BB_NUMBER_THREADS", self.cfgData, 1) or 1)
         self.scheduler = bb.data.getVar("BB_SCHEDULER", self.cfgData, 1) or "speed"
 
+        # Remote tasks are keyed by negative numbers in build_pids and
+        # build_pipes, local ones by their pid
+        self.remote = rq.remote
+        self.next_remote_key = -1
+        if self.remote:
+            self.number_tasks = self.number_tasks + self.remote.slots()
+
         self.runq_buildable = []
         self.runq_running = []
         self.runq_complete = []
         self.build_pids = {}
         self.build_pipes = {}
+        self.build_starttimes = {}
         self.failed_fnids = []
 
     def runqueue_process_waitpid(self):
@@ -1016,22 +1260,53 @@ class RunQueueExecute:
         Return none is there are no processes awaiting result collection, otherwise
         collect the process exit codes and close the information pipe.
         """
-        result = os.waitpid(-1, os.WNOHANG)
+        for key in self.build_pids:
+            if key < 0 and self.build_pipes[key].exitstatus is not None:
+                pipe = self.build_pipes.pop(key)
+                pipe.close()
+                self.task_exited(key, pipe.exitstatus, pipe.resources)
+                return
+
+        for key in self.build_pids:
+            if key > 0:
+                break
+        else:
+            return None
+
+        result = os.wait4(-1, os.WNOHANG)
         if result[0] == 0 and result[1] == 0:
             return None
-        task = self.build_pids[result[0]]
-        del self.build_pids[result[0]]
         self.build_pipes[result[0]].close()
         del self.build_pipes[result[0]]
-        if result[1] != 0:
-            self.task_fail(task, result[1]>>8)
+        resources = bb.taskstats.resources(self.build_starttimes.pop(result[0]), result[2])
+        self.task_exited(result[0], result[1], resources)
+
+    def task_exited(self, key, status, resources):
+        task = self.build_pids.pop(key)
+        if self.remote:
+            self.remote.finished(key)
+        if status != 0:
+            self.task_fail(task, status>>8, resources)
         else:
-            self.task_complete(task)
+            self.task_complete(task, resources)
+
+    def record_taskstats(self, task, taskname, exitcode, resources, deps = ()):
+        """
+        Store the resources used by a task in the build statistics database
+        """
+        if not resources or not self.rq.taskstats:
+            return
+        fn = self.rqdata.taskData.fn_index[self.rqdata.runq_fnid[task]]
+        self.rq.taskstats.record_task(task, fn, self.rqdata.dataCache.pkg_fn[fn], taskname,
+                                      deps, exitcode, resources)
 
     def finish_now(self):
         if self.stats.active:
             logger.info("Sending SIGTERM to remaining %s tasks", self.stats.active)
             for k, v in self.build_pids.iteritems():
+                if k < 0:
+                    self.build_pipes[k].kill()
+                    continue
                 try:
                     os.kill(-k, signal.SIGTERM)
                 except:
@@ -1057,7 +1332,75 @@ class RunQueueExecute:
         self.rq.state = runQueueComplete
         return
 
-    def fork_off_task(self, fn, task, taskname, quieterrors=False):
+    def launch_task(self, task, realtask, fn, taskname):
+        """
+        Start taskname of fn, either locally or on a remote worker, and
+        record it as task in build_pids and build_pipes
+        """
+        worker = None
+        if self.remote:
+            worker = self.remote.choose(self.rqdata.runq_depends[realtask])
+        if worker:
+            try:
+                sock, session = worker.connect(self.remote_request(fn, realtask, taskname))
+            except (socket.error, EnvironmentError, EOFError, bb.remote.AuthenticationError) as exc:
+                logger.warn("Unable to run %s:%s on %s (%s), no longer using it",
+                            fn, taskname, worker, exc)
+                self.remote.remove(worker)
+                self.number_tasks = self.number_tasks - worker.slots
+                worker = None
+
+        if worker:
+            key = self.next_remote_key
+            self.next_remote_key = self.next_remote_key - 1
+            logger.debug(1, "Running %s:%s on %s", fn, taskname, worker)
+            self.build_pipes[key] = runQueueRemotePipe(sock, session, self.cfgData)
+        else:
+            key, pipein, pipeout = self.fork_off_task(fn, realtask, taskname)
+            self.build_pipes[key] = runQueuePipe(pipein, pipeout, self.cfgData)
+            worker = None
+
+        self.build_pids[key] = task
+        if self.remote:
+            self.remote.started(key, realtask, worker)
+
+    def remote_request(self, fn, task, taskname):
+        """
+        Describe a task for bitbake-worker-agent, see bb.remote.run_task()
+        """
+        env = {}
+        fakedirs = []
+        taskdep = self.rqdata.dataCache.task_deps[fn]
+        if 'fakeroot' in taskdep and taskname in taskdep['fakeroot']:
+            envvars = (self.rqdata.dataCache.fakerootenv[fn] or "").split()
+            env = dict(var.split('=') for var in envvars)
+            fakedirs = (self.rqdata.dataCache.fakerootdirs[fn] or "").split()
+
+        # Only send the hashes the task can need, those of the other tasks
+        # of the recipe (for stamps) and of the task's dependencies
+        identifier = fn + "." + self.rqdata.runq_task[task]
+        hashes = {}
+        for name in self.rqdata.taskData.tasks_lookup[self.rqdata.runq_fnid[task]]:
+            k = fn + "." + name
+            if k in self.rqdata.hashes:
+                hashes[k] = self.rqdata.hashes[k]
+        hash_deps = {identifier : self.rqdata.hash_deps[identifier]}
+        for dep in hash_deps[identifier]:
+            hashes[dep] = self.rqdata.hashes[dep]
+
+        return {
+            "fn" : fn,
+            "taskname" : taskname,
+            "taskhash" : self.rqdata.runq_hash[task],
+            "appends" : self.cooker.get_file_appends(fn),
+            "env" : env,
+            "fakedirs" : fakedirs,
+            "hashes" : hashes,
+            "hash_deps" : hash_deps,
+            "quieterrors" : self.quieterrors,
+        }
+
+    def fork_off_task(self, fn, task, taskname):
         # We need to setup the environment BEFORE the fork, since
         # a fork() or exec*() activates PSEUDO...
 
@@ -1079,6 +1422,7 @@ class RunQueueExecute:
 
         sys.stdout.flush()
         sys.stderr.flush()
+        starttime = time.time()
         try:
             pipein, pipeout = os.pipe()
             pipein = os.fdopen(pipein, 'rb', 4096)
@@ -1095,6 +1439,10 @@ class RunQueueExecute:
             bb.event.worker_pid = os.getpid()
             bb.event.worker_pipe = pipeout
 
+            # Other tasks may write stamps whilst this one runs, don't
+            # answer check_stamp_fn() queries from a stale index
+            self.rq.stamps.clear()
+
             self.rq.state = runQueueChildProcess
             # Make the child the process group leader
             os.setpgid(0, 0)
@@ -1111,15 +1459,21 @@ class RunQueueExecute:
                 the_data.setVar('BB_TASKHASH', self.rqdata.runq_hash[task])
                 os.environ.update(bb.data.exported_vars(the_data))
             except Exception as exc:
-                if not quieterrors:
+                if not self.quieterrors:
                     logger.critical(str(exc))
+                bb.event.worker_flush()
                 os._exit(1)
             try:
                 ret = bb.build.exec_task(fn, taskname, the_data)
+                bb.event.worker_flush()
                 os._exit(ret)
             except:
-                os._exit(1)
+                try:
+                    bb.event.worker_flush()
+                finally:
+                    os._exit(1)
         else:
+            self.build_starttimes[pid] = starttime
             for key, value in envbackup.iteritems():
                 if value is None:
                     del os.environ[key]
@@ -1183,26 +1537,7 @@ class RunQueueExecuteTasks(RunQueueExecute):
 
 
     def get_schedulers(self):
-        schedulers = set(obj for obj in globals().values()
-                             if type(obj) is type and
-                                issubclass(obj, RunQueueScheduler))
-
-        user_schedulers = bb.data.getVar("BB_SCHEDULERS", self.cfgData, True)
-        if user_schedulers:
-            for sched in user_schedulers.split():
-                if not "." in sched:
-                    bb.note("Ignoring scheduler '%s' from BB_SCHEDULERS: not an import" % sched)
-                    continue
-
-                modname, name = sched.rsplit(".", 1)
-                try:
-                    module = __import__(modname, fromlist=(name,))
-                except ImportError, exc:
-                    logger.critical("Unable to import scheduler '%s' from '%s': %s" % (name, modname, exc))
-                    raise SystemExit(1)
-                else:
-                    schedulers.add(getattr(module, name))
-        return schedulers
+        return get_schedulers(self.cfgData)
 
     def task_completeoutright(self, task):
         """
@@ -1226,12 +1561,14 @@ class RunQueueExecuteTasks(RunQueueExecute):
                 taskname = self.rqdata.runq_task[revdep]
                 logger.debug(1, "Marking task %s (%s, %s) as buildable", revdep, fn, taskname)
 
-    def task_complete(self, task):
+    def task_complete(self, task, resources = None):
+        self.rq.stamps.update_task(task)
         self.stats.taskCompleted()
-        bb.event.fire(runQueueTaskCompleted(task, self.stats, self.rq), self.cfgData)
+        self.record_taskstats(task, self.rqdata.runq_task[task], 0, resources, self.rqdata.runq_depends[task])
+        bb.event.fire(runQueueTaskCompleted(task, self.stats, self.rq, resources), self.cfgData)
         self.task_completeoutright(task)
 
-    def task_fail(self, task, exitcode):
+    def task_fail(self, task, exitcode, resources = None):
         """
         Called when a task has failed
         Updates the state engine with the failure
@@ -1239,7 +1576,8 @@ class RunQueueExecuteTasks(RunQueueExecute):
         self.stats.taskFailed()
         fnid = self.rqdata.runq_fnid[task]
         self.failed_fnids.append(fnid)
-        bb.event.fire(runQueueTaskFailed(task, self.stats, exitcode, self.rq), self.cfgData)
+        self.record_taskstats(task, self.rqdata.runq_task[task], exitcode, resources, self.rqdata.runq_depends[task])
+        bb.event.fire(runQueueTaskFailed(task, self.stats, exitcode, self.rq, resources), self.cfgData)
         if self.rqdata.taskData.abort:
             self.rq.state = runQueueCleanUp
 
@@ -1283,17 +1621,14 @@ class RunQueueExecuteTasks(RunQueueExecute):
                 bb.event.fire(startevent, self.cfgData)
                 self.runq_running[task] = 1
                 self.stats.taskActive()
-                bb.build.make_stamp(taskname, self.rqdata.dataCache, fn)
+                self.rq.stamps.make_stamp(task, taskname)
                 self.task_complete(task)
                 return True
             else:
                 startevent = runQueueTaskStarted(task, self.stats, self.rq)
                 bb.event.fire(startevent, self.cfgData)
 
-            pid, pipein, pipeout = self.fork_off_task(fn, task, taskname)
-
-            self.build_pids[pid] = task
-            self.build_pipes[pid] = runQueuePipe(pipein, pipeout, self.cfgData)
+            self.launch_task(task, task, fn, taskname)
             self.runq_running[task] = 1
             self.stats.taskActive()
 
@@ -1321,6 +1656,8 @@ class RunQueueExecuteTasks(RunQueueExecute):
         return True
 
 class RunQueueExecuteScenequeue(RunQueueExecute):
+    quieterrors = True
+
     def __init__(self, rq):
         RunQueueExecute.__init__(self, rq)
 
@@ -1335,67 +1672,55 @@ class RunQueueExecuteScenequeue(RunQueueExecute):
 
         self.stats = RunQueueStats(len(self.rqdata.runq_setscene))
 
-        endpoints = {}
-        sq_revdeps = []
-        sq_revdeps_new = []
-        sq_revdeps_squash = []
-
         # We need to construct a dependency graph for the setscene functions. Intermediate
         # dependencies between the setscene tasks only complicate the code. This code
         # therefore aims to collapse the huge runqueue dependency tree into a smaller one
         # only containing the setscene functions.
+        #
+        # For every task we compute the set of setscene tasks which depend upon it either
+        # directly or through a chain of non-setscene tasks. The sets are bitsets indexed
+        # by setscene task number and are built by walking the graph in reverse
+        # topological order, so each task is visited once after all its reverse
+        # dependencies.
 
         for task in xrange(self.stats.total):
             self.runq_running.append(0)
             self.runq_complete.append(0)
             self.runq_buildable.append(0)
 
-        for task in xrange(len(self.rqdata.runq_fnid)):
-            sq_revdeps.append(copy.copy(self.rqdata.runq_revdeps[task]))
-            sq_revdeps_new.append(set())
-            if (len(self.rqdata.runq_revdeps[task]) == 0) and task not in self.rqdata.runq_setscene:
-                endpoints[task] = None
-
-        for task in self.rqdata.runq_setscene:
-            for dep in self.rqdata.runq_depends[task]:
-                    endpoints[dep] = task
-
-        def process_endpoints(endpoints):
-            newendpoints = {}
-            for point, task in endpoints.items():
-                tasks = set()
-                if task:
-                    tasks.add(task)
-                if sq_revdeps_new[point]:
-                    tasks |= sq_revdeps_new[point]
-                sq_revdeps_new[point] = set()
-                for dep in self.rqdata.runq_depends[point]:
-                    if point in sq_revdeps[dep]:
-                        sq_revdeps[dep].remove(point)
-                    if tasks:
-                        sq_revdeps_new[dep] |= tasks
-                    if (len(sq_revdeps[dep]) == 0 or len(sq_revdeps_new[dep]) != 0) and dep not in self.rqdata.runq_setscene:
-                        newendpoints[dep] = task
-            if len(newendpoints) != 0:
-                process_endpoints(newendpoints)
-
-        process_endpoints(endpoints)
+        sq_index = {}
+        for sq_task in xrange(len(self.rqdata.runq_setscene)):
+            sq_index[self.rqdata.runq_setscene[sq_task]] = sq_task
+
+        graph = self.rqdata.graph
+        reached = [0] * len(self.rqdata.runq_fnid)
+        for task in reversed(graph.order):
+            bits = 0
+            for i in xrange(graph.revdep_index[task], graph.revdep_index[task + 1]):
+                revdep = graph.revdeps[i]
+                if revdep in sq_index:
+                    bits = bits | (1 << sq_index[revdep])
+                else:
+                    bits = bits | reached[revdep]
+            reached[task] = bits
 
-        for task in xrange(len(self.rqdata.runq_fnid)):
-            if task in self.rqdata.runq_setscene:
-                deps = set()
-                for dep in sq_revdeps_new[task]:
-                    deps.add(self.rqdata.runq_setscene.index(dep))
-                sq_revdeps_squash.append(deps)
-            elif len(sq_revdeps_new[task]) != 0:
-                bb.msg.fatal(bb.msg.domain.RunQueue, "Something went badly wrong during scenequeue generation, aborting. Please report this problem.")
+        sq_revdeps_squash = []
+        for realtask in self.rqdata.runq_setscene:
+            bits = reached[realtask]
+            deps = set()
+            while bits:
+                lowbit = bits & -bits
+                # The index of the bit, bit_length() needs python 2.7
+                deps.add(len(bin(lowbit)) - 3)
+                bits = bits ^ lowbit
+            sq_revdeps_squash.append(deps)
 
         #for task in xrange(len(sq_revdeps_squash)):
         #    print "Task %s: %s.%s is %s " % (task, self.taskData.fn_index[self.runq_fnid[self.runq_setscene[task]]], self.runq_task[self.runq_setscene[task]] + "_setscene", sq_revdeps_squash[task])
 
         self.sq_deps = []
         self.sq_revdeps = sq_revdeps_squash
-        self.sq_revdeps2 = copy.deepcopy(self.sq_revdeps)
+        self.sq_revdeps2 = [set(revdeps) for revdeps in self.sq_revdeps]
 
         for task in xrange(len(self.sq_revdeps)):
             self.sq_deps.append(set())
@@ -1403,9 +1728,12 @@ class RunQueueExecuteScenequeue(RunQueueExecute):
             for dep in self.sq_revdeps[task]:
                 self.sq_deps[dep].add(task)
 
+        # Heap of tasks which have become buildable, lowest task number first
+        self.sq_ready = []
         for task in xrange(len(self.sq_revdeps)):
             if len(self.sq_revdeps[task]) == 0:
                 self.runq_buildable[task] = 1
+                self.sq_ready.append(task)
 
         if self.rq.hashvalidate:
             sq_hash = []
@@ -1422,7 +1750,7 @@ class RunQueueExecuteScenequeue(RunQueueExecute):
                 if 'noexec' in taskdep and taskname in taskdep['noexec']:
                     noexec.append(task)
                     self.task_skip(task)
-                    bb.build.make_stamp(taskname + "_setscene", self.rqdata.dataCache, fn)
+                    self.rq.stamps.make_stamp(realtask, taskname + "_setscene")
                     continue
                 sq_fn.append(fn)
                 sq_hashfn.append(self.rqdata.dataCache.hashfn[fn])
@@ -1452,6 +1780,7 @@ class RunQueueExecuteScenequeue(RunQueueExecute):
             self.sq_revdeps2[dep].remove(task)
             if len(self.sq_revdeps2[dep]) == 0:
                 self.runq_buildable[dep] = 1
+                heapq.heappush(self.sq_ready, dep)
 
     def task_completeoutright(self, task):
         """
@@ -1467,14 +1796,18 @@ class RunQueueExecuteScenequeue(RunQueueExecute):
         self.scenequeue_covered.add(task)
         self.scenequeue_updatecounters(task)
 
-    def task_complete(self, task):
+    def task_complete(self, task, resources = None):
+        realtask = self.rqdata.runq_setscene[task]
+        self.rq.stamps.update_task(realtask, self.rqdata.runq_task[realtask] + "_setscene")
         self.stats.taskCompleted()
+        self.record_taskstats(realtask, self.rqdata.runq_task[realtask] + "_setscene", 0, resources)
         self.task_completeoutright(task)
 
-    def task_fail(self, task, result):
+    def task_fail(self, task, result, resources = None):
         self.stats.taskFailed()
         index = self.rqdata.runq_setscene[task]
-        bb.event.fire(runQueueTaskFailed(task, self.stats, result, self), self.cfgData)
+        self.record_taskstats(index, self.rqdata.runq_task[index] + "_setscene", result, resources)
+        bb.event.fire(runQueueTaskFailed(task, self.stats, result, self, resources), self.cfgData)
         self.scenequeue_notcovered.add(task)
         self.scenequeue_updatecounters(task)
 
@@ -1502,8 +1835,9 @@ class RunQueueExecuteScenequeue(RunQueueExecute):
         task = None
         if self.stats.active < self.number_tasks:
             # Find the next setscene to run
-            for nexttask in xrange(self.stats.total):
-                if self.runq_buildable[nexttask] == 1 and self.runq_running[nexttask] != 1:
+            while self.sq_ready:
+                nexttask = heapq.heappop(self.sq_ready)
+                if self.runq_running[nexttask] != 1:
                     task = nexttask
                     break
         if task is not None:
@@ -1529,10 +1863,7 @@ class RunQueueExecuteScenequeue(RunQueueExecute):
                 self.task_skip(task)
                 return True
 
-            pid, pipein, pipeout = self.fork_off_task(fn, realtask, taskname)
-
-            self.build_pids[pid] = task
-            self.build_pipes[pid] = runQueuePipe(pipein, pipeout, self.cfgData)
+            self.launch_task(task, realtask, fn, taskname)
             self.runq_running[task] = 1
             self.stats.taskActive()
             if self.stats.active < self.number_tasks:
@@ -1557,9 +1888,6 @@ class RunQueueExecuteScenequeue(RunQueueExecute):
         self.rq.state = runQueueRunInit
         return True
 
-    def fork_off_task(self, fn, task, taskname):
-        return RunQueueExecute.fork_off_task(self, fn, task, taskname, quieterrors=True)
-
 class TaskFailure(Exception):
     """
     Exception raised when a task in a runqueue fails
@@ -1600,17 +1928,24 @@ class runQueueTaskFailed(runQueueEvent):
     """
     Event notifing a task failed
     """
-    def __init__(self, task, stats, exitcode, rq):
+    def __init__(self, task, stats, exitcode, rq, resources = None):
         runQueueEvent.__init__(self, task, stats, rq)
         self.exitcode = exitcode
+        self.resources = resources
 
 class runQueueTaskCompleted(runQueueEvent):
     """
     Event notifing a task completed
     """
+    def __init__(self, task, stats, rq, resources = None):
+        runQueueEvent.__init__(self, task, stats, rq)
+        self.resources = resources
 
 def check_stamp_fn(fn, taskname, d):
     rqexe = bb.data.getVar("__RUNQUEUE_DO_NOT_USE_EXTERNALLY", d)
+    if rqexe is None:
+        # Running under bitbake-worker-agent
+        return None
     fn = bb.data.getVar("__RUNQUEUE_DO_NOT_USE_EXTERNALLY2", d)
     fnid = rqexe.rqdata.taskData.getfn_id(fn)
     taskid = rqexe.rqdata.get_task_id(fnid, taskname)
@@ -1626,26 +1961,98 @@ class runQueuePipe():
         self.input = pipein
         pipeout.close()
         fcntl.fcntl(self.input, fcntl.F_SETFL, fcntl.fcntl(self.input, fcntl.F_GETFL) | os.O_NONBLOCK)
-        self.queue = ""
+        self.queue = bytearray()
         self.d = d
 
-    def read(self):
-        start = len(self.queue)
+    def receive(self):
         try:
-            self.queue = self.queue + self.input.read(102400)
+            return self.input.read(102400)
         except (OSError, IOError):
-            pass
+            return ""
+
+    def handle(self, data):
+        bb.event.fire_from_worker(data, self.d)
+
+    def read(self):
+        start = len(self.queue)
+        self.queue.extend(self.receive())
         end = len(self.queue)
-        index = self.queue.find("</event>")
-        while index != -1:
-            bb.event.fire_from_worker(self.queue[:index+8], self.d)
-            self.queue = self.queue[index+8:]
-            index = self.queue.find("</event>")
+
+        # Fire every complete frame then drop them from the buffer in one go
+        frame = bb.event.worker_frame
+        pos = 0
+        while end - pos >= frame.size:
+            length = frame.unpack_from(self.queue, pos)[0]
+            if end - pos - frame.size < length:
+                break
+            pos = pos + frame.size
+            self.handle(str(self.queue[pos:pos+length]))
+            pos = pos + length
+        if pos:
+            del self.queue[:pos]
         return (end > start)
 
     def close(self):
         while self.read():
             continue
         if len(self.queue) > 0:
-            print("Warning, worker left partial message: %s" % self.queue)
+            print("Warning, worker left partial message: %s" % str(self.queue))
         self.input.close()
+
+class runQueueRemotePipe(runQueuePipe):
+    """
+    Connection to a task running under bitbake-worker-agent. exitstatus is
+    set once the task has exited.
+    """
+    def __init__(self, sock, session, d):
+        self.input = sock
+        self.session = session
+        self.rejected = False
+        self.peer = "%s:%s" % sock.getpeername()[:2]
+        self.queue = bytearray()
+        self.d = d
+        self.exitstatus = None
+        self.resources = None
+        self.connected = True
+
+    def receive(self):
+        if not self.connected:
+            return ""
+        try:
+            data = self.input.recv(102400)
+        except socket.error as exc:
+            if exc.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return ""
+            data = ""
+        if not data:
+            self.connected = False
+            if self.exitstatus is None:
+                logger.error("Lost connection to remote worker %s", self.peer)
+                self.exitstatus = 1 << 8
+        return data
+
+    def handle(self, data):
+        if self.rejected:
+            return
+        try:
+            event = self.session.decode(data)
+        except bb.remote.AuthenticationError as exc:
+            logger.error("Dropping connection to remote worker %s: %s", self.peer, exc)
+            self.kill()
+            self.rejected = True
+            self.connected = False
+            if self.exitstatus is None:
+                self.exitstatus = 1 << 8
+            return
+        if isinstance(event, bb.remote.TaskExit):
+            self.exitstatus = event.status
+            self.resources = event.resources
+        else:
+            bb.event.fire_ui_handlers(event, self.d)
+
+    def kill(self):
+        # The agent kills the task when the connection goes away
+        try:
+            self.input.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
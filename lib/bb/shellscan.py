@@ -0,0 +1,597 @@
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+"""
+BitBake 'ShellScan' implementation
+
+Finds the commands shell code executes and the functions it defines, as
+bb.codeparser.ShellParser does with the pysh parser, in a single linear
+pass over the code.
+
+The scanner reads the same tokens as the pysh lexer, including its quirks
+(assignments are only recognised at the end of the input, reserved words
+anywhere, command substitutions only outside of double quotes, ...), and
+follows the choices the pysh grammar makes for the subset of shell found
+in metadata. Anything outside that subset, including code pysh rejects,
+raises Unsupported so the caller can fall back to pysh.
+"""
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import re
+import logging
+
+logger = logging.getLogger('BitBake.CodeParser')
+
+class Unsupported(Exception):
+    """
+    The code uses shell syntax the scanner doesn't handle the way pysh
+    does
+    """
+
+_OPERATORS = {
+    '&&' : 'AND_IF',
+    '||' : 'OR_IF',
+    ';;' : 'DSEMI',
+    '<<' : 'DLESS',
+    '>>' : 'DGREAT',
+    '<&' : 'LESSAND',
+    '>&' : 'GREATAND',
+    '<>' : 'LESSGREAT',
+    '<<-' : 'DLESSDASH',
+    '>|' : 'CLOBBER',
+    '&' : 'AMP',
+    ';' : 'COMMA',
+    '<' : 'LESS',
+    '>' : 'GREATER',
+    '(' : 'LPARENS',
+    ')' : 'RPARENS',
+}
+
+_PARTIAL_OPERATORS = set(op[:i] for op in _OPERATORS for i in range(1, len(op) + 1))
+
+_RESERVED = {
+    'if' : 'If',
+    'then' : 'Then',
+    'else' : 'Else',
+    'elif' : 'Elif',
+    'fi' : 'Fi',
+    'do' : 'Do',
+    'done' : 'Done',
+    'case' : 'Case',
+    'esac' : 'Esac',
+    'while' : 'While',
+    'until' : 'Until',
+    'for' : 'For',
+    '{' : 'Lbrace',
+    '}' : 'Rbrace',
+    '!' : 'Bang',
+    'in' : 'In',
+    '|' : 'PIPE',
+}
+
+_REDIRECTS = frozenset(('LESS', 'LESSAND', 'GREATER', 'GREATAND', 'DGREAT',
+                        'LESSGREAT', 'CLOBBER'))
+_HEREDOCS = frozenset(('DLESS', 'DLESSDASH'))
+_COMPOUNDS = frozenset(('Lbrace', 'LPARENS', 'For', 'Case', 'If', 'While', 'Until'))
+_COMMAND_STARTS = _COMPOUNDS | _REDIRECTS | _HEREDOCS | \
+                  frozenset(('TOKEN', 'ASSIGNMENT_WORD', 'IO_NUMBER'))
+# Reserved words taken as arguments of simple commands
+_SUFFIX_WORDS = frozenset(('TOKEN', 'For', 'Done', 'Do', 'Until', 'ASSIGNMENT_WORD',
+                           'If', 'Then', 'Bang', 'Fi'))
+
+_ORDINARY = re.compile(r"[^\n\\'\"`$&|;<>() \t]+")
+_NAME = re.compile(r"[0-9a-zA-Z_]*")
+_IS_NAME = re.compile(r"^[0-9a-zA-Z_]+$")
+_DIGITS = re.compile(r"^\d+$")
+_QUOTING = re.compile(r"[\\$`'\"]")
+_DQUOTE_SPECIAL = re.compile(r"[$\\`\"]")
+_COMMAND_SPECIAL = {
+    '`' : re.compile(r"[$\\`\"']"),
+    '$(' : re.compile(r"[$\\`\"')]"),
+}
+_PARAMETER_SPECIAL = re.compile(r"[$\\`\"'}]")
+_HEREDOC_LINE = re.compile(r"(?:[^\\\n]|\\[\s\S])*\\?")
+
+def _quoted(text, pos):
+    """
+    Read the quoted string or expansion starting at text[pos] as the pysh
+    word lexer does. Returns its text without line continuations, the
+    position following it, its kind ('`' and '$(' for command
+    substitutions) and for command substitutions, the command.
+    """
+    c = text[pos]
+    if c == "'":
+        end = text.find("'", pos + 1)
+        if end == -1:
+            raise Unsupported("Unterminated quoted string")
+        return text[pos:end + 1], end + 1, c, None
+    if c == '\\':
+        if pos + 1 >= len(text):
+            raise Unsupported("Unterminated escape")
+        if text[pos + 1] == '\n':
+            return '', pos + 2, c, None
+        return text[pos:pos + 2], pos + 2, c, None
+    if c == '"':
+        return _delimited(text, pos + 1, '"', _DQUOTE_SPECIAL, '"')
+    if c == '`':
+        return _delimited(text, pos + 1, '`', _COMMAND_SPECIAL['`'], '`')
+
+    # $
+    if pos + 1 >= len(text):
+        raise Unsupported("Unterminated expansion")
+    c = text[pos + 1]
+    if c == '(':
+        if pos + 2 >= len(text):
+            raise Unsupported("Unterminated expansion")
+        if text[pos + 2] == '(':
+            # pysh doesn't implement arithmetic expansion
+            raise Unsupported("Arithmetic expansion")
+        return _delimited(text, pos + 2, '$(', _COMMAND_SPECIAL['$('], ')')
+    if c == '{':
+        return _delimited(text, pos + 2, '${', _PARAMETER_SPECIAL, '}')
+    if c in '@*#?-$!0':
+        return text[pos:pos + 2], pos + 2, '$', None
+    end = _NAME.match(text, pos + 1).end()
+    return text[pos:end], end, '$', None
+
+def _delimited(text, pos, opening, special, closing):
+    inner = []
+    while True:
+        match = special.search(text, pos)
+        if not match:
+            raise Unsupported("Unterminated %s" % opening)
+        start = match.start()
+        inner.append(text[pos:start])
+        if text[start] == closing:
+            inner = ''.join(inner)
+            return opening + inner + closing, start + 1, opening, inner
+        part, pos = _quoted(text, start)[:2]
+        inner.append(part)
+
+def substitutions(word):
+    """
+    Return the commands of the command substitutions of a word which
+    aren't quoted or nested in other expansions
+    """
+    # pysh fails to read words ending with an unescaped $ again
+    if '`' not in word and '$(' not in word and not word.endswith('$'):
+        return []
+    commands = []
+    pos = 0
+    while True:
+        match = _QUOTING.search(word, pos)
+        if not match:
+            return commands
+        part, pos, kind, inner = _quoted(word, match.start())
+        if kind in ('`', '$('):
+            commands.append(inner)
+
+def _heredoc_name(word):
+    """
+    Remove the quotes from a here-document delimiter
+    """
+    name = []
+    pos = 0
+    while pos < len(word):
+        match = _QUOTING.search(word, pos)
+        if not match:
+            name.append(word[pos:])
+            break
+        start = match.start()
+        name.append(word[pos:start])
+        part, pos, kind, inner = _quoted(word, start)
+        if kind == "'":
+            name.append(part[1:-1])
+        elif kind == '"' and not _QUOTING.search(inner):
+            name.append(inner)
+        elif kind == '\\' and part:
+            name.append(part[1:])
+        else:
+            raise Unsupported("Here-document delimiter %s" % word)
+    return ''.join(name)
+
+class Lexer(object):
+    """
+    Split shell code into the (type, value) tokens the pysh lexer returns
+    """
+    def __init__(self):
+        self.tokens = []
+        self.for_count = None
+        self.heredoc_op = None
+        self.heredoc_name = None
+        # Tokens following a here-document operator on its line, they come
+        # after the here-document
+        self.pendings = []
+        self.heredoc_pending = False
+
+    def push(self, value, type, delim):
+        if not value:
+            return
+
+        if self.heredoc_op is not None:
+            if self.heredoc_name is None:
+                if type != 'TOKEN':
+                    raise Unsupported("Expecting here-document name, got '%s'" % value)
+                self.heredoc_name = _heredoc_name(value)
+                type = 'HERENAME'
+            else:
+                if type == 'NEWLINE':
+                    self.heredoc_pending = True
+                self.pendings.append((value, type, delim))
+                return
+
+        if type == 'OP':
+            op = _OPERATORS.get(value)
+            if op is None:
+                type = 'TOKEN'
+            else:
+                type = op
+                if value in ('<<', '<<-'):
+                    self.heredoc_op = value
+
+        if type == 'TOKEN':
+            if '=' in value and not delim:
+                if not value.startswith('=') and _IS_NAME.match(value[:value.find('=')]):
+                    type = 'ASSIGNMENT_WORD'
+            else:
+                reserved = _RESERVED.get(value)
+                if reserved is not None:
+                    if reserved != 'In' or self.for_count == 2:
+                        type = reserved
+                        if reserved in ('For', 'Case'):
+                            self.for_count = 0
+                elif delim in ('<', '>') and _DIGITS.match(value):
+                    type = 'IO_NUMBER'
+        elif type == 'COMMENT':
+            return
+
+        if self.for_count is not None:
+            self.for_count += 1
+            if self.for_count == 3:
+                self.for_count = None
+
+        self.tokens.append((type, value))
+
+    def heredoc(self, text, pos):
+        """
+        Read the here-document starting at text[pos], then push the tokens
+        which followed its operator
+        """
+        if pos >= len(text):
+            raise Unsupported("Missing here-document")
+        content = []
+        while True:
+            end = _HEREDOC_LINE.match(text, pos).end()
+            line = text[pos:end]
+            if end < len(text):
+                eol = '\n'
+                pos = end + 1
+            else:
+                eol = ''
+                pos = end
+            if self.heredoc_op == '<<-':
+                line = line.lstrip('\t')
+            if line == self.heredoc_name:
+                break
+            content.append(line)
+            content.append(eol)
+            if not eol:
+                break
+
+        content = ''.join(content)
+        if not content:
+            raise Unsupported("Empty here-document")
+        pendings = self.pendings
+        name = self.heredoc_name
+        self.heredoc_op = self.heredoc_name = None
+        self.pendings = []
+        self.heredoc_pending = False
+        self.push(content, 'TOKEN', name)
+        for value, type, delim in pendings:
+            self.push(value, type, delim)
+        return pos
+
+    def lex(self, text):
+        pos = 0
+        end = len(text)
+        token = []
+        while pos < end:
+            c = text[pos]
+            if c == '\n':
+                self.push(''.join(token), 'TOKEN', c)
+                token = []
+                self.push(c, 'NEWLINE', '')
+                pos += 1
+                while self.heredoc_pending:
+                    pos = self.heredoc(text, pos)
+            elif c in '\\\'"`$':
+                part, pos = _quoted(text, pos)[:2]
+                token.append(part)
+            elif c in '&|;<>()':
+                self.push(''.join(token), 'TOKEN', c)
+                token = []
+                op = c
+                pos += 1
+                while pos < end and op + text[pos] in _PARTIAL_OPERATORS:
+                    op += text[pos]
+                    pos += 1
+                self.push(op, 'OP', text[pos:pos + 1])
+            elif c in ' \t':
+                self.push(''.join(token), 'TOKEN', c)
+                token = []
+                pos += 1
+            elif c == '#' and not ''.join(token):
+                newline = text.find('\n', pos)
+                if newline == -1:
+                    raise Unsupported("Comment at end of input")
+                self.push(text[pos + 1:newline], 'COMMENT', '\n')
+                pos = newline
+            else:
+                match = _ORDINARY.match(text, pos)
+                token.append(match.group())
+                pos = match.end()
+
+        self.push(''.join(token), 'TOKEN', '')
+        if self.heredoc_op is not None:
+            raise Unsupported("Missing here-document delimiter")
+        return self.tokens
+
+class Scanner(object):
+    """
+    Collect the commands executed and the functions defined by shell code,
+    including code run through command substitutions and eval
+    """
+    def __init__(self):
+        self.execs = set()
+        self.funcdefs = set()
+
+    def scan(self, text):
+        self.tokens = Lexer().lex(text)
+        self.pos = 0
+        self.program()
+
+    def next(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos][0]
+        return None
+
+    def take(self, *types):
+        if self.next() not in types:
+            raise Unsupported("Unexpected %s" % (self.next(),))
+        value = self.tokens[self.pos][1]
+        self.pos += 1
+        return value
+
+    def linebreak(self):
+        while self.next() == 'NEWLINE':
+            self.pos += 1
+
+    def program(self):
+        self.linebreak()
+        while self.next() is not None:
+            self.and_or()
+            if self.next() == 'COMMA':
+                self.pos += 1
+                self.linebreak()
+            elif self.next() == 'NEWLINE':
+                self.linebreak()
+            elif self.next() is not None:
+                raise Unsupported("Unexpected %s" % self.next())
+
+    def and_or(self):
+        self.pipeline()
+        while self.next() in ('AND_IF', 'OR_IF'):
+            self.pos += 1
+            self.linebreak()
+            self.pipeline()
+
+    def pipeline(self):
+        if self.next() == 'Bang':
+            self.pos += 1
+        self.command()
+        while self.next() == 'PIPE':
+            self.pos += 1
+            self.linebreak()
+            self.command()
+
+    def compound_list(self, *closers):
+        """
+        Parse commands up to one of closers, returns the closer found
+        """
+        self.linebreak()
+        while True:
+            self.and_or()
+            if self.next() == 'COMMA':
+                self.pos += 1
+                self.linebreak()
+            elif self.next() == 'NEWLINE':
+                self.linebreak()
+            else:
+                break
+            if self.next() in closers:
+                break
+        closer = self.next()
+        self.take(*closers)
+        return closer
+
+    def command(self):
+        type = self.next()
+        if type in _COMPOUNDS:
+            self.compound_command()
+            while self.redirect():
+                pass
+        elif type == 'TOKEN' and self.pos + 1 < len(self.tokens) and \
+             self.tokens[self.pos + 1][0] == 'LPARENS':
+            self.function_definition()
+        elif type in _COMMAND_STARTS:
+            self.simple_command()
+        else:
+            raise Unsupported("Unexpected %s" % (type,))
+
+    def compound_command(self):
+        type = self.next()
+        self.pos += 1
+        if type == 'Lbrace':
+            self.compound_list('Rbrace')
+        elif type == 'LPARENS':
+            self.compound_list('RPARENS')
+        elif type == 'For':
+            self.take('TOKEN', 'Fi')
+            self.linebreak()
+            self.take('In')
+            items = []
+            while self.next() in ('TOKEN', 'Fi'):
+                items.append(('TOKEN', self.take('TOKEN', 'Fi')))
+            self.take('COMMA', 'NEWLINE')
+            self.linebreak()
+            self.take('Do')
+            self.compound_list('Done')
+            self.words(items, [])
+        elif type == 'Case':
+            self.take('TOKEN', 'Fi')
+            self.linebreak()
+            self.take('In')
+            self.linebreak()
+            while self.next() != 'Esac':
+                if self.next() == 'LPARENS':
+                    self.pos += 1
+                patterns = [('TOKEN', self.take('TOKEN', 'Fi'))]
+                while self.next() == 'PIPE':
+                    self.pos += 1
+                    patterns.append(('TOKEN', self.take('TOKEN', 'Fi')))
+                self.take('RPARENS')
+                self.linebreak()
+                if self.next() in ('DSEMI', 'Esac'):
+                    closer = self.next()
+                    self.pos += 1
+                else:
+                    closer = self.compound_list('DSEMI', 'Esac')
+                self.words(patterns, [])
+                if closer == 'Esac':
+                    return
+                self.linebreak()
+            self.pos += 1
+        elif type == 'If':
+            self.compound_list('Then')
+            closer = self.compound_list('Elif', 'Else', 'Fi')
+            while closer == 'Elif':
+                self.compound_list('Then')
+                closer = self.compound_list('Elif', 'Else', 'Fi')
+            if closer == 'Else':
+                self.compound_list('Fi')
+        else:
+            # while and until loops
+            self.compound_list('Do')
+            self.compound_list('Done')
+
+    def function_definition(self):
+        name = self.take('TOKEN')
+        self.take('LPARENS')
+        self.take('RPARENS')
+        self.linebreak()
+        if self.next() not in _COMPOUNDS:
+            raise Unsupported("Function body")
+        self.compound_command()
+        if self.redirect():
+            raise Unsupported("Function redirections")
+        self.funcdefs.add(name)
+
+    def redirect(self):
+        """
+        Skip an IO redirection, returns False if there is none
+        """
+        start = self.pos
+        if self.next() == 'IO_NUMBER':
+            self.pos += 1
+        type = self.next()
+        if type in _REDIRECTS:
+            self.pos += 1
+            self.take('TOKEN')
+        elif type in _HEREDOCS:
+            self.pos += 1
+            self.take('HERENAME')
+            self.take('TOKEN')
+        elif self.pos != start:
+            raise Unsupported("IO number without redirection")
+        else:
+            return False
+        return True
+
+    def simple_command(self):
+        words = []
+        assigns = []
+        prefix = False
+        while True:
+            if self.next() == 'ASSIGNMENT_WORD':
+                assigns.append(tuple(self.take('ASSIGNMENT_WORD').split('=', 1)))
+            elif not self.redirect():
+                break
+            prefix = True
+
+        if self.next() == 'TOKEN':
+            words.append(('cmd_word' if prefix else 'cmd_name', self.take('TOKEN')))
+            while True:
+                if self.next() in _SUFFIX_WORDS:
+                    words.append(('TOKEN', self.tokens[self.pos][1]))
+                    self.pos += 1
+                elif not self.redirect():
+                    break
+        elif self.next() == 'Fi' and prefix:
+            raise Unsupported("Ambiguous fi")
+        self.words(words, assigns)
+
+    def words(self, words, assigns):
+        """
+        Find the commands run by a simple command, or by the expansions of
+        the words of compound commands, as ShellParser.process_words() does
+        """
+        words = words + assigns
+        for word in list(words):
+            for command in substitutions(word[1]):
+                self.scan_nested(command)
+                if word[0] in ("cmd_name", "cmd_word") and word in words:
+                    words.remove(word)
+
+        usetoken = False
+        for word in words:
+            if word[0] in ("cmd_name", "cmd_word") or \
+               (usetoken and word[0] == "TOKEN"):
+                if "=" in word[1]:
+                    usetoken = True
+                    continue
+
+                cmd = word[1]
+                if cmd.startswith("$"):
+                    logger.debug(1, "Warning: execution of non-literal "
+                                    "command '%s'", cmd)
+                elif cmd == "eval":
+                    self.scan_nested(" ".join(word for _, word in words[1:]))
+                else:
+                    self.execs.add(cmd)
+                break
+
+    def scan_nested(self, text):
+        nested = Scanner()
+        nested.scan(text)
+        self.execs |= nested.execs
+        self.funcdefs |= nested.funcdefs
+
+def scan(text):
+    """
+    Return the sets of commands executed and of functions defined by the
+    shell code text. Raises Unsupported if it can't be done without pysh.
+    """
+    scanner = Scanner()
+    scanner.scan(text)
+    return scanner.execs, scanner.funcdefs
@@ -35,7 +35,7 @@ class SignatureGenerator(object):
     def __init__(self, data):
         return
 
-    def finalise(self, fn, d, varient):
+    def finalise(self, fn, d, varient, base = None):
         return
 
     def get_taskhash(self, fn, task, deps, dataCache):
@@ -67,9 +67,9 @@ class SignatureGeneratorBasic(SignatureGenerator):
         else:
             self.twl = None
 
-    def _build_data(self, fn, d):
+    def _build_data(self, fn, d, base = None):
 
-        tasklist, gendeps = bb.data.generate_dependencies(d)
+        tasklist, gendeps = bb.data.generate_dependencies(d, base)
 
         taskdeps = {}
         basehash = {}
@@ -112,12 +112,12 @@ class SignatureGeneratorBasic(SignatureGenerator):
 
         return taskdeps
 
-    def finalise(self, fn, d, variant):
+    def finalise(self, fn, d, variant, base = None):
 
         if variant:
             fn = "virtual:" + variant + ":" + fn
 
-        taskdeps = self._build_data(fn, d)
+        taskdeps = self._build_data(fn, d, base)
 
         #Slow but can be useful for debugging mismatched basehashes
         #for task in self.taskdeps[fn]:
@@ -129,18 +129,20 @@ class SignatureGeneratorBasic(SignatureGenerator):
     def get_taskhash(self, fn, task, deps, dataCache):
         k = fn + "." + task
         data = dataCache.basetaskhash[k]
-        self.runtaskdeps[k] = []
+        runtaskdeps = []
+        # We only manipulate the dependencies for packages not in the whitelist
+        filterdeps = self.twl and not self.twl.search(dataCache.pkg_fn[fn])
         for dep in sorted(deps):
-            # We only manipulate the dependencies for packages not in the whitelist
-            if self.twl and not self.twl.search(dataCache.pkg_fn[fn]):
+            if filterdeps:
                 # then process the actual dependencies
-                dep_fn = re.search("(?P<fn>.*)\..*", dep).group('fn')
+                dep_fn = dep.rsplit(".", 1)[0]
                 if self.twl.search(dataCache.pkg_fn[dep_fn]):
                     continue
             if dep not in self.taskhash:
                 bb.fatal("%s is not in taskhash, caller isn't calling in dependency order?", dep)
-            data = data + self.taskhash[dep]
-            self.runtaskdeps[k].append(dep)
+            runtaskdeps.append(dep)
+        self.runtaskdeps[k] = runtaskdeps
+        data = data + "".join([self.taskhash[dep] for dep in runtaskdeps])
         h = hashlib.md5(data).hexdigest()
         self.taskhash[k] = h
         #d.setVar("BB_TASKHASH_task-%s" % task, taskhash[task])
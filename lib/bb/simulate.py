@@ -0,0 +1,257 @@
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+"""
+BitBake 'Simulate' implementation
+
+Predicts how a build would go by replaying task durations against a
+prepared runqueue with a given scheduler and number of threads, without
+running anything. Used by "bitbake --simulate".
+
+Durations come from the task statistics database (see bb.taskstats),
+averaged over the successful runs of each recipe's task. Tasks without
+recorded runs take the average for tasks of the same name, or
+BB_SIMULATE_DEFAULT_DURATION seconds (default 60) if there is none.
+
+BB_SIMULATE_THREADS and BB_SIMULATE_SCHEDULERS list the thread counts and
+schedulers to compare, by default BB_NUMBER_THREADS and BB_SCHEDULER.
+"""
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import heapq
+import logging
+import bb.data
+import bb.runqueue
+import bb.taskstats
+
+logger = logging.getLogger("BitBake.Simulate")
+
+def task_durations(rqdata, d):
+    """
+    Return the expected duration of every task in the runqueue and the
+    number of tasks for which a duration was recorded
+    """
+    recorded = {}
+    stats = bb.taskstats.TaskStats.from_metadata(d)
+    if stats:
+        recorded = stats.average_durations()
+
+    default = float(bb.data.getVar("BB_SIMULATE_DEFAULT_DURATION", d, True) or 60)
+    bytask = {}
+    for (pn, taskname), wall in recorded.iteritems():
+        bytask.setdefault(taskname, []).append(wall)
+    for taskname in bytask:
+        bytask[taskname] = sum(bytask[taskname]) / len(bytask[taskname])
+
+    durations = []
+    known = 0
+    for task in xrange(len(rqdata.runq_fnid)):
+        fn = rqdata.taskData.fn_index[rqdata.runq_fnid[task]]
+        taskname = rqdata.runq_task[task]
+        key = (rqdata.dataCache.pkg_fn[fn], taskname)
+        if key in recorded:
+            durations.append(recorded[key])
+            known = known + 1
+        else:
+            durations.append(bytask.get(taskname, default))
+    return durations, known
+
+def critical_path(rqdata, durations):
+    """
+    Return the total duration and the tasks of the longest chain of
+    dependent tasks, a lower bound on the build time whatever the number
+    of threads
+    """
+    finish = [0.0] * len(durations)
+    previous = [None] * len(durations)
+    for task in rqdata.graph.order:
+        start = 0.0
+        for dep in rqdata.graph.depends(task):
+            if finish[dep] > start:
+                start = finish[dep]
+                previous[task] = dep
+        finish[task] = start + durations[task]
+
+    if not finish:
+        return 0.0, []
+    task = max(xrange(len(finish)), key=finish.__getitem__)
+    path = []
+    while task is not None:
+        path.append(task)
+        task = previous[task]
+    path.reverse()
+    return finish[path[-1]], path
+
+class SimulatedExecute(object):
+    """
+    Stands in for RunQueueExecuteTasks so the real schedulers can pick the
+    tasks to run
+    """
+    def __init__(self, rqdata, threads):
+        numtasks = len(rqdata.runq_fnid)
+        self.rqdata = rqdata
+        self.number_tasks = threads
+        self.stats = bb.runqueue.RunQueueStats(numtasks)
+        self.runq_running = [0] * numtasks
+        self.runq_complete = [0] * numtasks
+        self.runq_buildable = [0] * numtasks
+        self.remaining = [len(rqdata.runq_depends[task]) for task in xrange(numtasks)]
+        for task in xrange(numtasks):
+            if not self.remaining[task]:
+                self.runq_buildable[task] = 1
+
+class Simulation(object):
+    def __init__(self, rqdata, scheduler, threads, durations):
+        self.rqdata = rqdata
+        self.scheduler = scheduler
+        self.threads = threads
+        self.durations = durations
+        self.makespan = 0.0
+        # (time, number of running tasks) whenever it changes
+        self.timeline = []
+
+    def run(self):
+        rqdata = self.rqdata
+        exe = SimulatedExecute(rqdata, self.threads)
+        sched = self.scheduler(exe, rqdata)
+
+        # Schedulers which only reorder prio_map pick the first buildable
+        # task in it, which a heap ordered by position finds without
+        # scanning the whole map each time
+        ready = None
+        if type(sched).next is bb.runqueue.RunQueueScheduler.next and \
+           type(sched).next_buildable_task is bb.runqueue.RunQueueScheduler.next_buildable_task:
+            rank = [0] * len(sched.prio_map)
+            for position, task in enumerate(sched.prio_map):
+                rank[task] = position
+            ready = [rank[task] for task in xrange(len(rank)) if exe.runq_buildable[task]]
+            heapq.heapify(ready)
+
+        now = 0.0
+        running = []
+        while True:
+            while exe.stats.active < self.threads:
+                if ready is not None:
+                    if not ready:
+                        break
+                    task = sched.prio_map[heapq.heappop(ready)]
+                else:
+                    task = sched.next()
+                    if task is None:
+                        break
+                exe.runq_running[task] = 1
+                exe.stats.taskActive()
+                heapq.heappush(running, (now + self.durations[task], task))
+
+            if not self.timeline or self.timeline[-1][1] != exe.stats.active:
+                self.timeline.append((now, exe.stats.active))
+            if not running:
+                break
+
+            now, task = heapq.heappop(running)
+            exe.stats.taskCompleted()
+            exe.runq_complete[task] = 1
+            for revdep in rqdata.runq_revdeps[task]:
+                exe.remaining[revdep] = exe.remaining[revdep] - 1
+                if not exe.remaining[revdep]:
+                    exe.runq_buildable[revdep] = 1
+                    if ready is not None:
+                        heapq.heappush(ready, rank[revdep])
+
+        if exe.stats.completed != exe.stats.total:
+            logger.warn("Scheduler %s left %d tasks unscheduled", self.scheduler.name,
+                        exe.stats.total - exe.stats.completed)
+        self.makespan = now
+        return self
+
+    def utilisation(self):
+        """
+        Average fraction of the threads in use over the whole build
+        """
+        if not self.makespan:
+            return 0.0
+        return sum(self.durations) / (self.makespan * self.threads)
+
+    def busy_intervals(self, count):
+        """
+        Split the build into count intervals and return the average number
+        of running tasks during each
+        """
+        if not self.makespan:
+            return []
+        width = self.makespan / count
+        busy = [0.0] * count
+        steps = self.timeline + [(self.makespan, 0)]
+        for i in xrange(len(steps) - 1):
+            start, active = steps[i]
+            end = steps[i + 1][0]
+            while start < end and active:
+                bucket = min(int(start / width), count - 1)
+                upto = min(end, (bucket + 1) * width)
+                if upto <= start:
+                    upto = end
+                busy[bucket] = busy[bucket] + (upto - start) * active
+                start = upto
+        return [total / width for total in busy]
+
+def format_duration(seconds):
+    return "%d:%02d:%02d" % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+def simulate(rqdata, d):
+    """
+    Simulate the runqueue for each combination of BB_SIMULATE_THREADS and
+    BB_SIMULATE_SCHEDULERS and report the results
+    """
+    threads = (bb.data.getVar("BB_SIMULATE_THREADS", d, True) or
+               bb.data.getVar("BB_NUMBER_THREADS", d, True) or "1").split()
+    names = (bb.data.getVar("BB_SIMULATE_SCHEDULERS", d, True) or
+             bb.data.getVar("BB_SCHEDULER", d, True) or "speed").split()
+    schedulers = dict((obj.name, obj) for obj in bb.runqueue.get_schedulers(d))
+    for name in names:
+        if name not in schedulers:
+            bb.fatal("Invalid scheduler '%s'.  Available schedulers: %s" %
+                     (name, ", ".join(schedulers)))
+
+    durations, known = task_durations(rqdata, d)
+    total = sum(durations)
+    pathlength, path = critical_path(rqdata, durations)
+
+    lines = ["Simulated %d tasks (%d with recorded durations), %s of work" %
+             (len(durations), known, format_duration(total))]
+    lines.append("Critical path %s:" % format_duration(pathlength))
+    for task in path:
+        lines.append("  %10s  %s" % (format_duration(durations[task]), rqdata.get_user_idstring(task)))
+
+    results = []
+    for name in names:
+        for count in threads:
+            results.append(Simulation(rqdata, schedulers[name], int(count), durations).run())
+
+    lines.append("")
+    lines.append("  %-12s %7s %10s %11s" % ("scheduler", "threads", "time", "utilisation"))
+    for result in results:
+        lines.append("  %-12s %7d %10s %10.0f%%" % (result.scheduler.name, result.threads,
+                                                   format_duration(result.makespan),
+                                                   result.utilisation() * 100))
+
+    for result in results:
+        lines.append("")
+        lines.append("Running tasks over time, %s scheduler with %d threads:" % (result.scheduler.name, result.threads))
+        for i, busy in enumerate(result.busy_intervals(20)):
+            bar = int(round(busy * 40 / result.threads))
+            lines.append("  %10s |%-40s| %.1f" % (format_duration(i * result.makespan / 20),
+                                                  "#" * bar, busy))
+
+    logger.info("\n".join(lines))
+    return results
@@ -45,11 +45,18 @@ class TaskData:
         self.build_names_index = []
         self.run_names_index = []
         self.fn_index = []
+        # Reverse maps of the above, name -> ID
+        self.build_names_lookup = {}
+        self.run_names_lookup = {}
+        self.fn_lookup = {}
 
         self.build_targets = {}
         self.run_targets = {}
+        # The build and runtime targets each fnid provides
+        self.fn_build_targets = {}
+        self.fn_run_targets = {}
 
-        self.external_targets = []
+        self.external_targets = set()
 
         self.tasks_fnid = []
         self.tasks_name = []
@@ -60,12 +67,17 @@ class TaskData:
 
         self.depids = {}
         self.rdepids = {}
+        # The fnids depending on each build/runtime target and the tasks
+        # with a 'depends' flag on each build target
+        self.dependees = {}
+        self.rdependees = {}
+        self.idependees = {}
 
-        self.consider_msgs_cache = []
+        self.consider_msgs_cache = set()
 
-        self.failed_deps = []
-        self.failed_rdeps = []
-        self.failed_fnids = []
+        self.failed_deps = set()
+        self.failed_rdeps = set()
+        self.failed_fnids = set()
 
         self.abort = abort
         self.tryaltconfigs = tryaltconfigs
@@ -75,33 +87,36 @@ class TaskData:
         Return an ID number for the build target name.
         If it doesn't exist, create one.
         """
-        if not name in self.build_names_index:
-            self.build_names_index.append(name)
-            return len(self.build_names_index) - 1
+        if name in self.build_names_lookup:
+            return self.build_names_lookup[name]
 
-        return self.build_names_index.index(name)
+        self.build_names_index.append(name)
+        self.build_names_lookup[name] = len(self.build_names_index) - 1
+        return self.build_names_lookup[name]
 
     def getrun_id(self, name):
         """
         Return an ID number for the run target name.
         If it doesn't exist, create one.
         """
-        if not name in self.run_names_index:
-            self.run_names_index.append(name)
-            return len(self.run_names_index) - 1
+        if name in self.run_names_lookup:
+            return self.run_names_lookup[name]
 
-        return self.run_names_index.index(name)
+        self.run_names_index.append(name)
+        self.run_names_lookup[name] = len(self.run_names_index) - 1
+        return self.run_names_lookup[name]
 
     def getfn_id(self, name):
         """
         Return an ID number for the filename.
         If it doesn't exist, create one.
         """
-        if not name in self.fn_index:
-            self.fn_index.append(name)
-            return len(self.fn_index) - 1
+        if name in self.fn_lookup:
+            return self.fn_lookup[name]
 
-        return self.fn_index.index(name)
+        self.fn_index.append(name)
+        self.fn_lookup[name] = len(self.fn_index) - 1
+        return self.fn_lookup[name]
 
     def gettask_ids(self, fnid):
         """
@@ -154,7 +169,7 @@ class TaskData:
             bb.msg.fatal(bb.msg.domain.TaskData, "Trying to re-add a failed file? Something is broken...")
 
         # Check if we've already seen this fn
-        if fnid in self.tasks_fnid:
+        if fnid in self.tasks_lookup:
             return
 
         for task in task_deps['tasks']:
@@ -174,7 +189,9 @@ class TaskData:
                     if dep:
                         if ":" not in dep:
                             bb.msg.fatal(bb.msg.domain.TaskData, "Error, dependency %s does not contain ':' character\n. Task 'depends' should be specified in the form 'packagename:task'" % (dep, fn))
-                        ids.append(((self.getbuild_id(dep.split(":")[0])), dep.split(":")[1]))
+                        depid = self.getbuild_id(dep.split(":")[0])
+                        ids.append((depid, dep.split(":")[1]))
+                        self.idependees.setdefault(depid, set()).add(taskid)
                 self.tasks_idepends[taskid].extend(ids)
 
         # Work out build dependencies
@@ -184,6 +201,8 @@ class TaskData:
                 logger.debug(2, "Added dependency %s for %s", depend, fn)
                 dependids[self.getbuild_id(depend)] = None
             self.depids[fnid] = dependids.keys()
+            for depid in dependids:
+                self.dependees.setdefault(depid, set()).add(fnid)
 
         # Work out runtime dependencies
         if not fnid in self.rdepids:
@@ -199,6 +218,8 @@ class TaskData:
                     logger.debug(2, "Added runtime recommendation %s for %s", rdepend, fn)
                     rdependids[self.getrun_id(rdepend)] = None
             self.rdepids[fnid] = rdependids.keys()
+            for rdepid in rdependids:
+                self.rdependees.setdefault(rdepid, set()).add(fnid)
 
         for dep in self.depids[fnid]:
             if dep in self.failed_deps:
@@ -241,8 +262,9 @@ class TaskData:
             if fnid in self.build_targets[targetid]:
                 return
             self.build_targets[targetid].append(fnid)
-            return
-        self.build_targets[targetid] = [fnid]
+        else:
+            self.build_targets[targetid] = [fnid]
+        self.fn_build_targets.setdefault(fnid, []).append(targetid)
 
     def add_runtime_target(self, fn, item):
         """
@@ -256,8 +278,9 @@ class TaskData:
             if fnid in self.run_targets[targetid]:
                 return
             self.run_targets[targetid].append(fnid)
-            return
-        self.run_targets[targetid] = [fnid]
+        else:
+            self.run_targets[targetid] = [fnid]
+        self.fn_run_targets.setdefault(fnid, []).append(targetid)
 
     def mark_external_target(self, item):
         """
@@ -265,8 +288,7 @@ class TaskData:
         """
         targetid = self.getbuild_id(item)
 
-        if targetid not in self.external_targets:
-            self.external_targets.append(targetid)
+        self.external_targets.add(targetid)
 
     def get_unresolved_build_targets(self, dataCache):
         """
@@ -274,12 +296,10 @@ class TaskData:
         are unknown.
         """
         unresolved = []
-        for target in self.build_names_index:
-            if re_match_strings(target, dataCache.ignored_dependencies):
-                continue
-            if self.build_names_index.index(target) in self.failed_deps:
+        for targetid, target in enumerate(self.build_names_index):
+            if targetid in self.failed_deps or targetid in self.build_targets:
                 continue
-            if not self.have_build_target(target):
+            if not re_match_strings(target, dataCache.ignored_dependencies):
                 unresolved.append(target)
         return unresolved
 
@@ -289,12 +309,10 @@ class TaskData:
         are unknown.
         """
         unresolved = []
-        for target in self.run_names_index:
-            if re_match_strings(target, dataCache.ignored_dependencies):
+        for targetid, target in enumerate(self.run_names_index):
+            if targetid in self.failed_rdeps or targetid in self.run_targets:
                 continue
-            if self.run_names_index.index(target) in self.failed_rdeps:
-                continue
-            if not self.have_runtime_target(target):
+            if not re_match_strings(target, dataCache.ignored_dependencies):
                 unresolved.append(target)
         return unresolved
 
@@ -310,43 +328,27 @@ class TaskData:
         """
         Return a list of targets which depend on item
         """
-        dependees = []
-        for fnid in self.depids:
-            if itemid in self.depids[fnid]:
-                dependees.append(fnid)
-        return dependees
+        return sorted(self.dependees.get(itemid, ()))
 
     def get_dependees_str(self, item):
         """
         Return a list of targets which depend on item as a user readable string
         """
         itemid = self.getbuild_id(item)
-        dependees = []
-        for fnid in self.depids:
-            if itemid in self.depids[fnid]:
-                dependees.append(self.fn_index[fnid])
-        return dependees
+        return [self.fn_index[fnid] for fnid in self.get_dependees(itemid)]
 
     def get_rdependees(self, itemid):
         """
         Return a list of targets which depend on runtime item
         """
-        dependees = []
-        for fnid in self.rdepids:
-            if itemid in self.rdepids[fnid]:
-                dependees.append(fnid)
-        return dependees
+        return sorted(self.rdependees.get(itemid, ()))
 
     def get_rdependees_str(self, item):
         """
         Return a list of targets which depend on runtime item as a user readable string
         """
         itemid = self.getrun_id(item)
-        dependees = []
-        for fnid in self.rdepids:
-            if itemid in self.rdepids[fnid]:
-                dependees.append(self.fn_index[fnid])
-        return dependees
+        return [self.fn_index[fnid] for fnid in self.get_rdependees(itemid)]
 
     def add_provider(self, cfgData, dataCache, item):
         try:
@@ -390,7 +392,7 @@ class TaskData:
                 for fn in eligible:
                     providers_list.append(dataCache.pkg_fn[fn])
                 bb.event.fire(bb.event.MultipleProviders(item, providers_list), cfgData)
-            self.consider_msgs_cache.append(item)
+            self.consider_msgs_cache.add(item)
 
         for fn in eligible:
             fnid = self.getfn_id(fn)
@@ -434,7 +436,7 @@ class TaskData:
                 for fn in eligible:
                     providers_list.append(dataCache.pkg_fn[fn])
                 bb.event.fire(bb.event.MultipleProviders(item, providers_list, runtime=True), cfgData)
-            self.consider_msgs_cache.append(item)
+            self.consider_msgs_cache.add(item)
 
         if numberPreferred > 1:
             if item not in self.consider_msgs_cache:
@@ -442,7 +444,7 @@ class TaskData:
                 for fn in eligible:
                     providers_list.append(dataCache.pkg_fn[fn])
                 bb.event.fire(bb.event.MultipleProviders(item, providers_list, runtime=True), cfgData)
-            self.consider_msgs_cache.append(item)
+            self.consider_msgs_cache.add(item)
 
         # run through the list until we find one that we can build
         for fn in eligible:
@@ -463,17 +465,15 @@ class TaskData:
         if fnid in self.failed_fnids:
             return
         logger.debug(1, "File '%s' is unbuildable, removing...", self.fn_index[fnid])
-        self.failed_fnids.append(fnid)
-        for target in self.build_targets:
-            if fnid in self.build_targets[target]:
-                self.build_targets[target].remove(fnid)
-                if len(self.build_targets[target]) == 0:
-                    self.remove_buildtarget(target, missing_list)
-        for target in self.run_targets:
-            if fnid in self.run_targets[target]:
-                self.run_targets[target].remove(fnid)
-                if len(self.run_targets[target]) == 0:
-                    self.remove_runtarget(target, missing_list)
+        self.failed_fnids.add(fnid)
+        for target in self.fn_build_targets.pop(fnid, []):
+            self.build_targets[target].remove(fnid)
+            if len(self.build_targets[target]) == 0:
+                self.remove_buildtarget(target, missing_list)
+        for target in self.fn_run_targets.pop(fnid, []):
+            self.run_targets[target].remove(fnid)
+            if len(self.run_targets[target]) == 0:
+                self.remove_runtarget(target, missing_list)
 
     def remove_buildtarget(self, targetid, missing_list = []):
         """
@@ -485,15 +485,12 @@ class TaskData:
         else:
             missing_list = [self.build_names_index[targetid]] + missing_list
         logger.verbose("Target '%s' is unbuildable, removing...\nMissing or unbuildable dependency chain was: %s", self.build_names_index[targetid], missing_list)
-        self.failed_deps.append(targetid)
+        self.failed_deps.add(targetid)
         dependees = self.get_dependees(targetid)
         for fnid in dependees:
             self.fail_fnid(fnid, missing_list)
-        for taskid in xrange(len(self.tasks_idepends)):
-            idepends = self.tasks_idepends[taskid]
-            for (idependid, idependtask) in idepends:
-                if idependid == targetid:
-                    self.fail_fnid(self.tasks_fnid[taskid], missing_list)
+        for taskid in sorted(self.idependees.get(targetid, ())):
+            self.fail_fnid(self.tasks_fnid[taskid], missing_list)
 
         if self.abort and targetid in self.external_targets:
             target = self.build_names_index[targetid]
@@ -511,7 +508,7 @@ class TaskData:
             missing_list = [self.run_names_index[targetid]] + missing_list
 
         logger.info("Runtime target '%s' is unbuildable, removing...\nMissing or unbuildable dependency chain was: %s", self.run_names_index[targetid], missing_list)
-        self.failed_rdeps.append(targetid)
+        self.failed_rdeps.add(targetid)
         dependees = self.get_rdependees(targetid)
         for fnid in dependees:
             self.fail_fnid(fnid, missing_list)
@@ -0,0 +1,203 @@
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+"""
+BitBake 'TaskStats' implementation
+
+Records how long each task of a build took and the resources it used in
+an sqlite database (bb_taskstats.sqlite3 in PERSISTENT_DIR or CACHE) and
+summarises the results. Setting BB_TASKSTATS = "0" disables recording.
+"""
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import os
+import time
+import logging
+import bb.data
+import bb.utils
+import bb.persist_data
+
+logger = logging.getLogger("BitBake.TaskStats")
+
+def resources(start, rusage):
+    """
+    Turn the start time of a task and the rusage returned by os.wait4()
+    into the dict carried by the runqueue task events
+    """
+    return {
+        "start" : start,
+        "wall" : time.time() - start,
+        "utime" : rusage.ru_utime,
+        "stime" : rusage.ru_stime,
+        "maxrss" : rusage.ru_maxrss,
+        # Linux counts blocks of 512 bytes
+        "readbytes" : rusage.ru_inblock * 512,
+        "writebytes" : rusage.ru_oublock * 512,
+    }
+
+def statsfile(d):
+    cachedir = (bb.data.getVar("PERSISTENT_DIR", d, True) or
+                bb.data.getVar("CACHE", d, True))
+    if not cachedir:
+        return None
+    return os.path.join(cachedir, "bb_taskstats.sqlite3")
+
+class TaskStats(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = bb.persist_data.connect(filename)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS builds("
+                                "id INTEGER PRIMARY KEY, targets TEXT, "
+                                "start REAL, end REAL, result TEXT);")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS tasks("
+                                "build INTEGER, taskid INTEGER, fn TEXT, "
+                                "pn TEXT, task TEXT, deps TEXT, exitcode INTEGER, "
+                                "start REAL, wall REAL, utime REAL, stime REAL, "
+                                "maxrss INTEGER, readbytes INTEGER, writebytes INTEGER);")
+        self.build = None
+
+    @classmethod
+    def from_metadata(cls, d):
+        """
+        Return a TaskStats for the configuration or None if recording is
+        disabled or there is nowhere to store the database
+        """
+        if bb.data.getVar("BB_TASKSTATS", d, True) == "0":
+            return None
+        filename = statsfile(d)
+        if not filename:
+            return None
+        bb.utils.mkdirhier(os.path.dirname(filename))
+        return cls(filename)
+
+    def start_build(self, targets):
+        with self.connection:
+            cursor = self.connection.execute("INSERT INTO builds(targets, start) VALUES (?, ?);",
+                                             (" ".join(targets), time.time()))
+        self.build = cursor.lastrowid
+
+    def end_build(self, result):
+        if self.build is None:
+            return
+        with self.connection:
+            self.connection.execute("UPDATE builds SET end=?, result=? WHERE id=?;",
+                                    (time.time(), result, self.build))
+        self.build = None
+
+    def record_task(self, taskid, fn, pn, task, deps, exitcode, res):
+        if self.build is None:
+            return
+        with self.connection:
+            self.connection.execute("INSERT INTO tasks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
+                                    (self.build, taskid, fn, pn, task,
+                                     " ".join(str(dep) for dep in deps), exitcode,
+                                     res["start"], res["wall"], res["utime"], res["stime"],
+                                     res["maxrss"], res["readbytes"], res["writebytes"]))
+
+    def average_durations(self):
+        """
+        Return the average wall time of the successful runs of each task,
+        keyed by (pn, task)
+        """
+        durations = {}
+        for pn, task, wall in self.connection.execute("SELECT pn, task, AVG(wall) FROM tasks "
+                                                      "WHERE exitcode=0 GROUP BY pn, task;"):
+            durations[(pn, task)] = wall
+        return durations
+
+    def last_build(self):
+        for row in self.connection.execute("SELECT id, targets, start, end, result FROM builds "
+                                           "WHERE id IN (SELECT build FROM tasks) "
+                                           "ORDER BY id DESC LIMIT 1;"):
+            return row
+        return None
+
+    def slowest_tasks(self, build, count = 10):
+        return list(self.connection.execute("SELECT pn, task, wall, utime, stime, maxrss, "
+                                            "readbytes, writebytes FROM tasks WHERE build=? "
+                                            "ORDER BY wall DESC LIMIT ?;", (build, count)))
+
+    def slowest_recipes(self, build, count = 10):
+        return list(self.connection.execute("SELECT pn, SUM(wall), SUM(utime), SUM(stime), "
+                                            "MAX(maxrss) FROM tasks WHERE build=? GROUP BY fn "
+                                            "ORDER BY SUM(wall) DESC LIMIT ?;", (build, count)))
+
+    def critical_path(self, build):
+        """
+        Return the chain of executed tasks, as (pn, task, wall) tuples, with
+        the largest total wall time. Dependencies on tasks which didn't run
+        in the build are ignored.
+        """
+        tasks = {}
+        order = []
+        for taskid, pn, task, deps, wall in self.connection.execute(
+                "SELECT taskid, pn, task, deps, wall FROM tasks WHERE build=? ORDER BY start;", (build,)):
+            if task.endswith("_setscene"):
+                continue
+            tasks[taskid] = (pn, task, [int(dep) for dep in deps.split()], wall)
+            order.append(taskid)
+
+        # Tasks are ordered by start time so dependencies are seen first
+        longest = {}
+        previous = {}
+        for taskid in order:
+            pn, task, deps, wall = tasks[taskid]
+            best = None
+            for dep in deps:
+                if dep in longest and (best is None or longest[dep] > longest[best]):
+                    best = dep
+            longest[taskid] = wall + (longest[best] if best is not None else 0)
+            previous[taskid] = best
+
+        if not longest:
+            return []
+        taskid = max(longest, key=longest.get)
+        path = []
+        while taskid is not None:
+            pn, task, deps, wall = tasks[taskid]
+            path.append((pn, task, wall))
+            taskid = previous[taskid]
+        path.reverse()
+        return path
+
+def summary(filename, count = 10):
+    """
+    Print the slowest tasks and recipes and the critical path of the last
+    recorded build
+    """
+    stats = TaskStats(filename)
+    build = stats.last_build()
+    if not build:
+        print("No builds recorded in %s" % filename)
+        return
+
+    buildid, targets, start, end, result = build
+    print("Build %s of %s started %s (%s)" % (buildid, targets, time.ctime(start), result or "incomplete"))
+    if end:
+        print("Elapsed time: %.1fs" % (end - start))
+
+    print("\nSlowest tasks:")
+    print("  %10s %10s %10s %10s %10s %10s  %s" % ("wall(s)", "user(s)", "sys(s)", "maxrss(kB)", "read(kB)", "write(kB)", "task"))
+    for pn, task, wall, utime, stime, maxrss, readbytes, writebytes in stats.slowest_tasks(buildid, count):
+        print("  %10.1f %10.1f %10.1f %10d %10d %10d  %s:%s" % (wall, utime, stime, maxrss, readbytes / 1024, writebytes / 1024, pn, task))
+
+    print("\nSlowest recipes:")
+    print("  %10s %10s %10s %10s  %s" % ("wall(s)", "user(s)", "sys(s)", "maxrss(kB)", "recipe"))
+    for pn, wall, utime, stime, maxrss in stats.slowest_recipes(buildid, count):
+        print("  %10.1f %10.1f %10.1f %10d  %s" % (wall, utime, stime, maxrss, pn))
+
+    path = stats.critical_path(buildid)
+    print("\nCritical path (%.1fs):" % sum(entry[2] for entry in path))
+    for pn, task, wall in path:
+        print("  %10.1f  %s:%s" % (wall, pn, task))
@@ -21,6 +21,8 @@ BitBake Utility Functions
 
 import re, fcntl, os, string, stat, shutil, time
 import sys
+import glob
+import tempfile
 import errno
 import logging
 import bb
@@ -40,55 +42,64 @@ _context = {
     "time": time,
 }
 
+_version_token_regexp = re.compile('\d+|[a-zA-Z]+|.', re.DOTALL)
+
 def explode_version(s):
+    """
+    Split a version into runs of digits (as integers), runs of letters and
+    single other characters
+    """
     r = []
-    alpha_regexp = re.compile('^([a-zA-Z]+)(.*)$')
-    numeric_regexp = re.compile('^(\d+)(.*)$')
-    while (s != ''):
-        if s[0] in string.digits:
-            m = numeric_regexp.match(s)
-            r.append(int(m.group(1)))
-            s = m.group(2)
-            continue
-        if s[0] in string.letters:
-            m = alpha_regexp.match(s)
-            r.append(m.group(1))
-            s = m.group(2)
-            continue
-        r.append(s[0])
-        s = s[1:]
+    for token in _version_token_regexp.findall(s):
+        if token[0] in string.digits:
+            r.append(int(token))
+        else:
+            r.append(token)
     return r
 
-def vercmp_part(a, b):
-    va = explode_version(a)
-    vb = explode_version(b)
-    sa = False
-    sb = False
-    while True:
-        if va == []:
-            ca = None
-        else:
-            ca = va.pop(0)
-        if vb == []:
-            cb = None
+__version_key_cache__ = {}
+
+def version_part_key(s):
+    """
+    Return a tuple for a version or revision string which orders versions
+    as vercmp_part() does.
+
+    Each element of the version becomes (separator, type, value). The
+    separator field is 0 when the last alphabetic or punctuation element
+    seen was a separator. The type field orders numbers before other
+    strings. The string ends with (separator, 0), which orders before any
+    further element, so "1.0" < "1.0.1" and "1.0" < "1.0a".
+    """
+    try:
+        return __version_key_cache__[s]
+    except KeyError:
+        pass
+
+    key = []
+    separator = 1
+    for token in explode_version(s or ""):
+        if isinstance(token, basestring):
+            separator = 0 if token in separators else 1
+            key.append((separator, 2, token))
         else:
-            cb = vb.pop(0)
-        if ca == None and cb == None:
-            return 0
-
-        if isinstance(ca, basestring):
-            sa = ca in separators
-        if isinstance(cb, basestring):
-            sb = cb in separators
-        if sa and not sb:
-            return -1
-        if not sa and sb:
-            return 1
-
-        if ca > cb:
-            return 1
-        if ca < cb:
-            return -1
+            key.append((separator, 1, token))
+    key.append((separator, 0))
+    key = tuple(key)
+    if len(__version_key_cache__) >= 10000:
+        __version_key_cache__.clear()
+    __version_key_cache__[s] = key
+    return key
+
+def version_key(ta):
+    """
+    Return a tuple for an (epoch, version, revision) triplet which orders
+    versions as vercmp() does, for use as a sort key
+    """
+    (e, v, r) = ta
+    return (int(e or 0), version_part_key(v), version_part_key(r))
+
+def vercmp_part(a, b):
+    return cmp(version_part_key(a), version_part_key(b))
 
 def vercmp(ta, tb):
     (ea, va, ra) = ta
@@ -162,10 +173,10 @@ def vercmp_string(val1, val2):
     # cache lookup
     try:
         return __vercmp_cache__[valkey]
-        try:
-            return - __vercmp_cache__[val2 + " " + val1]
-        except KeyError:
-            pass
+    except KeyError:
+        pass
+    try:
+        return - __vercmp_cache__[val2 + " " + val1]
     except KeyError:
         pass
 
@@ -226,6 +237,40 @@ def vercmp_string(val1, val2):
     __vercmp_cache__[valkey] = 0
     return 0
 
+# A version starts with a word beginning with "(" and runs up to the first
+# word ending with ")", or to the end of the string if there is none.
+# Anything else is a dependency.
+_explode_deps_regexp = re.compile(r'\(\S*\)(?!\S)|\(.*?\s\S*\)(?!\S)|\(.*|(\S+)', re.DOTALL)
+
+# Dependency strings are very often identical across packages and
+# recipes, so parse each once
+_deps_cache_size = 10000
+__deps_cache__ = {}
+__dep_versions_cache__ = {}
+
+def parse_deps(s):
+    """
+    As explode_deps() but returns a tuple, shared between all callers
+    asking for the same string
+    """
+    try:
+        return __deps_cache__[s]
+    except KeyError:
+        pass
+
+    r = []
+    for dep in _explode_deps_regexp.findall(s):
+        if dep:
+            if type(dep) is str:
+                dep = intern(dep)
+            r.append(dep)
+    r = tuple(r)
+
+    if len(__deps_cache__) >= _deps_cache_size:
+        __deps_cache__.clear()
+    __deps_cache__[s] = r
+    return r
+
 def explode_deps(s):
     """
     Take an RDEPENDS style string of format:
@@ -233,22 +278,7 @@ def explode_deps(s):
     and return a list of dependencies.
     Version information is ignored.
     """
-    r = []
-    l = s.split()
-    flag = False
-    for i in l:
-        if i[0] == '(':
-            flag = True
-            #j = []
-        if not flag:
-            r.append(i)
-        #else:
-        #    j.append(i)
-        if flag and i.endswith(')'):
-            flag = False
-            # Ignore version
-            #r[-1] += ' ' + ' '.join(j)
-    return r
+    return list(parse_deps(s))
 
 def explode_dep_versions(s):
     """
@@ -256,6 +286,11 @@ def explode_dep_versions(s):
     "DEPEND1 (optional version) DEPEND2 (optional version) ..."
     and return a dictionary of dependencies and versions.
     """
+    try:
+        return dict(__dep_versions_cache__[s])
+    except KeyError:
+        pass
+
     r = {}
     l = s.replace(",", "").split()
     lastdep = None
@@ -277,7 +312,10 @@ def explode_dep_versions(s):
         elif inversion:
             lastver = lastver + " " + i
 
-    return r
+    if len(__dep_versions_cache__) >= _deps_cache_size:
+        __dep_versions_cache__.clear()
+    __dep_versions_cache__[s] = r
+    return dict(r)
 
 def join_deps(deps, commasep=True):
     """
@@ -307,13 +345,32 @@ def _print_trace(body, line):
         else:
             logger.error('     %.4d:%s', i, body[i-1])
 
+# Code objects compiled by better_compile, keyed by (source, name, mode)
+__compile_cache__ = {}
+
+def cached_compile(text, file, mode = "exec"):
+    """
+    compile() through the in-memory code cache
+    """
+    key = (text, file, mode)
+    try:
+        return __compile_cache__[key]
+    except KeyError:
+        pass
+
+    code = compile(text, file, mode)
+    if len(__compile_cache__) >= 10000:
+        __compile_cache__.clear()
+    __compile_cache__[key] = code
+    return code
+
 def better_compile(text, file, realfile, mode = "exec"):
     """
     A better compile method. This method
     will print  the offending lines.
     """
     try:
-        return compile(text, file, mode)
+        return cached_compile(text, file, mode)
     except Exception as e:
         # split the text into lines again
         body = text.split('\n')
@@ -457,6 +514,52 @@ def unlockfile(lf):
     fcntl.flock(lf.fileno(), fcntl.LOCK_UN)
     lf.close()
 
+@contextmanager
+def replacing(filename, shard = False):
+    """
+    Context manager yielding a file to write the new contents of filename
+    to, or a new shard of it (filename.<unique>.shard) if shard is set.
+    The file is written under a temporary name and renamed into place
+    afterwards, so readers see either all of it or none at all.
+    """
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(filename),
+                                   prefix="%s.%d." % (os.path.basename(filename), os.getpid()),
+                                   suffix=".tmp")
+    try:
+        # mkstemp() makes the file private to its owner, give it the
+        # permissions open() would have
+        mask = os.umask(0)
+        os.umask(mask)
+        os.fchmod(fd, 0666 & ~mask)
+        with os.fdopen(fd, "wb") as f:
+            yield f
+    except:
+        os.unlink(tmpname)
+        raise
+    if shard:
+        os.rename(tmpname, os.path.splitext(tmpname)[0] + ".shard")
+    else:
+        os.rename(tmpname, filename)
+
+def shards(filename):
+    """
+    Return the shards of filename written with replacing()
+    """
+    return glob.glob(filename + ".*.shard")
+
+def remove_stale_temporaries(filename, age = 3600):
+    """
+    Remove the temporary files left behind by writers of filename that
+    died in replacing() more than age seconds ago
+    """
+    limit = time.time() - age
+    for tmpname in glob.glob(filename + ".*.tmp"):
+        try:
+            if os.path.getmtime(tmpname) < limit:
+                os.unlink(tmpname)
+        except OSError:
+            pass
+
 def md5_file(filename):
     """
     Return the hex string representation of the MD5 checksum of filename.
@@ -588,10 +691,8 @@ def build_environment(d):
     Build an environment from all exported variables.
     """
     import bb.data
-    for var in bb.data.keys(d):
-        export = bb.data.getVarFlag(var, "export", d)
-        if export:
-            os.environ[var] = bb.data.getVar(var, d, True) or ""
+    for var in d.keys_with_flag("export"):
+        os.environ[var] = bb.data.getVar(var, d, True) or ""
 
 def remove(path, recurse=False):
     """Equivalent to rm -f or rm -rf"""
@@ -56,7 +56,7 @@ setup(name='bitbake',
       packages = ["bb.server", "bb.parse.parse_py", "bb.parse", "bb.fetch",
                   "bb.fetch2", "bb.ui.crumbs", "bb.ui", "bb.pysh", "bb"],
       py_modules = ["codegen"],
-      scripts = ["bin/bitbake", "bin/bitbake-layers", "bin/bitbake-diffsigs"],
+      scripts = ["bin/bitbake", "bin/bitbake-layers", "bin/bitbake-diffsigs", "bin/bitbake-taskstats", "bin/bitbake-worker-agent"],
       data_files = [("share/bitbake", glob("conf/*") + glob("classes/*")),
                   ("share/doc/bitbake-%s/manual" % __version__, glob("doc/manual/html/*"))],
       cmdclass = {